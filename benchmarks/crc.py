@@ -0,0 +1,41 @@
+'''
+Micro-benchmark of the CRC check of received telegrams in EmsProtocol.
+
+Measures calc_crc for telegrams of typical and maximum length, and the cost of the check in
+EmsProtocol._rx_filter, which every telegram of the RX queue passes.
+
+Usage: python3 -m benchmarks.crc [count]
+'''
+
+import logging
+import sys
+import timeit
+
+from ems_bus import ems_protocol, ems_simulator
+from ems_bus.ems_crc import calc_crc
+
+TELEGRAMS = {
+    'short (6 bytes)': ems_simulator.telegram(0x0b, 0x88, 0x02, 0, b'\x20'),
+    'monitor (30 bytes)': ems_simulator.telegram(
+        0x08, 0x00, 0x18, 0, ems_simulator.default_devices()[0x08][0x18]),
+    'maximum (32 bytes)': ems_simulator.telegram(0x08, 0x00, 0x18, 0, bytes(27)),
+}
+
+
+def main(count):
+    logging.disable(logging.ERROR)
+    for name, message in TELEGRAMS.items():
+        duration = timeit.timeit(lambda: calc_crc(message), number=count)
+        print(f'calc_crc {name:20}: {duration / count * 1e6:6.2f} us')
+
+    message = TELEGRAMS['monitor (30 bytes)']
+    results = {}
+    for crc in (False, True):
+        proto = ems_protocol.EmsProtocol(None, 0, 0x0b, crc=crc)
+        results[crc] = timeit.timeit(lambda: proto._rx_filter(message), number=count) / count
+        print(f'_rx_filter with crc={crc!s:5}   : {results[crc] * 1e6:6.2f} us')
+    print(f'CRC check cost: {(results[True] - results[False]) * 1e6:.2f} us per telegram')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,54 @@
+'''
+Checks and benchmarks the compiled message decoders.
+
+First verifies for every message in ems_messages.py that the decoder returns exactly the values
+the fields decode themselves, using random telegrams. Then compares the time to decode all
+fields of UbaMonitorFast.
+
+Usage: python3 -m benchmarks.decode [count]
+'''
+
+import os
+import sys
+import timeit
+
+from ems_bus import ems_messages
+
+
+def messages():
+    for obj in ems_messages.__dict__.values():
+        if isinstance(obj, type) and issubclass(obj, ems_messages.Message) and \
+           obj.Meta.length > 0:
+            yield obj(0x08, None)
+
+
+def check(rounds=1000):
+    for msg in messages():
+        fields = [field for _, field in msg.get_fields()]
+        decoder = msg._decoder
+        for _ in range(rounds):
+            data = bytearray(os.urandom(msg.Meta.length))
+            values = decoder.decode(data)
+            for field, bulk, value in zip(fields, decoder.bulk, values):
+                if bulk and field.decode(data) != value:
+                    raise(AssertionError(f'{msg.__class__.__name__}.{field.name}: '
+                                         f'{field.decode(data)!r} != {value!r}'))
+        print(f'{msg.__class__.__name__:32} {sum(decoder.bulk):3}/{len(fields):3} fields ok')
+
+
+def run(count):
+    msg = ems_messages.UbaMonitorFast(0x08, None)
+    data = bytearray(os.urandom(msg.Meta.length))
+    fields = [field for _, field in msg.get_fields()]
+    def by_field():
+        return([field.decode(data) for field in fields])
+    def compiled():
+        return(msg._decoder.decode(data))
+    for name, func in (('per field', by_field), ('compiled', compiled)):
+        duration = min(timeit.repeat(func, number=count, repeat=5)) / count
+        print(f'{name:12}: {duration * 1e6:.1f} us per UbaMonitorFast')
+
+
+if __name__ == '__main__':
+    check()
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,125 @@
+'''
+Benchmark of the entity registration on device discovery of the Home Assistant component
+
+Before, the event handler added each new entity with its own call of async_add_entities. Now, the
+new entities of the telegrams handled together are added with one call per platform. This runs
+the bus simulator with a boiler and a thermostat answering all initial requests and EmsProtocol,
+and adds the entities as the component does in both ways. Home Assistant is not needed, the
+platforms are modeled by a cost per call and per entity, which block the event loop. Reports the
+calls, the time from the start of the bus to the last entity added, the full dashboard, and the
+time the platforms blocked the event loop. The replies of the devices are serialized by the
+polling of the bus master, so that time is mostly hidden in the discovery on an idle bus.
+
+In Home Assistant, the stats service of the component logs the time of the last entity added
+after the start of the bus.
+
+Usage: python3 -m benchmarks.discovery [--call-cost S] [--entity-cost S] [--timeout S]
+'''
+
+import argparse
+import asyncio
+import time
+
+from benchmarks.routing import entity_platform
+from ems_bus import ems_protocol, ems_simulator
+from ems_bus.ems_devices import EMS_DEVICE_TYPE_BOILER, EMS_DEVICE_TYPE_THERMOSTAT, \
+                                EMS_INITIAL_REQUESTS
+
+# Time without a new entity until the discovery is considered complete, in s
+IDLE_TIME = 1.0
+
+
+def devices():
+    ''' Returns the simulated devices, answering all initial requests '''
+    data = ems_simulator.default_devices()
+    for address, device_type in ((ems_simulator.MASTER_ID, EMS_DEVICE_TYPE_BOILER),
+                                 (ems_simulator.THERMOSTAT_ID, EMS_DEVICE_TYPE_THERMOSTAT)):
+        for msg_type in EMS_INITIAL_REQUESTS[device_type]:
+            data[address].setdefault(msg_type.Meta.identification, ems_simulator.encode(msg_type))
+    return(data)
+
+
+class Platforms:
+    ''' Models the async_add_entities of the platforms of Home Assistant '''
+    def __init__(self, call_cost, entity_cost):
+        self.call_cost = call_cost
+        self.entity_cost = entity_cost
+        self.calls = 0
+        self.entities = 0
+        self.last_added = None
+        # Time the event loop was blocked, in s
+        self.blocked = 0.0
+
+    def add(self, entities):
+        cost = self.call_cost + self.entity_cost * len(entities)
+        time.sleep(cost)
+        self.blocked += cost
+        self.calls += 1
+        self.entities += len(entities)
+        self.last_added = time.monotonic()
+
+
+async def run(args, simulator, batched):
+    platforms = Platforms(args.call_cost, args.entity_cost)
+    known = set()
+    new_entities = {}
+    loop = asyncio.get_running_loop()
+
+    def add_new_entities():
+        for entities in new_entities.values():
+            platforms.add(entities)
+        new_entities.clear()
+
+    async def event_handler(signal, device, message, _):
+        if signal == ems_protocol.EVENT_OFFLINE:
+            return
+        for field_name, field_obj in message.get_fields():
+            unique_id = (device.address, message.Meta.identification, field_name)
+            if unique_id in known:
+                continue
+            known.add(unique_id)
+            platform_name = entity_platform(message, field_obj)[0]
+            if not batched:
+                platforms.add([unique_id])
+                continue
+            if not new_entities:
+                loop.call_soon(add_new_entities)
+            new_entities.setdefault(platform_name, []).append(unique_id)
+
+    proto = ems_protocol.EmsProtocol(simulator.path, 0, ems_simulator.CLIENT_ID, event_handler)
+    start = time.monotonic()
+    if await proto.start() is None:
+        return(None)
+    while time.monotonic() - start < args.timeout and (
+            platforms.last_added is None or time.monotonic() - platforms.last_added < IDLE_TIME):
+        await asyncio.sleep(0.1)
+    await proto.stop()
+    if platforms.last_added is not None:
+        platforms.last_added -= start
+    return(platforms)
+
+
+def main(args):
+    for name, batched in (('per entity', False), ('batched', True)):
+        simulator = ems_simulator.BusSimulator(devices=devices())
+        simulator.start()
+        try:
+            platforms = asyncio.run(run(args, simulator, batched))
+        finally:
+            simulator.close()
+        if platforms is None or platforms.last_added is None:
+            print(f'{name:10}: no entities added')
+            continue
+        print(f'{name:10}: {platforms.entities} entities in {platforms.calls:3} calls, '
+              f'last one {platforms.last_added:.2f} s after the start, '
+              f'event loop blocked {platforms.blocked:.2f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--call-cost', type=float, default=0.002,
+                        help='Time of a call of async_add_entities, in s')
+    parser.add_argument('--entity-cost', type=float, default=0.0002,
+                        help='Additional time per entity added, in s')
+    parser.add_argument('--timeout', type=float, default=15.0)
+    main(parser.parse_args())
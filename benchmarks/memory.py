@@ -0,0 +1,54 @@
+'''
+Memory benchmark of the message objects kept by EmsProtocol.
+
+Simulates 20 devices which each know every message of ems_messages.py and parsed a full telegram
+of it. Reports the memory allocated for them, measured with tracemalloc.
+
+Usage: python3 -m benchmarks.memory [devices]
+'''
+
+import os
+import sys
+import tracemalloc
+
+from ems_bus import ems_messages
+from ems_bus.ems_protocol import EmsDevice
+
+MESSAGES = [obj for obj in ems_messages.__dict__.values()
+            if isinstance(obj, type) and issubclass(obj, ems_messages.Message) and
+            obj.Meta.length > 0]
+
+
+def telegram(msg_type):
+    data = bytearray(os.urandom(msg_type.Meta.length))
+    # Keep date fields valid: day 1, month 1, hour 0, minute 0.
+    for _, field in msg_type._layout:
+        if field.__class__.__name__ in ('DateField', 'DateTimeField'):
+            data[field.pos:field.pos + field.length] = bytes((1, 1, 0, 1, 0, 0)[:field.length])
+    return(data)
+
+
+def main(num_devices):
+    telegrams = {msg_type: telegram(msg_type) for msg_type in MESSAGES}
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    devices = {}
+    for address in range(8, 8 + num_devices):
+        messages = {}
+        for msg_type, data in telegrams.items():
+            msg = msg_type(address, None)
+            msg.parse(data, 0)
+            messages[msg_type.Meta.identification] = msg
+        devices[address] = EmsDevice(address, None, messages)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    count = num_devices * len(MESSAGES)
+    print(f'{num_devices} devices, {count} messages: {size} bytes, '
+          f'{size / num_devices:.0f} bytes per device, {size / count:.0f} bytes per message')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
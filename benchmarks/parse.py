@@ -0,0 +1,59 @@
+'''
+Micro-benchmark of Message.parse for UbaMonitorFast.
+
+Compares the field layout compiled at class creation against scanning the message with dir() for
+every telegram, as it was done before.
+
+Usage: python3 -m benchmarks.parse [count]
+'''
+
+import sys
+import timeit
+
+from ems_bus.ems_fields import Field
+from ems_bus.ems_messages import UbaMonitorFast
+
+PAYLOADS = (
+    bytes.fromhex('2d01c2640a0000fd00020e01f30142012c00001d0000000000'),
+    bytes.fromhex('2e01c3640b0000f400020f01f40143012d00001c0000000000'),
+)
+
+
+class DirScanMonitorFast(UbaMonitorFast):
+    '''UbaMonitorFast finding its fields with dir() on every call'''
+    def get_fields(self):
+        for field_name in dir(self):
+            field_obj = getattr(self, field_name)
+            if issubclass(field_obj.__class__, Field):
+                yield (field_name, field_obj)
+
+    def parse(self, update, offset):
+        changed_fields = []
+        update_end = offset + len(update)
+        for _, field in self.get_fields():
+            if field.pos < offset or field.pos >= update_end:
+                continue
+            if field.pos + field.length > update_end:
+                continue
+            index = self._index[field.attr]
+            if field.has_changed(update, offset, self.message, self.values[index]) and \
+               field not in changed_fields:
+                changed_fields.append(field)
+        self.message[offset:update_end] = update
+        for field in changed_fields:
+            self.values[self._index[field.attr]] = field.decode(self.message)
+        return(changed_fields)
+
+
+def run(msg_type, count):
+    msg = msg_type(0x08, None)
+    def parse():
+        for payload in PAYLOADS:
+            msg.parse(payload, 0)
+    return(min(timeit.repeat(parse, number=count, repeat=5)) / count / len(PAYLOADS))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, msg_type in (('dir() scan', DirScanMonitorFast), ('layout', UbaMonitorFast)):
+        print(f'{name:12}: {run(msg_type, count) * 1e6:.1f} us per telegram')
@@ -0,0 +1,196 @@
+'''
+End-to-end benchmark of the RX pipeline: ems_serio, the RX queue or ring, EmsProtocol.recv,
+parse_message and the event handler.
+
+The bus simulator streams telegrams on a pseudo-terminal from a separate process, so the CPU time
+of this process is the one of the driver thread and the event loop. Synthetic telegrams are
+UbaMonitorFast broadcasts carrying a sequence number, which gives the latency from writing the
+last character to the event handler. A recorded stream is a file with one telegram in hex per
+line, also in the "RX: 08 00 ..." format of the driver log. For it, no latency is reported.
+
+Do not run this while the ems_serio driver is running, it uses the same queues.
+
+Usage: python3 -m benchmarks.pipeline [--count N] [--rate R] [--stream FILE] [--batch]
+                                      [--ring] [--depth N] [--overflow POLICY] [--metrics]
+                                      [--save FILE] [--baseline FILE]
+'''
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import time
+
+import posix_ipc
+
+from ems_bus import ems_protocol, ems_serio, ems_simulator
+from ems_bus.ems_devices import EMS_DEVICES
+from ems_bus.ems_messages import UbaMonitorFast
+
+BOILER_PRODUCT_ID = 123
+# Time without progress until the pipeline is considered drained, in s
+IDLE_TIMEOUT = 1.0
+OVERFLOW_POLICIES = {
+    'drop_newest': ems_serio.RX_OVERFLOW_DROP_NEWEST,
+    'drop_oldest': ems_serio.RX_OVERFLOW_DROP_OLDEST,
+    'coalesce': ems_serio.RX_OVERFLOW_COALESCE,
+}
+DROP_STATS = ('rx_dropped', 'rx_dropped_oldest', 'rx_coalesced')
+
+
+def synthetic_stream(count):
+    ''' Returns UbaMonitorFast broadcasts with the sequence number in the data bytes 1 to 4 '''
+    data = bytearray(ems_simulator.default_devices()[ems_simulator.MASTER_ID][0x18])
+    telegrams = []
+    for seq in range(count):
+        data[1:5] = seq.to_bytes(4, 'big')
+        telegrams.append(ems_simulator.telegram(ems_simulator.MASTER_ID, 0x00,
+                                                UbaMonitorFast.Meta.identification, 0, data))
+    return(telegrams)
+
+
+def recorded_stream(path):
+    ''' Returns the telegrams of a file, one per line in hex '''
+    telegrams = []
+    with open(path) as stream:
+        for line in stream:
+            line = line.split('RX:')[-1].strip()
+            if line and not line.startswith('#'):
+                telegrams.append(bytes.fromhex(line))
+    return(telegrams)
+
+
+class BenchProtocol(ems_protocol.EmsProtocol):
+    def __init__(self, path, count, synthetic, args):
+        super().__init__(path, 0, ems_simulator.CLIENT_ID, self.handle_event, batch=args.batch,
+                         ring=args.ring, queue_depth=args.depth,
+                         rx_overflow=OVERFLOW_POLICIES[args.overflow], metrics=args.metrics)
+        self.synthetic = synthetic
+        self.received = [0.0] * count
+        self.parsed = 0
+        self.events = 0
+        self.last = 0.0
+        # The boiler is known, so its messages are parsed and reported.
+        product = next(i for i in EMS_DEVICES if i[0] == BOILER_PRODUCT_ID)
+        self.known_devices[ems_simulator.MASTER_ID] = \
+            ems_protocol.EmsDevice(ems_simulator.MASTER_ID, product, {})
+
+    async def parse_message(self, message):
+        self.parsed += 1
+        self.last = time.monotonic()
+        await super().parse_message(message)
+
+    async def handle_event(self, _, __, message, ___):
+        if message is None:
+            # A device of a recorded stream went offline
+            return
+        now = time.monotonic()
+        self.events += 1
+        self.last = now
+        if self.synthetic:
+            self.received[int.from_bytes(message.message[1:5], 'big')] = now
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return(usage.ru_utime + usage.ru_stime)
+
+
+def percentile(values, fraction):
+    return(values[min(int(len(values) * fraction), len(values) - 1)])
+
+
+async def run(args):
+    synthetic = args.stream is None
+    telegrams = synthetic_stream(args.count) if synthetic else recorded_stream(args.stream)
+    count = len(telegrams)
+
+    # Remove the RX queue, so the protocol does not find it full and query devices.
+    try:
+        posix_ipc.unlink_message_queue(ems_protocol.RX_QUEUE_NAME)
+    except posix_ipc.ExistentialError:
+        pass
+
+    simulator = ems_simulator.BusSimulator()
+    proto = BenchProtocol(simulator.path, count, synthetic, args)
+    if await proto.start() is None:
+        raise(RuntimeError('Could not start ems_serio'))
+    await asyncio.sleep(0.2)
+    dropped = ems_serio.stats()
+
+    context = multiprocessing.get_context('fork')
+    sent = context.Array('d', count, lock=False)
+    feeder = context.Process(target=simulator.stream, args=(telegrams, args.rate, sent))
+    cpu = cpu_time()
+    start = time.monotonic()
+    feeder.start()
+    while feeder.is_alive() or time.monotonic() - max(proto.last, sent[count - 1]) < IDLE_TIMEOUT:
+        if proto.parsed == count:
+            break
+        await asyncio.sleep(0.01)
+    feeder.join()
+    cpu = cpu_time() - cpu
+    duration = proto.last - start
+
+    results = {
+        'telegrams': count,
+        'parsed': proto.parsed,
+        'events': proto.events,
+        **{key: ems_serio.stats()[key] - dropped[key] for key in DROP_STATS},
+        'telegrams_per_s': proto.parsed / duration if duration > 0 else 0.0,
+        'cpu_us_per_telegram': cpu / max(proto.parsed, 1) * 1e6,
+    }
+    if synthetic:
+        latencies = sorted(r - s for s, r in zip(sent, proto.received) if r)
+        if latencies:
+            results['latency_p50_us'] = percentile(latencies, 0.5) * 1e6
+            results['latency_p99_us'] = percentile(latencies, 0.99) * 1e6
+
+    await proto.stop()
+    simulator.close()
+    return(results)
+
+
+def compare(results, baseline):
+    ''' Prints the results with the change to the baseline '''
+    for key, value in results.items():
+        line = f'{key:20} {value:12.1f}'
+        if key in baseline and baseline[key]:
+            line += f'  {(value - baseline[key]) / baseline[key] * 100:+7.1f} %' \
+                    f' (baseline {baseline[key]:.1f})'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the RX pipeline')
+    parser.add_argument('--count', type=int, default=10000, help='Synthetic telegrams')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Telegrams per second, 0 for as fast as possible')
+    parser.add_argument('--stream', help='File with recorded telegrams')
+    parser.add_argument('--batch', action='store_true', help='Use the batch mode of EmsProtocol')
+    parser.add_argument('--ring', action='store_true',
+                        help='Receive from the shared memory ring instead of the RX queue')
+    parser.add_argument('--depth', type=int, default=ems_serio.QUEUE_DEPTH,
+                        help='Depth of the message queues')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default='drop_newest',
+                        help='Policy of the driver on a full RX queue')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Collect the protocol metrics of ems_metrics')
+    parser.add_argument('--save', help='Save the results as baseline to this file')
+    parser.add_argument('--baseline', help='Compare with the results in this file')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    compare(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
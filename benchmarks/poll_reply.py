@@ -0,0 +1,103 @@
+'''
+Benchmark of the poll reply time of the driver with packet logging and host load
+
+Runs the bus simulator polling every 2 ms and EmsProtocol with all ems_serio log flags on. A log
+handler sleeping for each record stands in for a slow log destination, which holds the GIL. The
+driver logs into a ring drained by the event loop, so the time from our poll to the reply should
+not depend on the handler. --load starts processes spinning on the CPUs, and --rt-priority,
+--cpu and --mlock set the scheduling of the reader thread. Reports the poll_reply_hist
+statistics of the driver, the reply times seen by the simulator and the records the log ring
+dropped. The driver counts from the read() returning the poll, so only the simulator sees how
+late the reader thread was woken up.
+
+Usage: python3 -m benchmarks.poll_reply [--duration S] [--handler-delay S] [--load N]
+                                        [--rt-priority P] [--cpu N] [--mlock]
+'''
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import time
+
+from ems_bus import ems_protocol, ems_serio, ems_simulator
+from ems_bus.ems_stats import histogram_bounds
+
+
+class SlowHandler(logging.Handler):
+    ''' Log handler taking delay s per record '''
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.records = 0
+
+    def emit(self, record):
+        self.records += 1
+        time.sleep(self.delay)
+
+
+def spin(stop):
+    while not stop.is_set():
+        pass
+
+
+async def run(args, simulator):
+    async def event_handler(*_):
+        pass
+
+    proto = ems_protocol.EmsProtocol(simulator.path, 0x3f, ems_simulator.CLIENT_ID,
+                                     event_handler, rt_priority=args.rt_priority, cpu=args.cpu,
+                                     mlock=args.mlock)
+    if await proto.start() is None:
+        return
+    await asyncio.sleep(args.duration)
+    await proto.stop()
+
+
+def main(args):
+    handler = SlowHandler(args.handler_delay)
+    logger = logging.getLogger('ems_serio')
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    stop = multiprocessing.Event()
+    load = [multiprocessing.Process(target=spin, args=(stop,)) for _ in range(args.load)]
+    for process in load:
+        process.start()
+    simulator = ems_simulator.BusSimulator(poll_interval=0.002)
+    simulator.start()
+    try:
+        asyncio.run(run(args, simulator))
+    finally:
+        simulator.close()
+        stop.set()
+        for process in load:
+            process.join()
+
+    stats = ems_serio.stats()
+    print(f'{simulator.stats["polls"]} polls, {stats["tx_polls"]} answered, '
+          f'{handler.records} log records, {stats["log_dropped"]} dropped')
+    replies = sorted(simulator.reply_times)
+    if replies:
+        print('simulator reply time p50 {:.0f} us, p99 {:.0f} us, max {:.0f} us'.format(
+            replies[len(replies) // 2] * 1e6, replies[len(replies) * 99 // 100] * 1e6,
+            replies[-1] * 1e6))
+    print(f'driver poll reply time max {stats["poll_reply_max"]} us')
+    bounds = histogram_bounds('poll_reply_hist')
+    for i, count in enumerate(stats['poll_reply_hist']):
+        label = f'< {bounds[i]}' if bounds[i] is not None else f'>= {bounds[i - 1]}'
+        print(f'  {label:>8} us: {count}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--handler-delay', type=float, default=0.0002,
+                        help='Time the log handler takes per record, in s')
+    parser.add_argument('--load', type=int, default=0, help='Processes spinning on the CPUs')
+    parser.add_argument('--rt-priority', type=int, default=0,
+                        help='SCHED_FIFO priority of the reader thread, 0 for the default')
+    parser.add_argument('--cpu', type=int, default=-1, help='CPU of the reader thread')
+    parser.add_argument('--mlock', action='store_true', help='Lock the memory')
+    main(parser.parse_args())
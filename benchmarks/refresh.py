@@ -0,0 +1,111 @@
+'''
+Benchmark of the freshness of the initial requests and the reads on the bus, with and without
+their refresh
+
+Before, the initial requests of a device were read once and then only updated by broadcasts.
+Now, the RequestScheduler of EmsProtocol reads them again after their refresh interval, skipping
+the messages broadcast meanwhile, within a budget of outstanding reads and reads per minute. This
+runs the bus simulator with a boiler, which broadcasts its UbaMonitorFast, and a thermostat. The
+intervals of EMS_REFRESH_INTERVALS are multiplied by --scale to keep the run short, the minute
+of --reads-per-minute is not. Reports the maximum age of the data of each message in the second
+half of the run, the reads per minute at the unscaled intervals and the telegrams which postponed
+a read.
+
+Usage: python3 -m benchmarks.refresh [--duration S] [--scale F] [--reads-per-minute N]
+                                     [--max-outstanding N]
+'''
+
+import argparse
+import asyncio
+import time
+
+from ems_bus import ems_protocol, ems_simulator
+from ems_bus.ems_devices import EMS_DEVICE_TYPE_BOILER, EMS_DEVICE_TYPE_THERMOSTAT, \
+                                EMS_INITIAL_REQUESTS, EMS_REFRESH_INTERVALS
+
+DEVICES = ((ems_simulator.MASTER_ID, EMS_DEVICE_TYPE_BOILER),
+           (ems_simulator.THERMOSTAT_ID, EMS_DEVICE_TYPE_THERMOSTAT))
+# Interval of sampling the ages, in s
+SAMPLE_INTERVAL = 0.05
+
+
+def devices():
+    ''' Returns the simulated devices, answering all initial requests '''
+    data = ems_simulator.default_devices()
+    for address, device_type in DEVICES:
+        for msg_type in EMS_INITIAL_REQUESTS[device_type]:
+            data[address].setdefault(msg_type.Meta.identification, ems_simulator.encode(msg_type))
+    return(data)
+
+
+class BenchProtocol(ems_protocol.EmsProtocol):
+    ''' Records the time of the last telegram of each message at offset 0 '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # {(address, message type ID): time}
+        self.received = {}
+
+    async def parse_message(self, message):
+        if message[3] == 0:
+            self.received[(message[0], message[2])] = time.monotonic()
+        await super().parse_message(message)
+
+
+async def run(args, simulator, intervals):
+    ''' Returns ({message: maximum age in s}, protocol statistics) '''
+    async def event_handler(*_):
+        pass
+
+    proto = BenchProtocol(simulator.path, 0, ems_simulator.CLIENT_ID, event_handler,
+                          refresh_intervals=intervals, max_outstanding_reads=args.max_outstanding,
+                          reads_per_minute=args.reads_per_minute)
+    if await proto.start() is None:
+        return(None)
+    start = time.monotonic()
+    ages = {}
+    while time.monotonic() - start < args.duration:
+        await asyncio.sleep(SAMPLE_INTERVAL)
+        now = time.monotonic()
+        if now - start < args.duration / 2:
+            continue
+        for address, device_type in DEVICES:
+            for msg_type in EMS_INITIAL_REQUESTS[device_type]:
+                received = proto.received.get((address, msg_type.Meta.identification), start)
+                ages[msg_type.__name__] = max(ages.get(msg_type.__name__, 0), now - received)
+    stats = proto.stats()
+    await proto.stop()
+    return(ages, stats)
+
+
+def main(args):
+    scaled = {msg_type: interval * args.scale
+              for msg_type, interval in EMS_REFRESH_INTERVALS.items()}
+    results = {}
+    for name, intervals in (('read once', {msg_type: 1e9 for msg_type in scaled}),
+                            ('refreshed', scaled)):
+        simulator = ems_simulator.BusSimulator(devices=devices())
+        simulator.start()
+        try:
+            results[name] = asyncio.run(run(args, simulator, intervals))
+        finally:
+            simulator.close()
+    print(f'{"message":30} {"interval":>8} ' + ' '.join(f'{name:>10}' for name in results))
+    for msg_type, interval in scaled.items():
+        ages = ' '.join(f'{result[0].get(msg_type.__name__, 0):9.2f}s' for result in
+                        results.values())
+        print(f'{msg_type.__name__:30} {interval:7.2f}s {ages}')
+    for name, (_, stats) in results.items():
+        print(f'{name}: {stats["refresh_reads"]} reads, '
+              f'{stats["refresh_reads"] * 60 * args.scale / args.duration:.2f} reads/min unscaled, '
+              f'{stats["refresh_postponed"]} postponed by broadcasts, '
+              f'{stats["refresh_timeouts"]} timed out')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--scale', type=float, default=0.01,
+                        help='Factor of the refresh intervals')
+    parser.add_argument('--reads-per-minute', type=int, default=600)
+    parser.add_argument('--max-outstanding', type=int, default=2)
+    main(parser.parse_args())
@@ -0,0 +1,83 @@
+'''
+Micro-benchmark of the routing of an update to the entities in the Home Assistant event handler
+
+Before, the event handler derived the platform and built the unique ID of every field of the
+message on every telegram. Now, the route of a (device address, message type) is computed once and
+an update looks up the changed fields in it. The platform classes of Home Assistant are replaced
+by their names, so this runs without Home Assistant.
+
+Usage: python3 -m benchmarks.routing [count]
+'''
+
+import sys
+import timeit
+
+from ems_bus.ems_fields import BooleanField, BooleanIntegerField, IntegerField
+from ems_bus.ems_messages import Hc1ParamMessage, UbaMonitorFast
+from ems_bus.ems_units import UnitCelsius
+
+DOMAIN = 'ems_bus'
+ADDRESS = 0x08
+
+
+def entity_platform(message, field_obj):
+    ''' The platform derivation of the event handler '''
+    platform_name = None
+    if getattr(message.Meta, 'write', False):
+        if issubclass(field_obj.__class__, BooleanField) or \
+           issubclass(field_obj.__class__, BooleanIntegerField):
+            platform_name = 'switch'
+        elif issubclass(field_obj.__class__, IntegerField):
+            if field_obj.unit == UnitCelsius:
+                platform_name = 'climate'
+            elif hasattr(field_obj.unit, 'VALUES'):
+                platform_name = 'input_select'
+            else:
+                platform_name = 'input_number'
+    if platform_name is None:
+        platform_name = 'sensor'
+    return(platform_name, platform_name)
+
+
+def per_field(entities, message, affected_fields):
+    ''' Returns the unique IDs of the changed fields, as it was done before '''
+    updated = []
+    for field_name, field_obj in message.get_fields():
+        platform_name, platform_type = entity_platform(message, field_obj)
+        unique_id = f'{DOMAIN}_{ADDRESS:02x}_{message.Meta.identification:02x}_{field_name}'
+        if not unique_id in entities:
+            entities[unique_id] = platform_type
+        if field_obj in affected_fields:
+            updated.append(unique_id)
+    return(updated)
+
+
+def routed(routes, message, affected_fields):
+    ''' Returns the unique IDs of the changed fields from the routing table '''
+    key = (ADDRESS, message.Meta.identification)
+    route = routes.get(key)
+    if route is None:
+        route = routes[key] = {
+            field_obj: entity_platform(message, field_obj)[0:1] +
+            (f'{DOMAIN}_{ADDRESS:02x}_{message.Meta.identification:02x}_{field_name}', None)
+            for field_name, field_obj in message.get_fields()}
+    return([route[field_obj][1] for field_obj in affected_fields if field_obj in route])
+
+
+def run(handler, message, affected_fields, count):
+    table = {}
+    return(min(timeit.repeat(lambda: handler(table, message, affected_fields), number=count,
+                             repeat=5)) / count)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for msg_type in (UbaMonitorFast, Hc1ParamMessage):
+        message = msg_type(ADDRESS, None)
+        fields = [field_obj for _, field_obj in message.get_fields()]
+        # A telegram changes a few fields, e.g. two temperatures
+        affected_fields = fields[:2]
+        assert per_field({}, message, affected_fields) == routed({}, message, affected_fields)
+        for name, handler in (('per field', per_field), ('routing table', routed)):
+            print(f'{msg_type.__name__:16} {len(fields):2} fields, {name:13}: '
+                  f'{run(handler, message, affected_fields, count) * 1e6:.2f} us per telegram')
@@ -0,0 +1,89 @@
+'''
+Benchmark of the RX path from the POSIX message queue into EmsProtocol.
+
+Sends telegrams into the RX queue from a separate thread and measures the throughput and the
+latency until EmsProtocol parses them. Do not run this while the ems_serio driver is running,
+it uses the same queues.
+
+Usage: python3 -m benchmarks.rx_queue [count]
+'''
+
+import asyncio
+import statistics
+import sys
+import threading
+import time
+
+import posix_ipc
+
+from ems_bus import ems_protocol
+from ems_bus.ems_crc import calc_crc
+
+# The last byte is the CRC, which EmsProtocol checks by default
+TELEGRAM = bytes.fromhex('08001800' + '00' * 25 + '00')[:ems_protocol.EMS_MAX_TELEGRAM_LENGTH]
+
+
+class BenchProtocol(ems_protocol.EmsProtocol):
+    def __init__(self, count):
+        super().__init__(None, 0, 0x0b)
+        self.count = count
+        self.sent = [0.0] * count
+        self.received = [0.0] * count
+        self.num_received = 0
+        self.done = None
+
+    async def parse_message(self, message):
+        self.received[int.from_bytes(message[4:8], 'big')] = time.perf_counter()
+        self.num_received += 1
+        if self.num_received == self.count:
+            self.done.set()
+
+
+def send(queue, proto):
+    data = bytearray(TELEGRAM)
+    for i in range(proto.count):
+        data[4:8] = i.to_bytes(4, 'big')
+        data[-1] = calc_crc(data)
+        proto.sent[i] = time.perf_counter()
+        queue.send(data)
+
+
+async def main(count):
+    rx_queue = posix_ipc.MessageQueue(
+        ems_protocol.RX_QUEUE_NAME, posix_ipc.O_CREAT, 0o666, 10, 32, False, True)
+    tx_queue = posix_ipc.MessageQueue(
+        ems_protocol.TX_QUEUE_NAME, posix_ipc.O_CREAT, 0o666, 10, 32, False, True)
+    # Empty the queue so the protocol does not clear it and query devices.
+    rx_queue.block = False
+    while rx_queue.current_messages:
+        rx_queue.receive()
+    rx_queue.block = True
+
+    proto = BenchProtocol(count)
+    proto.done = asyncio.Event()
+    proto.run = True
+    recv = asyncio.create_task(proto.recv())
+    await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=send, args=(rx_queue, proto))
+    thread.start()
+    await proto.done.wait()
+    duration = time.perf_counter() - start
+    thread.join()
+
+    # Not started, so this only stops the RX loop.
+    await proto.stop()
+    await recv
+
+    latencies = sorted(r - s for s, r in zip(proto.sent, proto.received))
+    print(f'{count} telegrams in {duration:.3f} s: {count / duration:.0f} telegrams/s')
+    print(f'latency mean {statistics.mean(latencies) * 1e6:.0f} us, '
+          f'p50 {latencies[len(latencies) // 2] * 1e6:.0f} us, '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us')
+    rx_queue.close()
+    tx_queue.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
@@ -0,0 +1,132 @@
+'''
+State writes of the Home Assistant component per minute, before and after the UpdateFilter
+
+Before, the component wrote the state of each field whose bytes changed in a telegram. Now, the
+EntityUpdateDispatcher skips values within the hysteresis and throttles updates per field. This
+replays telegrams through Message.parse and counts the writes of both, without Home Assistant.
+Throttled values are written when their interval elapsed, as the dispatcher does.
+
+The synthetic stream is a modulating boiler sending UbaMonitorFast every few seconds, with sensor
+noise on the temperatures and the flame current. A capture file of ems_serio replays real
+traffic instead.
+
+Usage: python3 -m benchmarks.state_writes [--minutes N] [--period S] [--capture FILE]
+                                          [--interval S] [--field-interval FIELD=S]
+                                          [--hysteresis C]
+'''
+
+import argparse
+import heapq
+import math
+import random
+
+from ems_bus import ems_messages, ems_simulator
+from ems_bus.ems_capture import TYPE_PACKET, CaptureFile
+from ems_bus.ems_throttle import PUBLISH, THROTTLED, UpdateFilter
+
+
+def synthetic_stream(minutes, period):
+    ''' Yields (time in s, telegram) of UbaMonitorFast broadcasts '''
+    rng = random.Random(1)
+    for i in range(int(minutes * 60 / period)):
+        now = i * period
+        # The burner modulates with a period of 10 minutes
+        phase = math.sin(2 * math.pi * now / 600)
+        forward = 55 + 5 * phase
+        data = ems_simulator.encode(
+            ems_messages.UbaMonitorFast, forward_temp_set=60,
+            forward_temp=round(forward + rng.gauss(0, 0.15), 1), burner_power_max=100,
+            burner_power=max(0, round(40 + 30 * phase)), fan=True, boiler_pump=True,
+            boiler_temp=round(forward + 1 + rng.gauss(0, 0.15), 1),
+            drinkwater_temp=round(48.5 + rng.gauss(0, 0.1), 1),
+            return_current=round(forward - 12 + rng.gauss(0, 0.15), 1),
+            flame_power=round(8 + rng.gauss(0, 0.3), 1), pressure=1.5,
+            intake_temp=round(18 + rng.gauss(0, 0.1), 1), service_code='-H')
+        yield (now, ems_simulator.telegram(ems_simulator.MASTER_ID, 0x00, 0x18, 0, data))
+
+
+def capture_stream(path):
+    ''' Yields (time in s, telegram) of the packets in a capture file '''
+    with CaptureFile(path) as capture:
+        start = None
+        for timestamp, record_type, data in capture:
+            if record_type != TYPE_PACKET or len(data) < 6:
+                continue
+            if start is None:
+                start = timestamp
+            yield ((timestamp - start) / 1e6, bytes(data))
+
+
+def replay(stream, update_filter):
+    ''' Returns (duration in s, writes before, writes after) '''
+    msg_dict = {obj.Meta.identification: obj for obj in ems_messages.__dict__.values()
+                if isinstance(obj, type) and issubclass(obj, ems_messages.Message)}
+    messages = {}
+    # (due time, key, message, field name, field) of throttled keys, written with the then
+    # current value
+    pending = []
+    pending_keys = set()
+    before = after = 0
+    now = 0
+
+    def publish(key, msg_obj, field_name, field, now):
+        nonlocal after
+        decision = update_filter.check(key, field_name, field, getattr(msg_obj, field_name), now)
+        if decision == PUBLISH:
+            after += 1
+        elif decision == THROTTLED and key not in pending_keys:
+            pending_keys.add(key)
+            heapq.heappush(pending, (update_filter.due(key), key, msg_obj, field_name, field))
+
+    for now, telegram in stream:
+        while pending and pending[0][0] <= now:
+            due, key, msg_obj, field_name, field = heapq.heappop(pending)
+            pending_keys.discard(key)
+            publish(key, msg_obj, field_name, field, due)
+        msg_type = msg_dict.get(telegram[2])
+        if msg_type is None:
+            continue
+        msg_obj = messages.get((telegram[0], telegram[2]))
+        first = msg_obj is None
+        if first:
+            msg_obj = messages[(telegram[0], telegram[2])] = msg_type(telegram[0], None)
+        changed = msg_obj.parse(telegram[4:-1], telegram[3])
+        for field_name, field in msg_obj.get_fields():
+            key = (telegram[0], telegram[2], field_name)
+            if first:
+                # Entity added with its state
+                update_filter.published(key, field_name, getattr(msg_obj, field_name), now)
+            elif field in changed:
+                before += 1
+                publish(key, msg_obj, field_name, field, now)
+    return(now, before, after)
+
+
+def main(args):
+    intervals = dict(item.split('=') for item in args.field_interval)
+    intervals = {name: float(value) for name, value in intervals.items()}
+    for interval, hysteresis, field_intervals in ((0, 0, {}),
+                                                  (args.interval, args.hysteresis, intervals)):
+        stream = capture_stream(args.capture) if args.capture else \
+                 synthetic_stream(args.minutes, args.period)
+        update_filter = UpdateFilter(interval, field_intervals, hysteresis)
+        duration, before, after = replay(stream, update_filter)
+        minutes = max(duration, 1) / 60
+        print(f'interval {interval:4g} s, hysteresis {hysteresis:4g} C: '
+              f'{before / minutes:6.1f} state writes/min before, {after / minutes:6.1f} after '
+              f'{update_filter.stats}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--minutes', type=float, default=60)
+    parser.add_argument('--period', type=float, default=3.0,
+                        help='Time between two UbaMonitorFast telegrams, in s')
+    parser.add_argument('--capture', help='Capture file to replay instead')
+    parser.add_argument('--interval', type=float, default=30.0,
+                        help='Minimum update interval of each field, in s')
+    parser.add_argument('--field-interval', action='append', default=[],
+                        metavar='FIELD=S', help='Minimum update interval of a field')
+    parser.add_argument('--hysteresis', type=float, default=0.5,
+                        help='Hysteresis of the temperatures, in C')
+    main(parser.parse_args())
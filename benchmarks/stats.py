@@ -0,0 +1,44 @@
+'''
+Micro-benchmark of reading the ems_serio statistics
+
+Compares ems_serio.stats(), which builds a dict, with StatsReader.read() on the shared memoryview
+and measures the memory kept per call with tracemalloc, which shows leaked references. The
+driver does not need to run.
+
+Usage: python3 -m benchmarks.stats [count]
+'''
+
+import sys
+import timeit
+import tracemalloc
+
+from ems_bus import ems_serio
+from ems_bus.ems_stats import StatsReader
+
+
+def retained(function, count):
+    ''' Returns the bytes kept per call of function. The first batch of calls is not counted,
+    as its interned names and caches stay allocated once. '''
+    tracemalloc.start()
+    for _ in range(count):
+        function()
+    first, _ = tracemalloc.get_traced_memory()
+    for _ in range(count):
+        function()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return((current - first) / count)
+
+
+def main(count):
+    reader = StatsReader()
+    for name, function in (('ems_serio.stats()', ems_serio.stats),
+                           ('StatsReader.read()', reader.read),
+                           ('StatsReader.as_dict()', reader.as_dict)):
+        duration = timeit.timeit(function, number=count)
+        print(f'{name:22}: {duration / count * 1e6:6.2f} us per call, '
+              f'{retained(function, count):6.1f} bytes kept per call')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,115 @@
+'''
+Benchmark of the write latency while discovery reads flood the TX queue.
+
+A thread simulates the bus driver: it takes the messages from a POSIX message queue in the order
+the driver does and sleeps for their bus time, scaled down by SPEEDUP. Another thread keeps the
+queue full of read requests while writes are sent with Message.field_set_send. The latency of a
+write is the bus time from sending it to the queue until the simulated bus transmitted it. The
+run is done with writes in the high and in the low lane, the latter is the behaviour without
+priorities.
+
+Usage: python3 -m benchmarks.tx_priority [writes]
+'''
+
+import statistics
+import sys
+import threading
+import time
+
+import posix_ipc
+
+from ems_bus import ems_messages, ems_protocol
+from ems_bus.ems_defines import TX_PRIORITY_LOW, TX_PRIORITY_HIGH, EMS_MAX_TELEGRAM_LENGTH
+
+QUEUE_NAME = '/ems_bus_bench_tx'
+# Character time at 9600 baud in s
+CHAR_TIME = 0.00104
+# The simulated bus runs this much faster than the real one
+SPEEDUP = 20
+# Bus time between two polls of our client ID in s
+POLL_INTERVAL = 0.1
+
+
+def bus_time(telegram):
+    ''' Returns the bus time of a telegram including the echo wait and the answer in s '''
+    chars = len(telegram) + 1
+    if telegram[1] & 0x80:
+        # Read request, the answer follows immediately
+        chars += telegram[4] + 5
+    else:
+        # Write ACK
+        chars += 1
+    return(chars * CHAR_TIME)
+
+
+def simulate_bus(queue, stop, sent):
+    ''' Sends one message per poll. The driver may send more, but this keeps the latency
+    readable in poll cycles. '''
+    while not stop.is_set():
+        try:
+            telegram = queue.receive(POLL_INTERVAL / SPEEDUP)[0]
+        except posix_ipc.BusyError:
+            continue
+        time.sleep((bus_time(telegram) + POLL_INTERVAL) / SPEEDUP)
+        if not telegram[1] & 0x80:
+            sent[telegram[4]] = time.perf_counter()
+
+
+def flood(proto, stop):
+    ''' Keeps the queue full of read requests as the device discovery does '''
+    data = bytearray(6)
+    data[0] = proto.client_id
+    data[1] = 0x08 | 0x80
+    data[2] = ems_messages.VersionMessage.Meta.identification
+    data[4] = EMS_MAX_TELEGRAM_LENGTH
+    queue = proto._tx_queue
+    while not stop.is_set():
+        # Leave one place for the write, so it is not blocked by a full queue.
+        if queue.current_messages < queue.max_messages - 1:
+            proto.send(data, TX_PRIORITY_LOW)
+        else:
+            time.sleep(0.001)
+
+
+def run(writes, priority):
+    queue = posix_ipc.MessageQueue(QUEUE_NAME, posix_ipc.O_CREAT, 0o600, 10, 32)
+    queue.unlink()
+    queue.block = True
+    proto = ems_protocol.EmsProtocol(None, 0, 0x0b)
+    proto._tx_queue = queue
+    message = ems_messages.UbaSettings(0x08, proto)
+    stop = threading.Event()
+    sent = [0.0] * writes
+    queued = [0.0] * writes
+    bus = threading.Thread(target=simulate_bus, args=(queue, stop, sent))
+    flooder = threading.Thread(target=flood, args=(proto, stop))
+    bus.start()
+    flooder.start()
+    # Let the queue fill up
+    time.sleep(20 * POLL_INTERVAL / SPEEDUP)
+
+    for i in range(writes):
+        queued[i] = time.perf_counter()
+        # The value is used to identify the write in the simulated bus
+        message.field_set_send('boiler_max', i, priority)
+        while not sent[i]:
+            time.sleep(0.001)
+
+    stop.set()
+    flooder.join()
+    bus.join()
+    queue.close()
+    return(sorted((s - q) * SPEEDUP for q, s in zip(queued, sent)))
+
+
+def main(writes):
+    for name, priority in (('high', TX_PRIORITY_HIGH), ('low', TX_PRIORITY_LOW)):
+        latencies = run(writes, priority)
+        print(f'{writes} writes in {name} lane: bus latency mean '
+              f'{statistics.mean(latencies) * 1000:.0f} ms, '
+              f'p50 {latencies[len(latencies) // 2] * 1000:.0f} ms, '
+              f'max {latencies[-1] * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,114 @@
+'''
+Benchmark of the time from the start of EmsProtocol to the first values, without and with the
+device cache
+
+Runs the bus simulator at 9600 baud with a boiler and a thermostat answering all initial requests.
+The cold start waits for the device list broadcast of the master, reads the versions and then the
+initial requests, one telegram per poll. The warm start restores the devices and values of the
+snapshot written by the cold start and confirms them in the background. Reports the time to the
+first value, to the values of all initial requests and to the last read request answered.
+
+The master broadcasts the device list every --broadcast-interval polls. The protocol is started
+--phase polls after a broadcast, the cold start waits for the next one.
+
+Usage: python3 -m benchmarks.warm_start [--poll-interval S] [--broadcast-interval N]
+                                        [--phase N] [--timeout S]
+'''
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from ems_bus import ems_protocol, ems_simulator
+from ems_bus.ems_devices import EMS_DEVICE_TYPE_BOILER, EMS_DEVICE_TYPE_THERMOSTAT, \
+                                EMS_INITIAL_REQUESTS
+
+# Time without a read request answered until the start is considered complete, in s
+IDLE_TIME = 1.0
+DEVICES = ((ems_simulator.MASTER_ID, EMS_DEVICE_TYPE_BOILER),
+           (ems_simulator.THERMOSTAT_ID, EMS_DEVICE_TYPE_THERMOSTAT))
+
+
+def devices():
+    ''' Returns the simulated devices, answering all initial requests '''
+    data = ems_simulator.default_devices()
+    for address, device_type in DEVICES:
+        for msg_type in EMS_INITIAL_REQUESTS[device_type]:
+            data[address].setdefault(msg_type.Meta.identification, ems_simulator.encode(msg_type))
+    return(data)
+
+
+async def run(args, simulator, cache):
+    ''' Returns the times of the first value, all initial values and the last read answered '''
+    expected = {(address, msg_type.Meta.identification) for address, device_type in DEVICES
+                for msg_type in EMS_INITIAL_REQUESTS[device_type]}
+    seen = set()
+    first = complete = None
+
+    async def event_handler(signal, device, message, updated_fields):
+        nonlocal first, complete
+        if signal != ems_protocol.EVENT_UPDATE or not updated_fields:
+            return
+        now = time.monotonic() - start
+        if first is None:
+            first = now
+        seen.add((device.address, message.Meta.identification))
+        if complete is None and expected <= seen:
+            complete = now
+
+    # Start the given number of polls after a broadcast
+    broadcasts = simulator.stats['broadcasts']
+    while simulator.stats['broadcasts'] == broadcasts:
+        await asyncio.sleep(0.01)
+    polls = simulator.stats['polls']
+    while simulator.stats['polls'] - polls < args.phase:
+        await asyncio.sleep(0.01)
+    proto = ems_protocol.EmsProtocol(simulator.path, 0, ems_simulator.CLIENT_ID, event_handler,
+                                     cache=cache)
+    reads = simulator.stats['reads']
+    start = time.monotonic()
+    last_read = start
+    if await proto.start() is None:
+        return(None)
+    while time.monotonic() - start < args.timeout and (
+            complete is None or time.monotonic() - last_read < IDLE_TIME):
+        if simulator.stats['reads'] != reads:
+            reads = simulator.stats['reads']
+            last_read = time.monotonic()
+        await asyncio.sleep(0.01)
+    await proto.stop()
+    return(first, complete, last_read - start)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        cache = os.path.join(directory, 'ems_bus_cache.json')
+        for name in ('cold', 'warm'):
+            simulator = ems_simulator.BusSimulator(
+                devices=devices(), poll_interval=args.poll_interval,
+                broadcast_interval=args.broadcast_interval, realtime=True)
+            simulator.start()
+            try:
+                times = asyncio.run(run(args, simulator, cache))
+            finally:
+                simulator.close()
+            if times is None or None in times:
+                print(f'{name}: incomplete {times}')
+                continue
+            first, complete, last_read = times
+            print(f'{name}: first value after {first:6.3f} s, all initial values after '
+                  f'{complete:6.3f} s, last read answered after {last_read:6.3f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--poll-interval', type=float, default=0.05,
+                        help='Time between two polls of the client, in s')
+    parser.add_argument('--broadcast-interval', type=int, default=200,
+                        help='Polls between two device list broadcasts')
+    parser.add_argument('--phase', type=int, default=100,
+                        help='Polls from a broadcast to the start of the protocol')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    main(parser.parse_args())
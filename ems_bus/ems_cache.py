@@ -0,0 +1,111 @@
+'''
+Snapshot of the devices and messages known to EmsProtocol, for a warm start
+
+Without a snapshot, EmsProtocol waits for the device list of the boiler, reads the version of
+each device and then its EMS_INITIAL_REQUESTS, one telegram per poll. With cache=path, it
+restores the devices, their product IDs and the raw data of their messages from the snapshot at
+start, so the event handler sees the values immediately. The versions and the initial requests
+are read again in the background, which confirms the snapshot or replaces its values.
+
+The snapshot is a JSON file:
+
+    {"version": 1, "online_devices": "hex",
+     "devices": {"8": {"product_id": 123, "messages": {"24": "hex", ...}}, ...}}
+
+It is written to a temporary file which replaces the snapshot, so a crash leaves the old or the
+new snapshot, never a partial one.
+
+Usage: python3 -m ems_bus.ems_cache cache_file
+    Prints the devices and message values of a snapshot
+'''
+
+import json
+import logging
+import os
+import sys
+
+from ems_bus import ems_messages
+from ems_bus.ems_devices import EMS_DEVICES
+
+LOGGER = logging.getLogger(__name__)
+
+VERSION = 1
+# Interval of writing the snapshot while the protocol runs, in s
+DEFAULT_INTERVAL = 300
+
+
+def snapshot(online_devices, known_devices):
+    ''' Returns the snapshot of the online device list and the known devices as JSON text '''
+    devices = {}
+    for address, device in known_devices.items():
+        if device.product is None:
+            continue
+        devices[str(address)] = {
+            'product_id': device.product[0],
+            'messages': {str(msgtype): msg_obj.message.hex()
+                         for msgtype, msg_obj in device.messages.items()},
+        }
+    return(json.dumps({'version': VERSION, 'online_devices': online_devices.hex(),
+                       'devices': devices}, sort_keys=True))
+
+
+def write(path, text):
+    ''' Writes the snapshot text atomically '''
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as cache:
+        cache.write(text)
+        cache.flush()
+        os.fsync(cache.fileno())
+    os.replace(temp_path, path)
+
+
+def read(path):
+    ''' Returns (online device list, {address: (product ID, {message type: data})}) of a
+    snapshot, or None if there is none or it is invalid '''
+    try:
+        with open(path) as cache:
+            data = json.load(cache)
+        if data.get('version') != VERSION:
+            LOGGER.warning('Ignoring the device cache %s of version %s', path,
+                           data.get('version'))
+            return(None)
+        devices = {int(address): (device['product_id'],
+                                  {int(msgtype): bytes.fromhex(message)
+                                   for msgtype, message in device['messages'].items()})
+                   for address, device in data['devices'].items()}
+        return(bytes.fromhex(data['online_devices']), devices)
+    except FileNotFoundError:
+        return(None)
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        LOGGER.warning('Ignoring the invalid device cache %s: %s', path, e)
+        return(None)
+
+
+def main(path):
+    cache = read(path)
+    if cache is None:
+        print(f'{path} is no device cache')
+        return
+    online_devices, devices = cache
+    print(f'Online devices: {online_devices.hex()}')
+    msg_dict = {obj.Meta.identification: obj for obj in ems_messages.__dict__.values()
+                if isinstance(obj, type) and issubclass(obj, ems_messages.Message)}
+    for address, (product_id, messages) in sorted(devices.items()):
+        product = next((i for i in EMS_DEVICES if i[0] == product_id), None)
+        print(f'0x{address:02x}: product ID {product_id}, {product[2] if product else "unknown"}')
+        for msgtype, message in sorted(messages.items()):
+            message_type = msg_dict.get(msgtype)
+            if message_type is None:
+                continue
+            msg_obj = message_type(address, None)
+            msg_obj.parse(message, 0)
+            print(f'  {message_type.__name__}:')
+            for (field_name, _), value in zip(msg_obj.get_fields(), msg_obj.values):
+                print(f'    {field_name}: {value}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1])
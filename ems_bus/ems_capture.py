@@ -0,0 +1,147 @@
+'''
+Reading and replaying capture files of ems_serio
+
+ems_serio.capture(path) records the packets forwarded to the RX queue, and with mac=True also the
+bus tokens, to an append-only file. The file starts with a header, followed by records of a fixed
+header and the packet data. The format is defined in ems_serio/capture.h.
+
+Usage: python3 -m ems_bus.ems_capture capture_file [speed]
+    speed is the replay speed, 1 for real time, 0 for as fast as possible (default)
+'''
+
+import asyncio
+import logging
+import mmap
+import struct
+import sys
+import time
+from bisect import bisect_left
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'EMSCAP\x00\x00'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sHH4x')
+RECORD_HEADER = struct.Struct('<QBB6x')
+TYPE_PACKET = 0
+TYPE_MAC = 1
+
+
+class CaptureFile:
+    ''' Memory mapped capture file. Iterating yields (time in us, type, data) of each record. '''
+    def __init__(self, path):
+        with open(path, 'rb') as capture:
+            self._map = mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_header_size = FILE_HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or record_header_size != RECORD_HEADER.size:
+            self._map.close()
+            raise(ValueError(f'{path} is no capture file of version {VERSION}'))
+        self._offsets = None
+        self._times = None
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __iter__(self):
+        return(self.records())
+
+    def records(self, start=0):
+        ''' Yields the records from the record number start '''
+        if start:
+            self.index()
+            if start >= len(self._offsets):
+                return
+            pos = self._offsets[start]
+        else:
+            pos = FILE_HEADER.size
+        data = self._map
+        end = len(data) - RECORD_HEADER.size
+        unpack_from = RECORD_HEADER.unpack_from
+        while pos <= end:
+            timestamp, length, record_type = unpack_from(data, pos)
+            pos += RECORD_HEADER.size
+            if pos + length > len(data):
+                # Incomplete record at the end
+                return
+            yield(timestamp, record_type, data[pos:pos + length])
+            pos += length
+
+    def index(self):
+        ''' Builds the index of the record offsets and times. Returns the number of records. '''
+        if self._offsets is None:
+            offsets = []
+            times = []
+            pos = FILE_HEADER.size
+            data = self._map
+            end = len(data) - RECORD_HEADER.size
+            unpack_from = RECORD_HEADER.unpack_from
+            while pos <= end:
+                timestamp, length, _ = unpack_from(data, pos)
+                if pos + RECORD_HEADER.size + length > len(data):
+                    break
+                offsets.append(pos)
+                times.append(timestamp)
+                pos += RECORD_HEADER.size + length
+            self._offsets = offsets
+            self._times = times
+        return(len(self._offsets))
+
+    def find(self, timestamp):
+        ''' Returns the number of the first record at or after timestamp in us since the epoch.
+        Records are in time order as the file is only appended. '''
+        self.index()
+        return(bisect_left(self._times, timestamp))
+
+
+async def replay(proto, path, speed=0, start=0):
+    ''' Replays the packets of a capture file into an EmsProtocol, as recv() would pass them.
+    speed 1 keeps the original timing, 10 is ten times faster, 0 as fast as possible.
+    Returns the number of replayed packets. '''
+    count = 0
+    first = None
+    begin = time.monotonic()
+    with CaptureFile(path) as capture:
+        for timestamp, record_type, data in capture.records(start):
+            if record_type != TYPE_PACKET:
+                continue
+            if speed:
+                if first is None:
+                    first = timestamp
+                delay = begin + (timestamp - first) / 1e6 / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if proto._rx_filter(data):
+                await proto.parse_message(data)
+            count += 1
+    return(count)
+
+
+async def main(path, speed):
+    # Imported here, so reading captures does not need the compiled ems_serio module
+    from ems_bus import ems_protocol
+
+    async def callback(msg_type, device, message, updated_fields):
+        for field in updated_fields:
+            LOGGER.info('0x%02x 0x%02x %s', device.address, message.Meta.identification,
+                        field.format(getattr(message, field.attr)))
+
+    logging.basicConfig(level=logging.INFO)
+    proto = ems_protocol.EmsProtocol(None, 0, 0x0b, callback)
+    # Replies to the requests of the protocol are in the capture, the requests are not sent.
+    async def read_request(*_, **__):
+        pass
+    proto.read_request = read_request
+    start = time.monotonic()
+    count = await replay(proto, path, speed)
+    duration = time.monotonic() - start
+    print(f'{count} packets in {duration:.3f} s: {count / duration:.0f} packets/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 0))
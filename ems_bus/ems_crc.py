@@ -0,0 +1,26 @@
+'''
+CRC of EMS telegrams, the same as calc_crc() in ems_serio/crc.c
+'''
+
+
+def _table():
+    table = bytearray(256)
+    for crc in range(256):
+        table[crc] = ((crc << 1) & 0xff) ^ (0x19 if crc & 0x80 else 0)
+    return(bytes(table))
+
+CRC_TABLE = _table()
+
+
+def calc_crc(data):
+    ''' Returns the CRC of a telegram. The last byte, the CRC itself, is not included. '''
+    crc = 0
+    table = CRC_TABLE
+    for byte in data[:-1]:
+        crc = table[crc] ^ byte
+    return(crc)
+
+
+def check_crc(data):
+    ''' Returns True if the last byte of the telegram is its CRC '''
+    return(calc_crc(data) == data[-1])
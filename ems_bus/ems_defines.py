@@ -5,6 +5,10 @@ Definitions for the EMS bus
 EMS_MIN_TELEGRAM_LENGTH = 6
 EMS_MAX_TELEGRAM_LENGTH = 32
 
+# TX queue priorities. The bus driver sends the messages with the highest priority first.
+TX_PRIORITY_LOW = 0  # Discovery and periodic reads
+TX_PRIORITY_HIGH = 1 # Writes and user actions
+
 # Bus message types
 EMS_TYPE_UBA_MONITOR_FAST = 0x18       # is an automatic monitor broadcast
 EMS_TYPE_UBA_MONITOR_SLOW = 0x19       # is an automatic monitor broadcast
@@ -28,6 +28,18 @@ EMS_INITIAL_REQUESTS = {
         UbaDrinkwaterMonitorMessage),
     EMS_DEVICE_TYPE_THERMOSTAT: (Hc1ParamMessage, Hc1MonitorMessage, HcDrinkwaterParam),
 }
+# Intervals of reading the initial requests again, in s. A read is skipped while the message is
+# broadcast more often. See ems_scheduler.py.
+EMS_REFRESH_INTERVALS = {
+    UbaMonitorFast: 60,
+    UbaMonitorSlow: 300,
+    UbaSetValuesMessage: 600,
+    UbaDrinkwaterParameterMessage: 600,
+    UbaDrinkwaterMonitorMessage: 120,
+    Hc1ParamMessage: 600,
+    Hc1MonitorMessage: 120,
+    HcDrinkwaterParam: 600,
+}
 
 EMS_DEVICE_FLAG_NONE = 0
 EMS_DEVICE_FLAG_SM10 = 10  # solar module1
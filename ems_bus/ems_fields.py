@@ -2,6 +2,7 @@
 Message field definitions for the EMS bus
 '''
 
+import struct
 from datetime import datetime, date
 
 from ems_bus.ems_units import UnitDate, UnitDateTime
@@ -12,10 +13,13 @@ LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
 
 class Field():
-    ''' Field abstract class '''
+    ''' Field abstract class
+
+    A field is a definition shared by all instances of a message class. The values are stored
+    in the message instances. Reading the field attribute of a message returns its value. '''
+    __slots__ = ('pos', 'length', 'name', 'unit', 'attr')
     MIN_LENGTH = 1
     MAX_LENGTH = 4
-    value = None
 
     def __init__(self, pos, length, name, unit=None):
         if length < self.MIN_LENGTH or length > self.MAX_LENGTH:
@@ -24,24 +28,37 @@ class Field():
         self.length = length
         self.name = name
         self.unit = unit
+        # Attribute name in the message class. Set when the message class is created.
+        self.attr = None
+
+    def __get__(self, msg_obj, _=None):
+        if msg_obj is None:
+            return(self)
+        return(msg_obj.values[msg_obj._index[self.attr]])
 
-    def __str__(self):
+    def format(self, value):
+        ''' Returns a printable line of the field with the value '''
         if self.unit is None:
-            val = str(self.value)
+            val = str(value)
         else:
-            val = str(self.unit(self.value))
+            val = str(self.unit(value))
         return(f'{self.name:40}: {val}')
 
-    def update(self, value):
-        ''' Update the value '''
-        self.value = value
-
-    def to_bytes(self, _):
+    def to_bytes(self, value, _):
         ''' Returns a bytes object of this field '''
         raise(Exception('Must be overridden'))
 
-    def has_changed(self, update, offset, message):
-        if self.value is None:
+    def decode(self, update):
+        ''' Returns the value of this field in the message data '''
+        raise(Exception('Must be overridden'))
+
+    def unpacker(self):
+        ''' Returns the struct format of this field and a Python expression converting the
+        unpacked items {0}, {1}, ... to the value. None if struct cannot unpack the field. '''
+        return(None)
+
+    def has_changed(self, update, offset, message, value):
+        if value is None:
             return(True)
         # Start and end of the field in the update
         update_start = self.pos - offset
@@ -53,73 +70,89 @@ class Field():
 
 class DateField(Field):
     ''' Date field '''
+    __slots__ = ()
     MIN_LENGTH = 3
     MAX_LENGTH = 3
 
     def __init__(self, pos, length, name):
         super().__init__(pos, length, name, UnitDate)
 
-    def parse(self, update):
+    def decode(self, update):
         data = update[self.pos:self.pos + self.length]
-        self.value = date(data[2] + 2000, data[1], data[0])
+        return(date(data[2] + 2000, data[1], data[0]))
 
-    def to_bytes(self, _):
+    def to_bytes(self, value, _):
         data = bytearray(self.length)
-        data[0] = self.value.day
-        data[1] = self.value.month
-        data[2] = self.value.year - 2000
+        data[0] = value.day
+        data[1] = value.month
+        data[2] = value.year - 2000
         return(data)
 
 
 class DateTimeField(Field):
     ''' Date and time field '''
+    __slots__ = ()
     MIN_LENGTH = 5
     MAX_LENGTH = 6
 
     def __init__(self, pos, length, name):
         super().__init__(pos, length, name, UnitDateTime)
 
-    def parse(self, update):
+    def decode(self, update):
         data = update[self.pos:self.pos + self.length]
         tzinfo = datetime.now().astimezone().tzinfo
         second = data[5] if self.length == 6 else 0
         # Todo: Understand what bit 7 of year means. Source:
         # https://emswiki.thefischer.net/doku.php?id=wiki:ems:telegramme#ubaerrormessages1
-        self.value = \
-            datetime((data[0] & 0x7F) + 2000, data[1], data[3], data[2], data[4], second, 0, tzinfo)
+        return(datetime((data[0] & 0x7F) + 2000, data[1], data[3], data[2], data[4], second, 0,
+                        tzinfo))
 
-    def to_bytes(self, _):
+    def to_bytes(self, value, _):
         data = bytearray(self.length)
-        data[0] = self.value.year - 2000
-        data[1] = self.value.month
-        data[2] = self.value.hour
-        data[3] = self.value.day
-        data[4] = self.value.minute
+        data[0] = value.year - 2000
+        data[1] = value.month
+        data[2] = value.hour
+        data[3] = value.day
+        data[4] = value.minute
         if self.length == 6:
-            data[5] = self.value.second
+            data[5] = value.second
         return(data)
 
 
 class IntegerField(Field):
     ''' Integer field '''
+    __slots__ = ('factor', 'signed')
     def __init__(self, pos, length, name, unit=None, factor=None, signed=False):
         super().__init__(pos, length, name, unit)
         self.factor = factor
         self.signed = signed
 
-    def parse(self, update):
-        self.value = \
-            int.from_bytes(update[self.pos:self.pos + self.length], 'big', signed=self.signed)
+    def decode(self, update):
+        value = int.from_bytes(update[self.pos:self.pos + self.length], 'big', signed=self.signed)
         if self.factor is not None:
-            self.value /= self.factor
+            value /= self.factor
+        return(value)
 
-    def to_bytes(self, _):
+    def unpacker(self):
+        if self.length == 3:
+            if self.signed:
+                return(None)
+            fmt, expr = 'BH', '({0} << 16 | {1})'
+        else:
+            fmt = {1: 'B', 2: 'H', 4: 'I'}[self.length]
+            fmt, expr = fmt.lower() if self.signed else fmt, '{0}'
+        if self.factor is not None:
+            expr += f' / {self.factor!r}'
+        return(fmt, expr)
+
+    def to_bytes(self, value, _):
         factor = 1 if self.factor is None else self.factor
-        return(int(self.value * factor).to_bytes(self.length, 'big', signed=self.signed))
+        return(int(value * factor).to_bytes(self.length, 'big', signed=self.signed))
 
 
 class BooleanField(Field):
     ''' Boolean field '''
+    __slots__ = ('bit',)
     MAX_LENGTH = 1
 
     def __init__(self, pos, length, name, unit=None, bit=None):
@@ -128,58 +161,111 @@ class BooleanField(Field):
             raise(ValueError('{}: Bit must be specied'.format(__name__)))
         self.bit = bit
 
-    def parse(self, update):
-        self.value = bool(update[self.pos] & (1 << self.bit))
+    def decode(self, update):
+        return(bool(update[self.pos] & (1 << self.bit)))
+
+    def unpacker(self):
+        return('B', f'bool({{0}} & {1 << self.bit})')
 
-    def has_changed(self, update, offset, message):
-        if self.value is None:
+    def has_changed(self, update, offset, message, value):
+        if value is None:
             return(True)
         mask = 1 << self.bit
         return(update[self.pos - offset] & mask != message[self.pos] & mask)
 
-    def to_bytes(self, msg_obj):
+    def to_bytes(self, value, msg_obj):
         # We need to set the bits of other booleans on the same byte, not touching undefined bits.
-        value = msg_obj[self.pos]
-        for field in dir(self):
-            f_obj = getattr(self, field)
-            if not issubclass(f_obj.__class__, Field) or f_obj.pos != self.pos:
+        byte = self.modify_byte(msg_obj.message[self.pos], value)
+        for _, f_obj in msg_obj.get_fields():
+            if f_obj.pos != self.pos or f_obj is self:
                 continue
             # Overlapping fields MUST be boolean
             if not issubclass(f_obj.__class__, BooleanField):
                 raise(Exception('Overlapping fields must be boolean'))
-            value = f_obj.modify_byte(value)
-        return(value.to_bytes(1, 'big', signed=False))
+            f_value = f_obj.__get__(msg_obj)
+            if f_value is not None:
+                byte = f_obj.modify_byte(byte, f_value)
+        return(byte.to_bytes(1, 'big', signed=False))
 
-    def modify_byte(self, value):
+    def modify_byte(self, byte, value):
         ''' Sets the value in the bit of a byte '''
-        return((value & ~(1 << self.bit)) | (int(self.value) << self.bit))
+        return((byte & ~(1 << self.bit)) | (int(value) << self.bit))
 
 
 class BooleanIntegerField(Field):
+    __slots__ = ('onvalue',)
     MAX_LENGTH = 1
 
     def __init__(self, pos, length, name, unit=None, onvalue=0xff, **kw):
         super().__init__(pos, length, name, unit)
         self.onvalue = onvalue
 
-    def parse(self, update):
-        self.value = update[self.pos] == self.onvalue
+    def decode(self, update):
+        return(update[self.pos] == self.onvalue)
+
+    def unpacker(self):
+        return('B', f'{{0}} == {self.onvalue!r}')
 
-    def to_bytes(self, _):
-        value = self.onvalue if self.value else 0x00
+    def to_bytes(self, value, _):
+        value = self.onvalue if value else 0x00
         return(value.to_bytes(1, 'big', signed=False))
 
 
 class StringField(Field):
     '''' String field '''
+    __slots__ = ()
     MAX_LENGTH = 8
     ENCODING = 'ISO8859-15' # Is assumed
 
-    def parse(self, update):
-        self.value = update[self.pos:self.pos + self.length].decode(self.ENCODING)
+    def decode(self, update):
+        return(update[self.pos:self.pos + self.length].decode(self.ENCODING))
 
-    def to_bytes(self, _):
-        value = self.value.encode(self.ENCODING)
+    def unpacker(self):
+        return(f'{self.length}s', f'{{0}}.decode({self.ENCODING!r})')
+
+    def to_bytes(self, value, _):
+        value = value.encode(self.ENCODING)
         if len(value) != self.length:
             return(None)
         return(value)
+
+
+class Decoder:
+    ''' Decodes all fields of a message with a single struct.unpack_from call.
+
+    The decode function is generated from the field definitions. Fields which struct cannot
+    unpack, or which overlap another field with a different format, are not decoded. They are
+    marked False in bulk and must be parsed by the field itself. '''
+    def __init__(self, fields):
+        formats = []
+        items = 0
+        end = 0
+        unpacked = {}
+        exprs = ['None'] * len(fields)
+        for index, field in sorted(enumerate(fields), key=lambda item: item[1].pos):
+            unpacker = field.unpacker()
+            if unpacker is None:
+                continue
+            fmt, expr = unpacker
+            key = (field.pos, fmt)
+            if key not in unpacked:
+                if field.pos < end:
+                    continue
+                if field.pos > end:
+                    formats.append(f'{field.pos - end}x')
+                count = len(struct.unpack('>' + fmt, bytes(field.length)))
+                unpacked[key] = [f'r{items + i}' for i in range(count)]
+                items += count
+                formats.append(fmt)
+                end = field.pos + field.length
+            exprs[index] = expr.format(*unpacked[key])
+
+        self.bulk = tuple(expr != 'None' for expr in exprs)
+        self.struct = struct.Struct('>' + ''.join(formats))
+        code = 'def decode(data):\n'
+        if items:
+            code += f'    {"".join(f"r{i}, " for i in range(items))}= unpack_from(data)\n'
+        code += f'    return(({"".join(expr + ", " for expr in exprs)}))\n'
+        namespace = {'unpack_from': self.struct.unpack_from}
+        exec(code, namespace)
+        self.decode = namespace['decode']
@@ -3,6 +3,7 @@ Message definitions for the EMS bus
 '''
 
 import logging
+from bisect import bisect_left
 
 from ems_bus.ems_units import \
     UnitMinute, UnitYesNo, UnitOpenClosed, UnitOnOff, UnitCelsius, UnitPercent, UnitMicroAmpere, \
@@ -10,28 +11,62 @@ from ems_bus.ems_units import \
     UnitHcInstallation, UnitHcWorkMode, UnitHcRemote, UnitHcOperation, UnitUbaMsTimestamp, \
     UnitHour, UnitWeekDay, UnitUbaMmNeed, UnitUbaFtValve, UnitHwDcProgram, UnitOffOnAuto
 from ems_bus.ems_fields import Field, DateTimeField, IntegerField, BooleanField, StringField, \
-                        BooleanIntegerField, DateField
+                        BooleanIntegerField, DateField, Decoder
+from ems_bus.ems_defines import TX_PRIORITY_HIGH
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
 
-class Message:
-    message = None
+class MessageType(type):
+    '''Metaclass of the messages. Messages only store their slots, no instance dictionary.'''
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        namespace.setdefault('__slots__', ())
+        return(super().__new__(mcs, name, bases, namespace, **kwargs))
+
+
+class Message(metaclass=MessageType):
+    __slots__ = ('device_id', 'proto', 'message', 'values')
+    # Fields of the message sorted by position, compiled when the class is created.
+    _layout = ()
+    # Position of each field in _layout, for finding the fields of an update.
+    _positions = ()
+    # Index of each field name in _layout and values
+    _index = {}
+    # Decoder of all fields in _layout
+    _decoder = None
 
     def __init__(self, dev_id, proto):
         self.device_id = dev_id
         self.proto = proto
         self.message = bytearray(self.Meta.length)
+        # Values of the fields, in the order of _layout
+        self.values = [None] * len(self._layout)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.compile()
+
+    @classmethod
+    def compile(cls):
+        '''Compiles the field layout of the message. Call again after adding fields.'''
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for name, obj in vars(klass).items():
+                if isinstance(obj, Field):
+                    fields[name] = obj
+        for name, field in fields.items():
+            field.attr = name
+        cls._layout = tuple(sorted(fields.items(), key=lambda item: item[1].pos))
+        cls._positions = tuple(field.pos for _, field in cls._layout)
+        cls._index = {name: index for index, (name, _) in enumerate(cls._layout)}
+        cls._decoder = Decoder([field for _, field in cls._layout])
 
     class Meta:
         identification = 0x00
         length = 0
 
     def get_fields(self):
-        for field_name in dir(self):
-            field_obj = getattr(self, field_name)
-            if issubclass(field_obj.__class__, Field):
-                yield (field_name, field_obj)
+        return(self._layout)
 
     def parse(self, update, offset):
         if offset < 0:
@@ -44,34 +79,45 @@ class Message:
 
         # Check what fields have changed, merge data and mark updated fields.
         changed_fields = []
+        changed_index = []
         update_end = offset + len(update)
-        for field_name, field in self.get_fields():
-            if field.pos < offset or field.pos >= update_end:
-                continue
+        first = bisect_left(self._positions, offset)
+        last = bisect_left(self._positions, update_end, first)
+        for index in range(first, last):
+            field_name, field = self._layout[index]
             # Check field in range
             field_end = field.pos + field.length
             if field_end > update_end:
                 LOGGER.error('Update message 0x%02d range [%d-%d] not covering whole field %s',
                              self.Meta.identification, offset, update_end, field_name)
                 continue
-            if field.has_changed(update, offset, self.message) and field not in changed_fields:
+            if field.has_changed(update, offset, self.message, self.values[index]) and \
+               field not in changed_fields:
                 changed_fields.append(field)
+                changed_index.append(index)
 
         # Merge data
         self.message[offset:update_end] = update
 
         # Update marked fields after data was merged.
-        for field in changed_fields:
-            field.parse(self.message)
+        if changed_index:
+            values = self._decoder.decode(self.message)
+            bulk = self._decoder.bulk
+            for index in changed_index:
+                if bulk[index]:
+                    self.values[index] = values[index]
+                else:
+                    self.values[index] = self._layout[index][1].decode(self.message)
 
         return(changed_fields)
 
 
-    def field_set_send(self, field, value):
+    def field_set_send(self, field, value, priority=TX_PRIORITY_HIGH):
         ''' Update a field and send the update to the device '''
-        field_obj = getattr(self, field)
-        field_obj.update(value)
-        update_data = field_obj.to_bytes(self)
+        index = self._index[field]
+        field_obj = self._layout[index][1]
+        self.values[index] = value
+        update_data = field_obj.to_bytes(value, self)
         data = bytearray(5 + len(update_data)) # 1 byte per src, dst, type, offset, crc
         data[0] = self.proto.client_id
         data[1] = self.device_id
@@ -79,14 +125,12 @@ class Message:
         data[3] = field_obj.pos
         data[4:4 + field_obj.length] = update_data
         #self.proto.bus.send(data)
-        self.proto._tx_queue.send(data)
+        self.proto.send(data, priority)
 
     def dump(self):
         ''' Print the values of the message to the logger '''
-        for field in dir(self):
-            field_obj = getattr(self, field)
-            if issubclass(field_obj.__class__, Field):
-                LOGGER.debug(str(field_obj))
+        for (_, field_obj), value in zip(self._layout, self.values):
+            LOGGER.debug(field_obj.format(value))
 
 
 
@@ -113,16 +157,45 @@ class RCTimeMessage(Message):
     enabled = BooleanField(7, 1, 'Clock enabled', None, 4)
 
 class UbaDevicesMessage(Message):
+    '''Bitmap of the online devices. Bit n of the first 8 bytes is bus address 8 + n.'''
     class Meta:
         identification = 0x07
         length = 13
-    def __init__(self, dev_id, proto, *args, **kwargs):
-        super().__init__(dev_id, proto, *args, **kwargs)
-        for num_byte in range(8):
-            for num_bit in range(8):
-                num_str = '{:02d}'.format((num_byte + 1) * 8 + num_bit)
-                setattr(self, 'device_' + num_str,
-                        BooleanField(num_byte, 1, 'Device ' + num_str, UnitDevice, num_bit))
+
+    FIRST_ADDRESS = 0x08
+    BITMAP_LENGTH = 8
+
+    def is_online(self, address):
+        '''Returns if the device with the bus address is online'''
+        num_byte, num_bit = divmod(address - self.FIRST_ADDRESS, 8)
+        return(bool(self.message[num_byte] & (1 << num_bit)))
+
+    @classmethod
+    def diff(cls, old, new):
+        '''Returns the lists of bus addresses which came online and went offline between two
+        device bitmaps'''
+        old = int.from_bytes(old[:cls.BITMAP_LENGTH], 'little')
+        new = int.from_bytes(new[:cls.BITMAP_LENGTH], 'little')
+        changed = old ^ new
+        added = []
+        removed = []
+        while changed:
+            bit = changed & -changed
+            address = cls.FIRST_ADDRESS + bit.bit_length() - 1
+            if new & bit:
+                added.append(address)
+            else:
+                removed.append(address)
+            changed ^= bit
+        return(added, removed)
+# One field per bus address, device_08 to device_71
+for num_byte in range(UbaDevicesMessage.BITMAP_LENGTH):
+    for num_bit in range(8):
+        num_str = '{:02d}'.format((num_byte + 1) * 8 + num_bit)
+        setattr(UbaDevicesMessage, 'device_' + num_str,
+                BooleanField(num_byte, 1, 'Device ' + num_str, UnitDevice, num_bit))
+del(num_byte, num_bit, num_str)
+UbaDevicesMessage.compile()
 
 
 class ErrorMessage(Message):
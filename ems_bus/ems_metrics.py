@@ -0,0 +1,249 @@
+'''
+Prometheus metrics of the bus driver and EmsProtocol
+
+MetricsExporter serves the counters of ems_serio and, with an EmsProtocol created with
+metrics=True, the protocol metrics in the Prometheus text format on http://host:port/metrics.
+The server runs in the event loop of the protocol, so the metrics are read without locking.
+
+Usage: python3 -m ems_bus.ems_metrics [--port PORT] [--host HOST] serial_path
+    Runs the bus driver and EmsProtocol and exports their metrics. Do not run this while another
+    process uses the bus driver, for example Home Assistant. Use its metrics_port option then.
+'''
+
+import argparse
+import asyncio
+import contextvars
+import logging
+import time
+from bisect import bisect_left
+
+from ems_bus import ems_serio
+from ems_bus.ems_stats import HISTOGRAM_BASES, StatsReader
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PORT = 9489
+# Bucket bounds in s
+PARSE_BUCKETS = (25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3)
+HANDLER_BUCKETS = (100e-6, 250e-6, 1e-3, 2.5e-3, 10e-3, 25e-3, 100e-3, 250e-3, 1.0)
+# ems_serio statistics which are no counters
+SERIO_GAUGES = {'rx_queue_len', 'rx_queue_max', 'tx_queue_len', 'tx_queue_max',
+                'tx_bus_time_max', 'tx_poll_max', 'tx_drain_time', 'tx_drain_time_max',
+                'poll_reply_max'}
+PROTOCOL_GAUGES = {'batch_max', 'refresh_outstanding'}
+
+# Time spent in the event handler by the telegram parsed in the current task, in s
+_handler_time = contextvars.ContextVar('handler_time', default=None)
+
+
+class Histogram:
+    ''' Histogram with fixed bucket bounds '''
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last bucket counts the values above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class ProtocolMetrics:
+    ''' Metrics of an EmsProtocol: parse and event handler durations, telegrams per source and
+    type, and the tasks. The parse time excludes the time in the event handler. '''
+    def __init__(self):
+        self.parse = Histogram(PARSE_BUCKETS)
+        self.handler = Histogram(HANDLER_BUCKETS)
+        # {(source, message type): count}
+        self.telegrams = {}
+        self.tasks_created = 0
+        self.tasks_pending = 0
+
+    def timed_handler(self, handler):
+        ''' Returns the event handler measuring its duration '''
+        async def timed(*args):
+            start = time.perf_counter()
+            try:
+                await handler(*args)
+            finally:
+                duration = time.perf_counter() - start
+                self.handler.observe(duration)
+                spent = _handler_time.get()
+                if spent is not None:
+                    spent[0] += duration
+        return(timed)
+
+    def timed_parse(self, parse):
+        ''' Returns the parse function counting the telegrams and measuring the duration '''
+        async def timed(message):
+            key = (message[0], message[2])
+            self.telegrams[key] = self.telegrams.get(key, 0) + 1
+            # Other tasks may run while the handler awaits, so the handler time is per task.
+            spent = [0.0]
+            token = _handler_time.set(spent)
+            start = time.perf_counter()
+            try:
+                await parse(message)
+            finally:
+                _handler_time.reset(token)
+            self.parse.observe(time.perf_counter() - start - spent[0])
+        return(timed)
+
+    def task_created(self, task):
+        self.tasks_created += 1
+        self.tasks_pending += 1
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, _):
+        self.tasks_pending -= 1
+
+
+def _counter(name):
+    return(name if name.endswith('_total') else name + '_total')
+
+
+def _histogram(lines, name, bounds, counts, total=None):
+    ''' Adds a histogram with the bounds and the counts of each bucket '''
+    lines.append(f'# TYPE {name} histogram')
+    cumulative = 0
+    for bound, count in zip(bounds, counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+    cumulative += counts[-1]
+    lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+    if total is not None:
+        lines.append(f'{name}_sum {total}')
+    lines.append(f'{name}_count {cumulative}')
+
+
+class MetricsExporter:
+    ''' HTTP server of the metrics. proto is an EmsProtocol, its metrics are exported if it was
+    created with metrics=True. '''
+    def __init__(self, proto=None):
+        self.proto = proto
+        self._stats = StatsReader()
+        self._server = None
+
+    async def start(self, host='', port=DEFAULT_PORT):
+        self._server = await asyncio.start_server(self._handle, host or None, port)
+        LOGGER.info('Serving metrics on port %d', port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Skip the headers
+            while (await reader.readline()).strip():
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def render(self):
+        ''' Returns the metrics in the Prometheus text format '''
+        lines = []
+        self._render_serio(lines)
+        if self.proto is not None:
+            self._render_protocol(lines)
+        return('\n'.join(lines) + '\n')
+
+    def _render_serio(self, lines):
+        stats = self._stats.as_dict()
+        for name, value in stats.items():
+            if name in HISTOGRAM_BASES:
+                base = HISTOGRAM_BASES[name]
+                bounds = [(base << i) / 1e6 for i in range(len(value) - 1)]
+                _histogram(lines, f'ems_serio_{name[:-len("_hist")]}_seconds', bounds, value)
+            elif name == 'rx_sources':
+                lines.append('# TYPE ems_serio_rx_packets_total counter')
+                lines.extend(f'ems_serio_rx_packets_total{{source="0x{address:02x}"}} {count}'
+                             for address, count in enumerate(value) if count)
+            elif name in SERIO_GAUGES:
+                lines.append(f'# TYPE ems_serio_{name} gauge')
+                lines.append(f'ems_serio_{name} {value}')
+            else:
+                lines.append(f'# TYPE ems_serio_{_counter(name)} counter')
+                lines.append(f'ems_serio_{_counter(name)} {value}')
+
+    def _render_protocol(self, lines):
+        proto = self.proto
+        for name, value in {**proto.rx_stats, **proto.scheduler.stats}.items():
+            if name in PROTOCOL_GAUGES:
+                lines.append(f'# TYPE ems_protocol_{name} gauge')
+                lines.append(f'ems_protocol_{name} {value}')
+            else:
+                lines.append(f'# TYPE ems_protocol_{_counter(name)} counter')
+                lines.append(f'ems_protocol_{_counter(name)} {value}')
+        lines.append('# TYPE ems_protocol_known_devices gauge')
+        lines.append(f'ems_protocol_known_devices {len(proto.known_devices)}')
+        online = sum(bin(byte).count('1') for byte in proto.online_devices)
+        lines.append('# TYPE ems_protocol_online_devices gauge')
+        lines.append(f'ems_protocol_online_devices {online}')
+
+        metrics = proto.metrics
+        if metrics is None:
+            return
+        _histogram(lines, 'ems_protocol_parse_seconds', metrics.parse.bounds,
+                   metrics.parse.counts, metrics.parse.sum)
+        _histogram(lines, 'ems_protocol_event_handler_seconds', metrics.handler.bounds,
+                   metrics.handler.counts, metrics.handler.sum)
+        lines.append('# TYPE ems_protocol_telegrams_total counter')
+        lines.extend(f'ems_protocol_telegrams_total{{source="0x{src:02x}",type="0x{msgtype:02x}"}}'
+                     f' {count}' for (src, msgtype), count in sorted(metrics.telegrams.items()))
+        lines.append('# TYPE ems_protocol_tasks_created_total counter')
+        lines.append(f'ems_protocol_tasks_created_total {metrics.tasks_created}')
+        lines.append('# TYPE ems_protocol_tasks_pending gauge')
+        lines.append(f'ems_protocol_tasks_pending {metrics.tasks_pending}')
+
+
+async def main(args):
+    # Imported here, as ems_protocol imports this module
+    from ems_bus.ems_protocol import EmsProtocol
+
+    async def event_handler(*_):
+        pass
+
+    logging.basicConfig(level=logging.INFO)
+    proto = EmsProtocol(args.serial_path, ems_serio.LOG_ERROR | ems_serio.LOG_INFO, 0x0b,
+                        event_handler, metrics=True)
+    exporter = MetricsExporter(proto)
+    await exporter.start(args.host, args.port)
+    task = await proto.start()
+    if task is None:
+        await exporter.stop()
+        return
+    try:
+        await task
+    finally:
+        await exporter.stop()
+        await proto.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prometheus exporter of the EMS bus')
+    parser.add_argument('serial_path')
+    parser.add_argument('--host', default='', help='Address to listen on, default all')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -7,21 +7,45 @@ import sys
 
 import posix_ipc
 
-from ems_bus.ems_defines import EMS_MAX_TELEGRAM_LENGTH
-from ems_bus import ems_messages, ems_serio
+from ems_bus.ems_defines import EMS_MAX_TELEGRAM_LENGTH, TX_PRIORITY_LOW, TX_PRIORITY_HIGH
+from ems_bus import ems_cache, ems_messages, ems_scheduler, ems_serio
+from ems_bus.ems_ring import RingReader
+from ems_bus.ems_crc import check_crc
+from ems_bus.ems_metrics import ProtocolMetrics
 from ems_bus.ems_devices import \
-    EMS_DEVICES, EMS_DEVICE_TYPE_NAMES, EMS_INITIAL_REQUESTS, EMS_DEVICE_FLAG_NO_WRITE
+    EMS_DEVICES, EMS_DEVICE_TYPE_NAMES, EMS_INITIAL_REQUESTS, EMS_REFRESH_INTERVALS, \
+    EMS_DEVICE_FLAG_NO_WRITE
 
 LOGGER = logging.getLogger(__name__)
 
 EMS_MSG_USAGES = ['BROADCAST', 'REQUEST', 'WRITE', 'RESPONSE', 'INVALID']
 
+# Types of the event handler calls
+EVENT_NEW_DEVICE = 0  # The version message of a new device was received
+EVENT_UPDATE = 1      # A message of a known device was received
+EVENT_OFFLINE = 2     # A known device went offline, message is None
+
+RX_QUEUE_NAME = '/ems_bus_rx'
+TX_QUEUE_NAME = '/ems_bus_tx'
+
 class EmsProtocol():
     run = False
     _rx_queue = None
     _tx_queue = None
+    _ring = None
+    _rx_messages = None
+    _loop = None
+    _log_loop = None
+    _cache_task = None
+    _scheduler_task = None
 
-    def __init__(self, serial_path, log_level, client_id, event_handler=None, hass=None):
+    def __init__(self, serial_path, log_level, client_id, event_handler=None, hass=None,
+                 batch=False, crc=True, ring=False, queue_depth=ems_serio.QUEUE_DEPTH,
+                 rx_overflow=ems_serio.RX_OVERFLOW_DROP_NEWEST, metrics=False, rt_priority=0,
+                 cpu=-1, mlock=False, cache=None, cache_interval=ems_cache.DEFAULT_INTERVAL,
+                 refresh_intervals=None,
+                 max_outstanding_reads=ems_scheduler.DEFAULT_MAX_OUTSTANDING,
+                 reads_per_minute=ems_scheduler.DEFAULT_READS_PER_MINUTE):
         self.online_devices = bytes(ems_messages.UbaDevicesMessage.Meta.length)
         self.known_devices = {}
         self._serial_path = serial_path
@@ -29,6 +53,40 @@ class EmsProtocol():
         self.client_id = client_id
         self.event_handler = event_handler
         self.hass = hass
+        # Parse all messages of one RX queue wakeup in one task, dropping outdated duplicates.
+        self.batch = batch
+        # The driver forwards telegrams without checking the CRC, as it must answer polls in time.
+        self.crc = crc
+        # Receive from the shared memory ring instead of the RX queue
+        self.ring = ring
+        # Number of messages of the RX and TX queues and the policy of the driver if RX is full
+        self.queue_depth = queue_depth
+        self.rx_overflow = rx_overflow
+        # SCHED_FIFO priority (0 for the default scheduling), CPU and memory locking of the
+        # reader thread of the driver
+        self.rt_priority = rt_priority
+        self.cpu = cpu
+        self.mlock = mlock
+        # Path of the snapshot of the known devices for a warm start and the interval of writing
+        # it in s. See ems_cache.py.
+        self.cache = cache
+        self.cache_interval = cache_interval
+        # Devices restored from the snapshot whose version was not read again yet
+        self._unconfirmed = set()
+        # Snapshot last written
+        self._cache_text = None
+        # Reads of the initial requests of the devices and their refresh. refresh_intervals maps
+        # message types to their interval in s, overriding EMS_REFRESH_INTERVALS.
+        self.scheduler = ems_scheduler.RequestScheduler(
+            self._scheduled_read, {**EMS_REFRESH_INTERVALS, **(refresh_intervals or {})},
+            max_outstanding=max_outstanding_reads, reads_per_minute=reads_per_minute)
+        # Parse and event handler durations, telegram and task counts for ems_metrics
+        self.metrics = ProtocolMetrics() if metrics else None
+        if self.metrics is not None:
+            self.event_handler = self.metrics.timed_handler(event_handler)
+            self.parse_message = self.metrics.timed_parse(self.parse_message)
+        self.rx_stats = {'batches': 0, 'batch_messages': 0, 'batch_max': 0, 'coalesced': 0,
+                         'rx_crc_dropped': 0}
         # Generate list of messages
         self.msg_dict = {obj.Meta.identification: obj for obj in ems_messages.__dict__.values() \
                          if isinstance(obj, type) and issubclass(obj, ems_messages.Message)}
@@ -45,19 +103,97 @@ class EmsProtocol():
             #def run_task():
             #    asyncio.run(task())
             #await loop.run_in_executor(executor, run_task)
+        if self.metrics is not None:
+            self.metrics.task_created(created)
         return(created)
 
+    def _scheduled_read(self, dst, message_type):
+        '''Starts a read request of the scheduler'''
+        self.create_task(self.read_request(dst, message_type))
+
     async def start(self):
         '''Start the serial bus driver'''
         ret = ems_serio.loglevel(self._log_level)
         LOGGER.debug('ems_serio log level is %d', ret)
-        ret = ems_serio.start(self._serial_path)
+        ret = ems_serio.start(self._serial_path,
+                              ring_slots=ems_serio.RING_SLOTS if self.ring else 0,
+                              queue_depth=self.queue_depth, rx_overflow=self.rx_overflow,
+                              rt_priority=self.rt_priority, cpu=self.cpu, mlock=self.mlock)
         if ret != 0:
             LOGGER.error('ems_serio.start(%s) failed: %d', self._serial_path, ret)
             return(None)
+        # The bus thread does not take the GIL to log. Its records are passed to the logger
+        # ems_serio from the event loop.
+        self._log_loop = asyncio.get_running_loop()
+        self._log_loop.add_reader(ems_serio.log_fd(), ems_serio.log_drain)
         self.run = True
+        if self.cache is not None:
+            # Before the RX loop, which confirms the restored devices
+            await self._restore_cache()
+            self._cache_task = self.create_task(self._cache_loop())
         return(self.create_task(self.recv()))
 
+    async def _executor_job(self, func, *args):
+        '''Runs a blocking function in an executor. Uses home assistant if given.'''
+        if self.hass:
+            return(await self.hass.async_add_executor_job(func, *args))
+        return(await asyncio.get_running_loop().run_in_executor(None, func, *args))
+
+    async def _restore_cache(self):
+        '''Restores the devices and messages of the snapshot and calls the event handler as if
+        they were received'''
+        cache = await self._executor_job(ems_cache.read, self.cache)
+        if cache is None:
+            return
+        _, devices = cache
+        version_id = ems_messages.VersionMessage.Meta.identification
+        for address, (product_id, messages) in devices.items():
+            product = next((i for i in EMS_DEVICES if i[0] == product_id), None)
+            if product is None or version_id not in messages or address in self.known_devices:
+                continue
+            dev_entry = EmsDevice(address, product, {})
+            self.known_devices[address] = dev_entry
+            self._unconfirmed.add(address)
+            # The version message first, as for a new device
+            for msgtype in sorted(messages, key=lambda msgtype: msgtype != version_id):
+                message_type = self.msg_dict.get(msgtype)
+                data = messages[msgtype]
+                if message_type is None or len(data) != message_type.Meta.length:
+                    continue
+                msg_obj = message_type(address, self)
+                updated_fields = msg_obj.parse(data, 0)
+                dev_entry.messages[msgtype] = msg_obj
+                if self.event_handler is not None:
+                    await self.event_handler(
+                        EVENT_NEW_DEVICE if msgtype == version_id else EVENT_UPDATE,
+                        dev_entry, msg_obj, updated_fields)
+        # Only the restored devices are online, so the next device list reports the others as
+        # new devices
+        online = 0
+        for address in self._unconfirmed:
+            online |= 1 << (address - ems_messages.UbaDevicesMessage.FIRST_ADDRESS)
+        self.online_devices = online.to_bytes(len(self.online_devices), 'little')
+        LOGGER.info('Restored %d devices from %s', len(self._unconfirmed), self.cache)
+
+    async def _cache_loop(self):
+        '''Writes the snapshot periodically'''
+        while self.run:
+            await asyncio.sleep(self.cache_interval)
+            await self.save_cache()
+
+    async def save_cache(self):
+        '''Writes the snapshot of the known devices, if they changed since the last one'''
+        if not self.known_devices:
+            return
+        text = ems_cache.snapshot(self.online_devices, self.known_devices)
+        if text == self._cache_text:
+            return
+        try:
+            await self._executor_job(ems_cache.write, self.cache, text)
+            self._cache_text = text
+        except OSError as e:
+            LOGGER.error('Writing the device cache %s failed: %s', self.cache, e)
+
 
     async def recv(self):
         LOGGER.debug('Entering RX loop')
@@ -66,73 +202,155 @@ class EmsProtocol():
         self._tx_queue = None
         tries = 0
 
-        while self._rx_queue is None or self._tx_queue is None:
+        while (self._rx_queue is None and not self.ring) or self._tx_queue is None:
             try:
-                self._rx_queue = \
-                    posix_ipc.MessageQueue('/ems_bus_rx', 0, 0o666, 10, 32, True, False)
-                LOGGER.debug('Connected to RX queue')
+                if not self.ring:
+                    self._rx_queue = \
+                        posix_ipc.MessageQueue(RX_QUEUE_NAME, 0, 0o666, self.queue_depth, 32,
+                                               True, False)
+                    LOGGER.debug('Connected to RX queue')
             except:
                 pass
             try:
                 self._tx_queue = \
-                    posix_ipc.MessageQueue('/ems_bus_tx', 0, 0o666, 10, 32, False, True)
+                    posix_ipc.MessageQueue(TX_QUEUE_NAME, 0, 0o666, self.queue_depth, 32, False, True)
                 LOGGER.debug('Connected to TX queue')
             except:
                 pass
-            if self._rx_queue is None or self._tx_queue is None:
+            if (self._rx_queue is None and not self.ring) or self._tx_queue is None:
                 await asyncio.sleep(1)
             tries += 1
 
+        self._scheduler_task = self.create_task(self.scheduler.run())
+
+        if self._unconfirmed:
+            # Confirm the snapshot in the background: the device list tells which devices are
+            # still online, their version if they are the same devices.
+            LOGGER.debug('Confirming the cached devices')
+            self.create_task(self.read_request(0x08, ems_messages.UbaDevicesMessage))
+            for address in self._unconfirmed:
+                self.create_task(self.read_request(address, ems_messages.VersionMessage))
+
+        self._rx_messages = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        if self.ring:
+            self._ring = RingReader(ems_serio.RING_NAME, ems_serio.ring_fd())
+            self._loop.add_reader(self._ring.event_fd, self._ring_readable)
+            LOGGER.debug('Connected to RX ring')
+            await self._rx_loop()
+            return
+
+        # The RX queue is read from the event loop when its descriptor gets readable.
+        self._rx_queue.block = False
+
         # If we could connect immediately and the queue was full, assume that the bus driver
-        # was running for a long time. Clear the queue and schedule a device query to the boiler.
+        # was running for a long time and schedule a device query to the boiler. When the driver
+        # dropped the newest packets, the queued ones are outdated. Clear them.
         if tries == 1 and self._rx_queue.current_messages == self._rx_queue.max_messages:
-            LOGGER.debug('Clearing RX queue')
-            self._rx_queue.block = False
-            while self._rx_queue.current_messages:
-                self._rx_queue.receive()
-            self._rx_queue.block = True
+            if self.rx_overflow == ems_serio.RX_OVERFLOW_DROP_NEWEST:
+                LOGGER.debug('Clearing RX queue')
+                while self._rx_queue.current_messages:
+                    self._rx_queue.receive()
 
-            LOGGER.debug('Querying device list from boiler')
-            self.create_task(self.read_request(0x08, ems_messages.UbaDevicesMessage))
+            if not self._unconfirmed:
+                LOGGER.debug('Querying device list from boiler')
+                self.create_task(self.read_request(0x08, ems_messages.UbaDevicesMessage))
         del(tries)
 
+        # On Linux, a message queue descriptor is a file descriptor which can be polled.
+        self._loop.add_reader(self._rx_queue.mqd, self._rx_readable)
+        await self._rx_loop()
+
+    async def _rx_loop(self):
+        '''Parses the messages read by the reader callbacks'''
         while self.run:
+            messages = await self._rx_messages.get()
+            if messages is None:
+                break
+            messages = [message for message in messages if self._rx_filter(message)]
+            if not messages:
+                continue
+
+            if self.batch:
+                # Parse everything we got on this wakeup in a single task.
+                messages = self._rx_coalesce(messages)
+                self.rx_stats['batches'] += 1
+                self.rx_stats['batch_messages'] += len(messages)
+                self.rx_stats['batch_max'] = max(self.rx_stats['batch_max'], len(messages))
+                self.create_task(self.parse_messages(messages))
+            else:
+                for message in messages:
+                    self.create_task(self.parse_message(message))
+
+    def _rx_readable(self):
+        '''Event loop callback when the RX queue has pending messages. Drains the queue.'''
+        messages = []
+        while True:
             try:
-                # Posix message queue is blocking, run in a separate executor.
-                if self.hass:
-                    message = (await self.hass.async_add_executor_job(self._rx_queue.receive))[0]
-                else:
-                    loop = asyncio.get_running_loop()
-                    with concurrent.futures.ThreadPoolExecutor() as pool:
-                        message = (await loop.run_in_executor(pool, self._rx_queue.receive))[0]
+                messages.append(self._rx_queue.receive()[0])
+            except posix_ipc.BusyError:
+                break
             except Exception as e:
                 LOGGER.error(e)
-                continue
+                break
+        if messages:
+            self._rx_messages.put_nowait(messages)
 
-            #LOGGER.debug('Got msg: %s', message.hex())
-            if len(message) < 6:
-                continue
-            src = message[0]
-            dst = message[1]
-            if message[1] == 0:
-                usage = 0
-            else:
-                #if src == self.bus.polled_id:
-                #    if dst & 0x80:
-                #        usage = 1
-                #    else:
-                #        usage = 2
-                #elif dst == self.bus.polled_id:
-                #    usage = 3
-                #else:
-                #    usage = 4
-                usage = 3
-            LOGGER.debug(
-                '%9s 0x%02x -> 0x%02x t 0x%02x, o %i: %s',
-                EMS_MSG_USAGES[usage], src, dst & 0x7f, message[2], message[3], message.hex())
-
-            if usage in (0, 3):
-                self.create_task(self.parse_message(message))
+    def _ring_readable(self):
+        '''Event loop callback when the RX ring has new packets. Drains the ring.'''
+        self._ring.clear_event()
+        # The packets are copied, as the parse tasks use them after the slots are released.
+        messages = [bytes(packet) for packet in self._ring.read()]
+        self._ring.release()
+        if messages:
+            self._rx_messages.put_nowait(messages)
+
+    def _rx_filter(self, message):
+        '''Returns True if the message should be parsed'''
+        #LOGGER.debug('Got msg: %s', message.hex())
+        if len(message) < 6:
+            return(False)
+        if self.crc and not check_crc(message):
+            LOGGER.error('Dropping telegram with bad CRC: %s', message.hex())
+            self.rx_stats['rx_crc_dropped'] += 1
+            return(False)
+        src = message[0]
+        dst = message[1]
+        if message[1] == 0:
+            usage = 0
+        else:
+            #if src == self.bus.polled_id:
+            #    if dst & 0x80:
+            #        usage = 1
+            #    else:
+            #        usage = 2
+            #elif dst == self.bus.polled_id:
+            #    usage = 3
+            #else:
+            #    usage = 4
+            usage = 3
+        LOGGER.debug(
+            '%9s 0x%02x -> 0x%02x t 0x%02x, o %i: %s',
+            EMS_MSG_USAGES[usage], src, dst & 0x7f, message[2], message[3], message.hex())
+
+        return(usage in (0, 3))
+
+    def _rx_coalesce(self, messages):
+        '''Drops all but the newest of messages with same source, type, offset and length.
+        The length is part of the key so a shorter update never hides data of a longer one.'''
+        newest = {}
+        for message in messages:
+            key = (message[0], message[2], message[3], len(message))
+            # Re-insert to keep the order of the newest messages
+            newest.pop(key, None)
+            newest[key] = message
+        self.rx_stats['coalesced'] += len(messages) - len(newest)
+        return(list(newest.values()))
+
+    async def parse_messages(self, messages):
+        '''Parses a batch of incoming messages'''
+        for message in messages:
+            await self.parse_message(message)
 
     async def parse_message(self, message):
         ''' Parses in incoming message '''
@@ -152,6 +370,10 @@ class EmsProtocol():
         except KeyError:
             LOGGER.error('Unknown message %02x from %02x to %02x', msgtype, src, dst)
             return
+        if src in self._unconfirmed and msgtype == ems_messages.VersionMessage.Meta.identification:
+            if not await self._confirm_device(src, message_type(src, self), data, offset):
+                return
+            # Another device is at the address now. Continue as with an unknown device.
         if src in self.known_devices:
             entry = self.known_devices[src]
             if entry.product is None:
@@ -162,6 +384,11 @@ class EmsProtocol():
             except KeyError:
                 msg_obj = message_type(src, self)
                 entry.messages[msgtype] = msg_obj
+        elif msgtype == ems_messages.UbaDevicesMessage.Meta.identification:
+            # The device list of an unknown device is used directly, no need to parse it.
+            if self.online_devices != data:
+                self.update_online_devices(data, offset)
+            return
         else:
             msg_obj = message_type(src, self)
         try:
@@ -170,54 +397,87 @@ class EmsProtocol():
             LOGGER.error(e)
             return
         #msg_obj.dump()
+        if offset == 0 and updated_fields is not None:
+            # A broadcast postpones the next read of the message
+            self.scheduler.received(src, msgtype)
 
         # We always parse 0x07 and 0x02, even from unknown devices
         if msg_obj.Meta.identification == 0x07 and self.online_devices != data:
-            # We got a changed online devices list.
-            LOGGER.debug('Device info changed: %s -> %s', self.online_devices.hex(), data.hex())
-            for num_byte in range(8):
-                for num_bit in range(8):
-                    old_state = self.online_devices[num_byte] & (1 << num_bit)
-                    new_state = data[num_byte] & (1 << num_bit)
-                    if old_state == new_state:
-                        continue
-                    dev_num = (num_byte + 1) * 8 + num_bit
-                    if old_state == 0x00:
-                        LOGGER.info('Device %02d came online. Requesting version.', dev_num)
-                        if dev_num != self.client_id:
-                            self.create_task(self.read_request(dev_num,
-                                                               ems_messages.VersionMessage))
-                    else:
-                        LOGGER.info('Device %02d went offline. Removing.', dev_num)
-                        if dev_num in self.known_devices:
-                            del(self.known_devices[dev_num])
-            self.online_devices = data
+            self.update_online_devices(data, offset)
         elif msgtype == 0x02 and src not in self.known_devices:
             # Received version info from a device. Update the internal table.
-            product_id = msg_obj.product_id.value
+            product_id = msg_obj.product_id
             product = next((i for i in EMS_DEVICES if i[0] == product_id), None)
             if product is None:
                 LOGGER.error('Found unknown device with product ID %02x', product_id)
                 return
             LOGGER.info('Found a %s at 0x%02x: ID %d, a %s v%d.%d',
                         EMS_DEVICE_TYPE_NAMES[product[1]], src, product[1], product[2],
-                        msg_obj.ver_major.value, msg_obj.ver_minor.value)
+                        msg_obj.ver_major, msg_obj.ver_minor)
 
-            # Read some initial parameters
-            if product[1] in EMS_INITIAL_REQUESTS:
-                for request in EMS_INITIAL_REQUESTS[product[1]]:
-                    self.create_task(self.read_request(src, request))
+            # Read some initial parameters, and again when they were not received for a while
+            self.scheduler.add_device(src, EMS_INITIAL_REQUESTS.get(product[1], ()))
 
             # Add to internal list and call back user event handler
             dev_entry = EmsDevice(src, product, {msgtype: msg_obj})
             self.known_devices[src] = dev_entry
-            await self.event_handler(0, dev_entry, msg_obj, updated_fields)
-            #await self.event_handler(1, self.known_devices[src], msg_obj)
+            await self.event_handler(EVENT_NEW_DEVICE, dev_entry, msg_obj, updated_fields)
         elif src in self.known_devices and updated_fields is not None:
-            await self.event_handler(1, self.known_devices[src], msg_obj, updated_fields)
+            await self.event_handler(EVENT_UPDATE, self.known_devices[src], msg_obj,
+                                     updated_fields)
 
 
-    async def read_request(self, dst, msgtype):
+    async def _confirm_device(self, src, msg_obj, data, offset):
+        '''Handles the version read again of a device restored from the snapshot. Returns True
+        if it is another device, which was removed.'''
+        try:
+            if msg_obj.parse(data, offset) is None:
+                return(False)
+        except ValueError as e:
+            LOGGER.error(e)
+            return(False)
+        self._unconfirmed.discard(src)
+        dev_entry = self.known_devices.get(src)
+        if dev_entry is None:
+            # Went offline meanwhile
+            return(True)
+        if msg_obj.product_id != dev_entry.product[0]:
+            LOGGER.info('Found another device at 0x%02x than the cached one. Removing it.', src)
+            del self.known_devices[src]
+            self.scheduler.remove_device(src)
+            if self.event_handler is not None:
+                await self.event_handler(EVENT_OFFLINE, dev_entry, None, [])
+            return(True)
+        LOGGER.info('Confirmed the cached %s at 0x%02x. Reading its values again.',
+                    EMS_DEVICE_TYPE_NAMES[dev_entry.product[1]], src)
+        self.scheduler.add_device(src, EMS_INITIAL_REQUESTS.get(dev_entry.product[1], ()))
+        version = dev_entry.messages[msg_obj.Meta.identification]
+        updated_fields = version.parse(data, offset)
+        if updated_fields and self.event_handler is not None:
+            await self.event_handler(EVENT_UPDATE, dev_entry, version, updated_fields)
+        return(False)
+
+    def update_online_devices(self, data, offset):
+        ''' Handles a changed online devices list of a UbaDevicesMessage '''
+        if offset != 0 or len(data) < ems_messages.UbaDevicesMessage.BITMAP_LENGTH:
+            LOGGER.error('Ignoring incomplete device list at offset %d: %s', offset, data.hex())
+            return
+        LOGGER.debug('Device info changed: %s -> %s', self.online_devices.hex(), data.hex())
+        added, removed = ems_messages.UbaDevicesMessage.diff(self.online_devices, data)
+        for dev_num in added:
+            LOGGER.info('Device %02d came online. Requesting version.', dev_num)
+            if dev_num != self.client_id:
+                self.create_task(self.read_request(dev_num, ems_messages.VersionMessage))
+        for dev_num in removed:
+            LOGGER.info('Device %02d went offline. Removing.', dev_num)
+            if dev_num in self.known_devices:
+                dev_entry = self.known_devices.pop(dev_num)
+                self.scheduler.remove_device(dev_num)
+                if self.event_handler is not None:
+                    self.create_task(self.event_handler(EVENT_OFFLINE, dev_entry, None, []))
+        self.online_devices = data
+
+    async def read_request(self, dst, msgtype, priority=TX_PRIORITY_LOW):
         ''' Generates a read request of this message '''
         msg_id = msgtype.Meta.identification
         LOGGER.info('Reading message 0x%02x from 0x%02x', msg_id, dst)
@@ -228,13 +488,17 @@ class EmsProtocol():
         data[3] = 0x00 # Offset 0
         data[4] = EMS_MAX_TELEGRAM_LENGTH
         if self.hass:
-            await self.hass.async_add_executor_job(self._tx_queue.send, data)
+            await self.hass.async_add_executor_job(self.send, data, priority)
         else:
             loop = asyncio.get_running_loop()
             with concurrent.futures.ThreadPoolExecutor() as executor:
-                await loop.run_in_executor(executor, self._tx_queue.send, data)
+                await loop.run_in_executor(executor, self.send, data, priority)
 
-    def device_set_value(self, dev_id, message_type, field, value):
+    def send(self, data, priority=TX_PRIORITY_LOW):
+        ''' Queues a telegram for the bus driver. Blocks while the TX queue is full. '''
+        self._tx_queue.send(data, priority=priority)
+
+    def device_set_value(self, dev_id, message_type, field, value, priority=TX_PRIORITY_HIGH):
         ''' Updates and sends an updated value of a field of a message of a device '''
         try:
             dev_entry = self.known_devices[dev_id]
@@ -244,15 +508,36 @@ class EmsProtocol():
         if product[3] & EMS_DEVICE_FLAG_NO_WRITE:
             raise(ValueError(f'Write not allowed for product {product[1]} - {product[2]}'))
         message = dev_entry.messages[message_type.Meta.identification]
-        message.field_set_send(field, value)
+        message.field_set_send(field, value, priority)
 
     async def stop(self):
         ''' Set a stop condition for the EMS bus'''
         self.run = False
+        if self._scheduler_task is not None:
+            self._scheduler_task.cancel()
+            self._scheduler_task = None
+        if self._cache_task is not None:
+            self._cache_task.cancel()
+            self._cache_task = None
+            await self.save_cache()
+        if self._loop is not None:
+            if self._ring is not None:
+                self._loop.remove_reader(self._ring.event_fd)
+            else:
+                self._loop.remove_reader(self._rx_queue.mqd)
+            self._rx_messages.put_nowait(None)
+            self._loop = None
         ems_serio.stop()
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+        if self._log_loop is not None:
+            self._log_loop.remove_reader(ems_serio.log_fd())
+            self._log_loop = None
+            ems_serio.log_drain()
 
     def stats(self):
-        return(ems_serio.stats())
+        return({**ems_serio.stats(), **self.rx_stats, **self.scheduler.stats})
 
 class EmsDevice:
     def __init__(self, address, product, messages):
@@ -0,0 +1,70 @@
+'''
+Reader of the shared memory ring of received packets, the alternative to the RX queue
+
+ems_serio.start(path, ring_slots=n) passes the received packets in a single producer, single
+consumer ring in shared memory instead of the RX message queue. The layout is defined in
+ems_serio/ring.h. The driver signals new packets on the eventfd ems_serio.ring_fd().
+'''
+
+import mmap
+import os
+import struct
+
+import posix_ipc
+
+RING_MAGIC = 0x454d5352
+HEADER = struct.Struct('=IIII')
+HEAD_OFFSET = 64
+TAIL_OFFSET = 128
+SLOTS_OFFSET = 192
+POSITION = struct.Struct('=Q')
+
+
+class RingReader:
+    ''' Reads the packets of the ring. read() returns memoryviews of the packets in the shared
+    memory without copying them. They are valid until release() hands their slots back to the
+    driver. '''
+    def __init__(self, name, event_fd):
+        memory = posix_ipc.SharedMemory(name)
+        try:
+            self._map = mmap.mmap(memory.fd, memory.size)
+        finally:
+            memory.close_fd()
+        magic, self.slots, self.slot_size, _ = HEADER.unpack_from(self._map)
+        if magic != RING_MAGIC:
+            self._map.close()
+            raise(ValueError(f'Shared memory {name} is no RX ring'))
+        self.event_fd = event_fd
+        self._view = memoryview(self._map)
+        self._tail = POSITION.unpack_from(self._map, TAIL_OFFSET)[0]
+        self._pending = 0
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+    def read(self):
+        ''' Returns memoryviews of all packets added since the last call '''
+        head = POSITION.unpack_from(self._map, HEAD_OFFSET)[0]
+        view = self._view
+        slots = self.slots
+        slot_size = self.slot_size
+        packets = []
+        for position in range(self._tail + self._pending, head):
+            start = SLOTS_OFFSET + position % slots * slot_size
+            packets.append(view[start + 1:start + 1 + view[start]])
+        self._pending = head - self._tail
+        return(packets)
+
+    def release(self):
+        ''' Releases the slots of the packets returned by read() '''
+        self._tail += self._pending
+        self._pending = 0
+        POSITION.pack_into(self._map, TAIL_OFFSET, self._tail)
+
+    def clear_event(self):
+        ''' Resets the eventfd after a wakeup '''
+        try:
+            os.read(self.event_fd, 8)
+        except BlockingIOError:
+            pass
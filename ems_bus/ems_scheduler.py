@@ -0,0 +1,163 @@
+'''
+Scheduler of the read requests of EmsProtocol
+
+The initial requests of a device are read when it is discovered and then again after their
+refresh interval, so values the devices do not broadcast do not go stale. A read is skipped if
+the message was received meanwhile, e.g. by a broadcast: each telegram of the message at offset 0
+moves its next read an interval later. The intervals get a random jitter, so the reads of the
+devices do not line up.
+
+The reads share a bus budget: at most max_outstanding reads wait for their reply, and at most
+reads_per_minute are started in any minute. A read not answered within READ_TIMEOUT s no longer
+counts as outstanding, the message is read again after its interval.
+'''
+
+import asyncio
+import heapq
+import logging
+import random
+from collections import deque
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 600
+DEFAULT_JITTER = 0.1
+DEFAULT_MAX_OUTSTANDING = 2
+DEFAULT_READS_PER_MINUTE = 20
+# Time a read may wait for its reply, in s. The TX queue sends one telegram per poll.
+READ_TIMEOUT = 10.0
+
+
+class RequestScheduler:
+    ''' Schedules the reads of messages of the devices. read(address, message_type) starts a
+    read request, intervals maps message types to their refresh interval in s. Call received()
+    for each telegram of a scheduled message and run() in a task. '''
+    def __init__(self, read, intervals=None, default_interval=DEFAULT_INTERVAL,
+                 jitter=DEFAULT_JITTER, max_outstanding=DEFAULT_MAX_OUTSTANDING,
+                 reads_per_minute=DEFAULT_READS_PER_MINUTE):
+        self._read = read
+        self.intervals = intervals or {}
+        self.default_interval = default_interval
+        # Fraction of the interval the refresh may be early or late
+        self.jitter = jitter
+        self.max_outstanding = max_outstanding
+        self.reads_per_minute = reads_per_minute
+        # {(address, message type ID): [due time, interval, message type, sequence number]}
+        self._entries = {}
+        # (due time, sequence number, (address, message type ID)). An item is outdated if its
+        # entry has another sequence number or is due later.
+        self._queue = []
+        self._sequence = 0
+        # {(address, message type ID): time the read times out}
+        self._outstanding = {}
+        # Start times of the reads in the last minute
+        self._reads = deque()
+        self._random = random.Random()
+        self._wakeup = asyncio.Event()
+        # refresh_postponed counts the telegrams received without a read
+        self.stats = {'refresh_reads': 0, 'refresh_postponed': 0, 'refresh_timeouts': 0,
+                      'refresh_outstanding': 0}
+
+    @staticmethod
+    def _time():
+        return(asyncio.get_running_loop().time())
+
+    def _interval(self, interval):
+        return(interval * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def _push(self, key, entry):
+        self._sequence += 1
+        entry[3] = self._sequence
+        heapq.heappush(self._queue, (entry[0], self._sequence, key))
+
+    def add_device(self, address, message_types):
+        ''' Schedules the messages of a device, which are read as soon as the budget allows '''
+        now = self._time()
+        for message_type in message_types:
+            key = (address, message_type.Meta.identification)
+            interval = self.intervals.get(message_type, self.default_interval)
+            self._entries[key] = entry = [now, interval, message_type, None]
+            self._push(key, entry)
+        self._wakeup.set()
+
+    def remove_device(self, address):
+        ''' Stops reading the messages of a device, e.g. when it went offline '''
+        for key in [key for key in self._entries if key[0] == address]:
+            del self._entries[key]
+            self._outstanding.pop(key, None)
+        self.stats['refresh_outstanding'] = len(self._outstanding)
+
+    def received(self, address, msgtype):
+        ''' Handles a telegram of a message at offset 0, answering a read or broadcast '''
+        key = (address, msgtype)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if self._outstanding.pop(key, None) is not None:
+            self.stats['refresh_outstanding'] = len(self._outstanding)
+            self._wakeup.set()
+        else:
+            self.stats['refresh_postponed'] += 1
+        entry[0] = self._time() + self._interval(entry[1])
+
+    def _expire(self, now):
+        ''' Removes the outstanding reads which timed out. Returns the next timeout. '''
+        for key, timeout in list(self._outstanding.items()):
+            if timeout <= now:
+                LOGGER.debug('Read of message 0x%02x from 0x%02x timed out', key[1], key[0])
+                del self._outstanding[key]
+                self.stats['refresh_timeouts'] += 1
+        self.stats['refresh_outstanding'] = len(self._outstanding)
+        return(min(self._outstanding.values(), default=None))
+
+    def _start_reads(self, now):
+        ''' Starts the due reads within the budget. Returns the time a read may start next. '''
+        while self._reads and self._reads[0] <= now - 60:
+            self._reads.popleft()
+        while self._queue:
+            due, sequence, key = self._queue[0]
+            entry = self._entries.get(key)
+            if entry is None or entry[3] != sequence:
+                # Device removed or added again
+                heapq.heappop(self._queue)
+                continue
+            if entry[0] > due:
+                # Received or read meanwhile
+                heapq.heappop(self._queue)
+                self._push(key, entry)
+                continue
+            if due > now:
+                return(due)
+            if key in self._outstanding:
+                # Still waiting for the last read
+                heapq.heappop(self._queue)
+                entry[0] = self._outstanding[key]
+                self._push(key, entry)
+                continue
+            if len(self._outstanding) >= self.max_outstanding:
+                # Woken up by the next reply or timeout
+                return(None)
+            if len(self._reads) >= self.reads_per_minute:
+                return(self._reads[0] + 60)
+            heapq.heappop(self._queue)
+            entry[0] = now + self._interval(entry[1])
+            self._push(key, entry)
+            self._outstanding[key] = now + READ_TIMEOUT
+            self._reads.append(now)
+            self.stats['refresh_reads'] += 1
+            self.stats['refresh_outstanding'] = len(self._outstanding)
+            self._read(key[0], entry[2])
+        return(None)
+
+    async def run(self):
+        ''' Starts the reads when they are due, until cancelled '''
+        while True:
+            now = self._time()
+            wakeups = [time for time in (self._expire(now), self._start_reads(now))
+                       if time is not None]
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       max(0, min(wakeups) - now) if wakeups else None)
+            except asyncio.TimeoutError:
+                pass
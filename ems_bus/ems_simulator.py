@@ -0,0 +1,285 @@
+'''
+Software EMS bus simulator on a pseudo-terminal
+
+The simulator plays the bus master (0x08) and the devices behind it. It polls the client ID,
+echoes the characters the client sends, terminates telegrams with BREAKs and answers read
+requests with scripted payloads. Point ems_serio.start() at the simulator path to run the bus
+driver and EmsProtocol without a boiler:
+
+    simulator = BusSimulator()
+    simulator.start()
+    ems_serio.start(simulator.path)
+
+A pseudo-terminal has no parity, so the simulator sends the BREAKs as the PARMRK sequence
+0xff 0x00 0x00 and doubles each 0xff, as the serial port would deliver them. ems_serio detects
+the pseudo-terminal and does not enable PARMRK itself.
+
+The end of a telegram of the client is detected by its CRC, as the BREAK of the client is a
+plain 0x00 without parity on a pseudo-terminal. A single character followed by 0x00 is a bus
+release, so broadcasts of the client are not supported.
+
+Usage: python3 -m ems_bus.ems_simulator [poll interval in s]
+'''
+
+import logging
+import os
+import pty
+import select
+import sys
+import threading
+import time
+import tty
+from collections import deque
+
+from ems_bus import ems_messages
+from ems_bus.ems_crc import calc_crc
+from ems_bus.ems_defines import EMS_MAX_TELEGRAM_LENGTH
+
+LOGGER = logging.getLogger(__name__)
+
+MASTER_ID = 0x08
+THERMOSTAT_ID = 0x10
+CLIENT_ID = 0x0b
+BREAK = b'\xff\x00\x00'
+ACK = 0x01
+# Time of one character on the bus at 9600 baud, 8N1, in s
+CHAR_TIME = 0.00104
+# Time the client may take to send the next character, in s
+CLIENT_TIMEOUT = 0.2
+# Reply times of the client kept in reply_times
+REPLY_TIMES = 10000
+
+
+def telegram(src, dst, msgtype, offset, data):
+    ''' Returns a telegram with CRC '''
+    message = bytearray([src, dst, msgtype, offset, *data, 0])
+    message[-1] = calc_crc(message)
+    return(bytes(message))
+
+
+def encode(message_type, **values):
+    ''' Returns the data of a message with the given field values, all others are 0 '''
+    msg_obj = message_type(0, None)
+    for name, value in values.items():
+        index = msg_obj._index[name]
+        field = msg_obj._layout[index][1]
+        msg_obj.values[index] = value
+        msg_obj.message[field.pos:field.pos + field.length] = field.to_bytes(value, msg_obj)
+    return(bytes(msg_obj.message))
+
+
+def default_devices():
+    ''' Returns the data of the simulated devices: {address: {message type: data}} '''
+    return({
+        MASTER_ID: {
+            # Buderus GBx72
+            0x02: encode(ems_messages.VersionMessage, product_id=123, ver_major=1, ver_minor=5),
+            0x18: encode(ems_messages.UbaMonitorFast, forward_temp_set=60, forward_temp=55.3,
+                         burner_power_max=100, burner_power=42, fan=True, boiler_pump=True,
+                         boiler_temp=56.1, drinkwater_temp=48.5, return_current=40.2,
+                         pressure=1.5, service_code='-H'),
+        },
+        THERMOSTAT_ID: {
+            # RC35
+            0x02: encode(ems_messages.VersionMessage, product_id=86, ver_major=1, ver_minor=2),
+            0x3e: encode(ems_messages.Hc1MonitorMessage, automatic_mode=True, day_mode=True,
+                         room_set_temp=21, room_current_temp=20.7, boiler_power=35),
+        },
+    })
+
+
+class BusSimulator:
+    ''' Simulated bus master on a pseudo-terminal. The bus runs in a thread between start() and
+    stop(). stats counts the poll cycles and the telegrams of the client. reply_times holds the
+    last times from a poll to the first character of the client, in s. '''
+    def __init__(self, client_id=CLIENT_ID, devices=None, poll_interval=0.01,
+                 broadcast_interval=100, realtime=False):
+        self.client_id = client_id
+        # Data of the devices on the bus. Read requests are answered from it, writes update it.
+        self.devices = default_devices() if devices is None else devices
+        # Time between two polls of the client
+        self.poll_interval = poll_interval
+        # The master broadcasts the device list and its monitor every broadcast_interval polls.
+        self.broadcast_interval = broadcast_interval
+        # Wait the transmission time of each character as on a 9600 baud bus
+        self.realtime = realtime
+        self.stats = {'polls': 0, 'broadcasts': 0, 'reads': 0, 'writes': 0, 'unanswered': 0,
+                      'timeouts': 0}
+        self.reply_times = deque(maxlen=REPLY_TIMES)
+        self.msg_dict = {obj.Meta.identification: obj for obj in ems_messages.__dict__.values()
+                         if isinstance(obj, type) and issubclass(obj, ems_messages.Message)}
+        self._master, self._slave = pty.openpty()
+        # The slave stays open, so the pseudo-terminal survives restarts of the driver.
+        tty.setraw(self._slave)
+        # Without a driver reading the other side, the buffer fills up. Drop the data then.
+        os.set_blocking(self._master, False)
+        self.path = os.ttyname(self._slave)
+        self._thread = None
+        self._run = False
+
+    def start(self):
+        ''' Starts the bus in a thread '''
+        self._run = True
+        self._thread = threading.Thread(target=self.run, name='ems_simulator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' Stops the bus thread '''
+        self._run = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        ''' Closes the pseudo-terminal '''
+        self.stop()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def run(self):
+        ''' Bus loop: broadcasts of the master and polls of the client '''
+        cycle = 0
+        while self._run:
+            if cycle % self.broadcast_interval == 0:
+                self.broadcast()
+            self.poll()
+            cycle += 1
+            time.sleep(self.poll_interval)
+
+    def stream(self, telegrams, rate=0, sent=None):
+        ''' Sends telegrams of other devices, rate per second. With rate 0, they are sent as fast
+        as the driver reads them. The time.monotonic() after writing telegram i is stored in
+        sent[i]. For benchmarks, do not start() the bus at the same time. '''
+        os.set_blocking(self._master, True)
+        start = time.monotonic()
+        try:
+            for i, message in enumerate(telegrams):
+                if rate:
+                    delay = start + i / rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.send(message)
+                if sent is not None:
+                    sent[i] = time.monotonic()
+        finally:
+            os.set_blocking(self._master, False)
+
+    def device_bitmap(self):
+        ''' Returns the data of the UbaDevicesMessage of the simulated devices and the client '''
+        bitmap = 0
+        for address in (*self.devices, self.client_id):
+            bitmap |= 1 << (address - ems_messages.UbaDevicesMessage.FIRST_ADDRESS)
+        return(bitmap.to_bytes(ems_messages.UbaDevicesMessage.Meta.length, 'little'))
+
+    def broadcast(self):
+        ''' Broadcasts the device list and the monitor of the master '''
+        self.send(telegram(MASTER_ID, 0x00, ems_messages.UbaDevicesMessage.Meta.identification, 0,
+                           self.device_bitmap()))
+        monitor = self.devices.get(MASTER_ID, {}).get(0x18)
+        if monitor is not None:
+            self.send(telegram(MASTER_ID, 0x00, 0x18, 0, monitor))
+        self.stats['broadcasts'] += 1
+
+    def poll(self):
+        ''' Polls the client and handles its telegrams until it releases the bus '''
+        self.send(bytes([0x80 | self.client_id]))
+        polled = time.monotonic()
+        self.stats['polls'] += 1
+        message = bytearray()
+        while True:
+            char = self.read_char()
+            if polled is not None:
+                if char is not None:
+                    self.reply_times.append(time.monotonic() - polled)
+                polled = None
+            if char is None:
+                LOGGER.debug('Client did not answer after %s', message.hex())
+                self.stats['timeouts'] += 1
+                return
+            if char == 0x00 and self.is_complete(message):
+                # BREAK of the client, echoed by the master
+                self.write(BREAK)
+                if len(message) == 1:
+                    return
+                self.answer(bytes(message))
+                message = bytearray()
+                continue
+            self.write(b'\xff\xff' if char == 0xff else bytes([char]))
+            message.append(char)
+
+    def is_complete(self, message):
+        ''' Returns if the characters received from the client are a bus release or a telegram '''
+        if len(message) == 1:
+            return(message[0] == self.client_id)
+        return(len(message) >= 6 and calc_crc(message) == message[-1])
+
+    def answer(self, message):
+        ''' Answers a telegram of the client '''
+        dst = message[1] & 0x7f
+        msgtype = message[2]
+        offset = message[3]
+        if message[1] & 0x80:
+            # Read request: answer from the device data, unknown data is zero.
+            self.stats['reads'] += 1
+            data = self.device_data(dst, msgtype)
+            if data is None:
+                LOGGER.debug('No answer of 0x%02x for message 0x%02x', dst, msgtype)
+                self.stats['unanswered'] += 1
+                return
+            length = min(message[4], EMS_MAX_TELEGRAM_LENGTH - 5)
+            self.send(telegram(dst, message[0], msgtype, offset, data[offset:offset + length]))
+        elif dst != 0x00:
+            # Write command: update the device data and ACK
+            self.stats['writes'] += 1
+            data = bytearray(self.device_data(dst, msgtype) or b'')
+            update = message[4:-1]
+            if len(data) < offset + len(update):
+                data.extend(bytes(offset + len(update) - len(data)))
+            data[offset:offset + len(update)] = update
+            self.devices.setdefault(dst, {})[msgtype] = bytes(data)
+            self.send(bytes([ACK]))
+
+    def device_data(self, address, msgtype):
+        ''' Returns the data of a message of a device. Messages without data are zero if the
+        device exists and the message type is known, else None. '''
+        data = self.devices.get(address, {}).get(msgtype)
+        if address == MASTER_ID and msgtype == ems_messages.UbaDevicesMessage.Meta.identification:
+            data = self.device_bitmap()
+        elif data is None and address in self.devices and msgtype in self.msg_dict:
+            data = bytes(self.msg_dict[msgtype].Meta.length)
+        return(data)
+
+    def send(self, message):
+        ''' Sends a telegram or a single character of the master, terminated with a BREAK '''
+        self.write(message.replace(b'\xff', b'\xff\xff') + BREAK)
+
+    def write(self, data):
+        if self.realtime:
+            time.sleep(len(data) * CHAR_TIME)
+        try:
+            os.write(self._master, data)
+        except BlockingIOError:
+            pass
+
+    def read_char(self):
+        ''' Returns the next character of the client or None on a timeout '''
+        if not select.select([self._master], [], [], CLIENT_TIMEOUT)[0]:
+            return(None)
+        return(os.read(self._master, 1)[0])
+
+
+def main(poll_interval):
+    logging.basicConfig(level=logging.DEBUG)
+    simulator = BusSimulator(poll_interval=poll_interval, realtime=True)
+    print(f'Simulated EMS bus on {simulator.path}')
+    simulator.start()
+    try:
+        while True:
+            time.sleep(10)
+            print(simulator.stats)
+    except KeyboardInterrupt:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.1)
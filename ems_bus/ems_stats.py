@@ -0,0 +1,60 @@
+'''
+Reader of the ems_serio statistics without calling into the driver
+
+ems_serio.stats_view() is a read-only memoryview of the statistics struct of the driver, and
+ems_serio.STATS_LAYOUT describes its fields as (name, offset, struct format, count). A monitoring
+loop creates a StatsReader once and calls read(), which unpacks all counters with a single
+struct.unpack_from call. The driver updates the counters without locking, so a value may be one
+update behind the others.
+
+Histograms (the *_hist fields) have ems_serio.HIST_BUCKETS buckets. Bucket 0 counts durations
+below the base in ems_serio.HIST_BASE_*, bucket i below base * 2^i and the last bucket all longer
+ones. rx_sources counts the forwarded packets per source address.
+'''
+
+import struct
+
+from ems_bus import ems_serio
+
+HISTOGRAM_BASES = {
+    'tx_bus_hist': ems_serio.HIST_BASE_TX_BUS,
+    'poll_interval_hist': ems_serio.HIST_BASE_POLL_INTERVAL,
+    'poll_reply_hist': ems_serio.HIST_BASE_POLL_REPLY,
+}
+
+
+def histogram_bounds(name):
+    ''' Returns the upper bounds of the buckets of a histogram in us, the last one is None '''
+    base = HISTOGRAM_BASES[name]
+    return([base << i for i in range(ems_serio.HIST_BUCKETS - 1)] + [None])
+
+
+class StatsReader:
+    ''' Reads the statistics of ems_serio from its memory. fields lists (name, index, count) of
+    each counter in the tuple of read(). Arrays have count items. '''
+    def __init__(self):
+        self._view = ems_serio.stats_view()
+        fmt = '='
+        pos = 0
+        index = 0
+        self.fields = []
+        for name, offset, item_format, count in sorted(ems_serio.STATS_LAYOUT,
+                                                       key=lambda field: field[1]):
+            if offset > pos:
+                fmt += f'{offset - pos}x'
+            fmt += f'{count}{item_format}'
+            pos = offset + count * struct.calcsize('=' + item_format)
+            self.fields.append((name, index, count))
+            index += count
+        self._struct = struct.Struct(fmt)
+
+    def read(self):
+        ''' Returns a tuple of all counters '''
+        return(self._struct.unpack_from(self._view))
+
+    def as_dict(self, values=None):
+        ''' Returns the counters of read() or values as dict. Arrays are tuples. '''
+        if values is None:
+            values = self.read()
+        return({name: values[index] if count == 1 else values[index:index + count]
+                for name, index, count in self.fields})
@@ -0,0 +1,68 @@
+'''
+Filter of field updates for consumers which publish the values, e.g. as Home Assistant states
+
+EmsProtocol reports every field whose bytes changed. Temperatures change by 0.1 °C on most
+telegrams, so publishing each change costs a state write per field and telegram. UpdateFilter
+decides per key, e.g. an entity ID, which values to publish:
+
+* values equal to the last published one are skipped,
+* Celsius values closer than hysteresis to the last published one are skipped,
+* a key is published at most every min_interval s, intervals maps field names to their own
+  interval. A throttled value is due at due(key). The caller publishes the then current value,
+  so the last value is not lost.
+
+The filter does not keep the time itself, now is passed by the caller.
+'''
+
+from ems_bus.ems_units import UnitCelsius
+
+# Decisions of UpdateFilter.check(), also the keys of UpdateFilter.stats
+PUBLISH = 'published'
+UNCHANGED = 'unchanged'
+HYSTERESIS = 'hysteresis'
+THROTTLED = 'throttled'
+
+
+class UpdateFilter:
+    ''' Decides which field values are published. stats counts the decisions. '''
+    def __init__(self, min_interval=0.0, intervals=None, hysteresis=0.0):
+        self.min_interval = min_interval
+        # {field name: minimum interval in s}
+        self.intervals = intervals or {}
+        # In °C, for fields with the unit UnitCelsius
+        self.hysteresis = hysteresis
+        # {key: (last published value, time, minimum interval)}
+        self._last = {}
+        self.stats = {PUBLISH: 0, UNCHANGED: 0, HYSTERESIS: 0, THROTTLED: 0}
+
+    def published(self, key, field_name, value, now):
+        ''' Records that value was published for key, e.g. when the entity was added '''
+        self._last[key] = (value, now, self.intervals.get(field_name, self.min_interval))
+
+    def check(self, key, field_name, field, value, now):
+        ''' Returns PUBLISH if value of the field should be published for key and records it as
+        published. Else returns why not: UNCHANGED, HYSTERESIS or THROTTLED. '''
+        decision = PUBLISH
+        last = self._last.get(key)
+        if last is not None:
+            last_value, last_time, interval = last
+            if value == last_value:
+                decision = UNCHANGED
+            elif self.hysteresis and field.unit is UnitCelsius and \
+                 isinstance(value, (int, float)) and isinstance(last_value, (int, float)) and \
+                 abs(value - last_value) < self.hysteresis:
+                decision = HYSTERESIS
+            elif now - last_time < interval:
+                decision = THROTTLED
+        if decision == PUBLISH:
+            self.published(key, field_name, value, now)
+        self.stats[decision] += 1
+        return(decision)
+
+    def due(self, key):
+        ''' Returns the time from which key may be published again '''
+        _, last_time, interval = self._last[key]
+        return(last_time + interval)
+
+    def forget(self, key):
+        self._last.pop(key, None)
@@ -0,0 +1,122 @@
+// Benchmark of the RX character processing in rx_packet.
+// Feeds a byte stream through a pipe into rx_packet and reports the throughput and the number
+// of read() calls per telegram.
+//
+// Usage: ./bench_rx [rounds] [stream file]
+// The stream file contains the raw bytes as read from the serial port, including parity marks.
+// Without a file, a synthetic stream of bus tokens and monitor telegrams is used.
+#define _GNU_SOURCE 1
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "serial.h"
+#include "ems_serio.h"
+#include "rx.h"
+
+// Stays below the default pipe capacity, so a whole round can be written before reading.
+#define STREAM_SIZE 60000
+
+extern size_t rx_len;
+
+uint8_t stream[STREAM_SIZE];
+
+size_t add_packet(size_t pos, const uint8_t *packet, size_t len) {
+    for (size_t i = 0; i < len; i++) {
+        stream[pos++] = packet[i];
+        // Parity marking doubles 0xff
+        if (packet[i] == 0xff)
+            stream[pos++] = 0xff;
+    }
+    memcpy(&stream[pos], BREAK_IN, sizeof(BREAK_IN) - 1);
+    return(pos + sizeof(BREAK_IN) - 1);
+}
+
+size_t synthetic_stream(unsigned int *packets) {
+    const uint8_t poll[] = { 0x88 };
+    const uint8_t release[] = { 0x08 };
+    uint8_t monitor[4 + 25 + 1] = { 0x08, 0x00, 0x18, 0x00 };
+    size_t pos = 0;
+
+    for (size_t i = 4; i < sizeof(monitor); i++)
+        monitor[i] = (uint8_t)(i * 37);
+    monitor[10] = 0xff;
+    *packets = 0;
+    while (pos + 3 * (sizeof(monitor) * 2 + 3) < STREAM_SIZE) {
+        pos = add_packet(pos, poll, sizeof(poll));
+        pos = add_packet(pos, monitor, sizeof(monitor));
+        pos = add_packet(pos, release, sizeof(release));
+        *packets += 3;
+    }
+    return(pos);
+}
+
+size_t file_stream(char *path, unsigned int *packets) {
+    FILE *file;
+    size_t len, end = 0;
+
+    file = fopen(path, "rb");
+    if (file == NULL) {
+        perror(path);
+        exit(EXIT_FAILURE);
+    }
+    len = fread(stream, 1, STREAM_SIZE, file);
+    fclose(file);
+    // Count the BREAKs and cut the stream after the last one
+    *packets = 0;
+    for (size_t i = 0; i + 2 < len; i++) {
+        if (stream[i] != 0xff)
+            continue;
+        if (stream[i + 1] == 0xff) {
+            i++;
+        } else if (stream[i + 1] == 0x00 && stream[i + 2] == 0x00) {
+            (*packets)++;
+            i += 2;
+            end = i + 1;
+        }
+    }
+    return(end);
+}
+
+int main(int argc, char *argv[]) {
+    int fds[2];
+    int abort = 0;
+    unsigned int rounds, packets;
+    size_t len, received = 0;
+    struct timespec start, end;
+    double duration;
+
+    rounds = argc > 1 ? (unsigned int)atoi(argv[1]) : 100;
+    len = argc > 2 ? file_stream(argv[2], &packets) : synthetic_stream(&packets);
+    if (pipe(fds) != 0) {
+        perror("pipe");
+        return(EXIT_FAILURE);
+    }
+    port = fds[0];
+    stats.rx_reads = 0;
+
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    for (unsigned int round = 0; round < rounds; round++) {
+        if (write(fds[1], stream, len) != (ssize_t)len) {
+            perror("write");
+            return(EXIT_FAILURE);
+        }
+        for (unsigned int i = 0; i < packets; i++) {
+            rx_packet(&abort);
+            received += rx_len;
+        }
+    }
+    clock_gettime(CLOCK_MONOTONIC, &end);
+
+    duration = (double)(end.tv_sec - start.tv_sec) + (double)(end.tv_nsec - start.tv_nsec) / 1e9;
+    printf("%u telegrams, %zu bytes (%zu without BREAKs and parity marks) in %.3f s\n",
+           rounds * packets, rounds * len, received, duration);
+    printf("%.0f bytes/s, %.0f telegrams/s, %.3f read() calls per telegram\n",
+           (double)(rounds * len) / duration, (double)(rounds * packets) / duration,
+           (double)stats.rx_reads / (rounds * packets));
+    return(0);
+}
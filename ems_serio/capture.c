@@ -0,0 +1,95 @@
+#define _GNU_SOURCE 1
+
+#include <stdint.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <errno.h>
+#include <stdio.h>
+#include <string.h>
+#include <time.h>
+#include <pthread.h>
+#include <sys/stat.h>
+
+#include "ems_serio.h"
+#include "capture.h"
+
+// Records the packets of the bus to a file, which can be replayed into EmsProtocol.
+// The file is only appended. Each record is written with a single write(), so a reader never
+// sees a partial record if the driver is stopped.
+
+int capture_fd = -1;
+int capture_mac = 0; // Also capture MAC tokens
+pthread_mutex_t capture_lock = PTHREAD_MUTEX_INITIALIZER;
+
+// Opens the capture file, appending to an existing one. Returns 0 on success.
+int capture_open(char *path, int mac) {
+    struct CAPTURE_HEADER header;
+    struct stat st;
+    int fd;
+
+    fd = open(path, O_WRONLY | O_APPEND | O_CREAT, 0644);
+    if (fd < 0) {
+        log(LOG_ERROR, "Failed to open capture file %s: %s", path, strerror(errno));
+        return(-1);
+    }
+    if (fstat(fd, &st) != 0) {
+        close(fd);
+        return(-1);
+    }
+    if (st.st_size == 0) {
+        memset(&header, 0, sizeof(header));
+        memcpy(header.magic, CAPTURE_MAGIC, sizeof(header.magic));
+        header.version = CAPTURE_VERSION;
+        header.record_header_size = sizeof(struct CAPTURE_RECORD);
+        if (write(fd, &header, sizeof(header)) != sizeof(header)) {
+            log(LOG_ERROR, "Failed to write capture file header: %s", strerror(errno));
+            close(fd);
+            return(-1);
+        }
+    }
+
+    capture_close();
+    pthread_mutex_lock(&capture_lock);
+    capture_fd = fd;
+    capture_mac = mac;
+    pthread_mutex_unlock(&capture_lock);
+    log(LOG_VERBOSE, "Capturing to %s", path);
+    return(0);
+}
+
+void capture_close() {
+    pthread_mutex_lock(&capture_lock);
+    if (capture_fd >= 0) {
+        close(capture_fd);
+        capture_fd = -1;
+    }
+    pthread_mutex_unlock(&capture_lock);
+}
+
+void capture_packet(uint8_t *data, size_t len, uint8_t type) {
+    struct {
+        struct CAPTURE_RECORD header;
+        uint8_t data[MAX_PACKET_SIZE];
+    } record;
+    struct timespec now;
+    size_t size;
+
+    if (capture_fd < 0)
+        return;
+    if (len > MAX_PACKET_SIZE)
+        len = MAX_PACKET_SIZE;
+    clock_gettime(CLOCK_REALTIME, &now);
+    memset(&record.header, 0, sizeof(record.header));
+    record.header.time = (uint64_t)now.tv_sec * 1000000 + (uint64_t)now.tv_nsec / 1000;
+    record.header.length = (uint8_t)len;
+    record.header.type = type;
+    memcpy(record.data, data, len);
+    size = sizeof(record.header) + len;
+
+    pthread_mutex_lock(&capture_lock);
+    if (capture_fd >= 0 && write(capture_fd, &record, size) != (ssize_t)size) {
+        log(LOG_ERROR, "Failed to write capture file: %s", strerror(errno));
+        stats.capture_errors++;
+    }
+    pthread_mutex_unlock(&capture_lock);
+}
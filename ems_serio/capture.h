@@ -0,0 +1,26 @@
+#define CAPTURE_MAGIC "EMSCAP\0\0"
+#define CAPTURE_VERSION 1
+#define CAPTURE_PACKET 0 // Packet forwarded to the RX queue
+#define CAPTURE_MAC 1    // Bus token (poll, release or ACK)
+
+// Start of the capture file. All numbers are little endian.
+struct CAPTURE_HEADER {
+    char magic[8];
+    uint16_t version;
+    uint16_t record_header_size; // sizeof(struct CAPTURE_RECORD)
+    uint32_t reserved;
+};
+
+// Each record is this header followed by length bytes of data
+struct CAPTURE_RECORD {
+    uint64_t time; // us since the epoch
+    uint8_t length;
+    uint8_t type;
+    uint8_t reserved[6];
+};
+
+extern int capture_mac;
+
+int capture_open(char *path, int mac);
+void capture_close();
+void capture_packet(uint8_t *data, size_t len, uint8_t type);
@@ -1,4 +1,7 @@
 #define MAX_PACKET_SIZE 32
+// Text of a packet: "RX:", " xx" per character and the spaces after the header and before the CRC
+#define PACKET_TEXT_SIZE (3 + MAX_PACKET_SIZE * 3 + 2 + 1)
+#define RX_CHARS_SIZE 256
 #define SRCPOS 0
 #define DSTPOS 1
 #define HDR_LEN 4
@@ -9,6 +12,13 @@
 
 #define RX_QUEUE_NAME "/ems_bus_rx"
 #define TX_QUEUE_NAME "/ems_bus_tx"
+#define QUEUE_DEPTH 10      // Default number of messages of the RX and TX queues, the default
+                            // limit /proc/sys/fs/mqueue/msg_max of unprivileged processes
+#define QUEUE_DEPTH_MAX 1024
+
+#define RX_OVERFLOW_DROP_NEWEST 0 // Drop the received packet if the RX queue is full
+#define RX_OVERFLOW_DROP_OLDEST 1 // Drop the oldest packet in the RX queue
+#define RX_OVERFLOW_COALESCE 2    // Drop queued packets with the same data, else the oldest
 
 #define BREAK_IN "\xFF\x00\x00"
 #define BREAK_OUT "\x00"
@@ -16,6 +26,13 @@
 #define ACK_LEN 1
 #define ACK_VALUE 0x01
 #define MAX_BUS_TIME 200 * 1000
+// Time of one character on the bus at 9600 baud, 8N1, in us
+#define CHAR_TIME 1042
+// Time the MASTER_ID may take to echo a character on top of the transmission, in us
+#define ECHO_MARGIN 20000
+
+#define TX_MODE_BYTE 0  // Write a character and wait for its echo before writing the next
+#define TX_MODE_FRAME 1 // Write the whole packet at once and check the echoes afterwards
 
 #define LOG_ERROR 0x01   // Error messages
 #define LOG_INFO 0x02    // Informational messages on start and stop
@@ -24,6 +41,14 @@
 #define LOG_MAC 0x10     // Output sync (token) information
 #define LOG_CHAR 0x20    // Output single characters
 
+// Histograms count durations in HIST_BUCKETS buckets. Bucket 0 counts durations below the base,
+// bucket i below base * 2^i and the last bucket all longer ones.
+#define HIST_BUCKETS 10
+#define HIST_BASE_TX_BUS 1000       // Base of tx_bus_hist, in us
+#define HIST_BASE_POLL_INTERVAL 10000 // Base of poll_interval_hist, in us
+#define HIST_BASE_POLL_REPLY 100    // Base of poll_reply_hist, in us
+#define RX_SOURCES 128              // Bus addresses counted in rx_sources
+
 struct STATS {
     unsigned int rx_mac_errors;
     unsigned int rx_total;
@@ -34,6 +59,30 @@ struct STATS {
     unsigned int rx_crc;
     unsigned int tx_total;
     unsigned int tx_fail;
+    unsigned int rx_reads; // read() calls on the serial port
+    unsigned int rx_dropped; // Packets dropped on a full RX queue
+    unsigned int rx_dropped_oldest; // Queued packets dropped for newer ones on a full RX queue
+    unsigned int rx_coalesced; // Queued packets replaced by newer ones of the same data
+    unsigned int capture_errors; // Failed writes to the capture file
+    unsigned long long tx_bus_time; // Sum of the time to send a packet, in us
+    unsigned int tx_bus_time_max;   // Longest time to send a packet, in us
+    unsigned int tx_polls;           // Polls of our client ID
+    unsigned int tx_busy_polls;      // Polls in which at least one packet was sent
+    unsigned int tx_poll_max;        // Most packets sent in one poll
+    unsigned int tx_drain_time;      // Time to send the last backlog of the TX queue, in us
+    unsigned int tx_drain_time_max;  // Longest time to send a backlog of the TX queue, in us
+    unsigned int tx_retries;         // Packets sent again after a failure
+    unsigned int tx_dropped;         // Packets dropped after MAX_TX_RETRIES failures
+    unsigned int rx_queue_len;       // Packets in the RX queue or ring after the last one was added
+    unsigned int rx_queue_max;       // Most packets in the RX queue or ring
+    unsigned int tx_queue_len;       // Packets in the TX queue at the last poll
+    unsigned int tx_queue_max;       // Most packets in the TX queue at a poll
+    unsigned int poll_reply_max;     // Longest time from our poll to the first character sent, in us
+    unsigned int tx_bus_hist[HIST_BUCKETS];        // Time we occupied the bus per poll
+    unsigned int poll_interval_hist[HIST_BUCKETS]; // Time between two polls of our ID
+    unsigned int poll_reply_hist[HIST_BUCKETS];    // Time from our poll to the first character sent
+    unsigned int rx_sources[RX_SOURCES];           // Forwarded packets per source address
+    unsigned int log_dropped;        // Log records dropped on a full log ring
 };
 
 enum STATE { RELEASED, ASSIGNED, WROTE, READ };
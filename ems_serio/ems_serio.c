@@ -15,12 +15,17 @@
 #include <sys/stat.h>
 #include <string.h>
 #include <pthread.h>
+#include <sched.h>
 #include <signal.h>
+#include <sys/mman.h>
 
 #include "serial.h"
 #include "defines.h"
 #include "queue.h"
 #include "rx.h"
+#include "tx.h"
+#include "capture.h"
+#include "ring.h"
 
 #define handle_error_en(en, msg) do { errno = en; perror(msg); exit(EXIT_FAILURE); } while (0)
 
@@ -28,6 +33,30 @@ int waitingfor;
 struct STATS stats;
 pthread_t readloop = 0;
 int logging = 0;
+int rt_priority = 0; // SCHED_FIFO priority of the reader thread, 0 for the default policy
+int rt_cpu = -1;     // CPU the reader thread is pinned to, -1 for any
+int rt_mlock = 0;    // Lock the memory of the process while the driver runs
+
+// Counts a duration in us in a histogram with the bucket limits base, 2 * base, 4 * base, ...
+void hist_add(unsigned int *hist, unsigned int base, int64_t duration) {
+    unsigned int bucket = 0;
+    int64_t limit = base;
+
+    while (bucket < HIST_BUCKETS - 1 && duration >= limit) {
+        bucket++;
+        limit *= 2;
+    }
+    hist[bucket]++;
+}
+
+static void print_hist(char *name, unsigned int *hist, unsigned int base) {
+    char text[HIST_BUCKETS * 11 + 1];
+    int pos = 0;
+
+    for (int i = 0; i < HIST_BUCKETS; i++)
+        pos += sprintf(&text[pos], " %u", hist[i]);
+    logalways(LOG_INFO, "%-23s%s (from %u us)", name, text, base);
+}
 
 void print_stats() {
     if (!(logging & LOG_INFO))
@@ -41,26 +70,70 @@ void print_stats() {
     logalways(LOG_INFO, "RX CRC errors           %d", stats.rx_format);
     logalways(LOG_INFO, "TX total                %d", stats.tx_total);
     logalways(LOG_INFO, "TX failures             %d", stats.tx_fail);
+    logalways(LOG_INFO, "RX read() calls         %d", stats.rx_reads);
+    logalways(LOG_INFO, "RX queue full drops     %u", stats.rx_dropped);
+    logalways(LOG_INFO, "RX oldest drops         %u", stats.rx_dropped_oldest);
+    logalways(LOG_INFO, "RX coalesced            %u", stats.rx_coalesced);
+    logalways(LOG_INFO, "Capture write errors    %u", stats.capture_errors);
+    logalways(LOG_INFO, "TX bus time total       %llu us", stats.tx_bus_time);
+    logalways(LOG_INFO, "TX bus time maximum     %u us", stats.tx_bus_time_max);
+    logalways(LOG_INFO, "TX polls                %u", stats.tx_polls);
+    logalways(LOG_INFO, "TX polls with packets   %u", stats.tx_busy_polls);
+    logalways(LOG_INFO, "TX packets per poll max %u", stats.tx_poll_max);
+    logalways(LOG_INFO, "TX queue drain time     %u us", stats.tx_drain_time);
+    logalways(LOG_INFO, "TX queue drain time max %u us", stats.tx_drain_time_max);
+    logalways(LOG_INFO, "RX CRC errors           %u", stats.rx_crc);
+    logalways(LOG_INFO, "TX retries              %u", stats.tx_retries);
+    logalways(LOG_INFO, "TX dropped              %u", stats.tx_dropped);
+    logalways(LOG_INFO, "RX queue maximum        %u", stats.rx_queue_max);
+    logalways(LOG_INFO, "TX queue maximum        %u", stats.tx_queue_max);
+    logalways(LOG_INFO, "Poll reply time max     %u us", stats.poll_reply_max);
+    logalways(LOG_INFO, "Log records dropped     %u", stats.log_dropped);
+    print_hist("TX bus time per poll", stats.tx_bus_hist, HIST_BASE_TX_BUS);
+    print_hist("Poll interval", stats.poll_interval_hist, HIST_BASE_POLL_INTERVAL);
+    print_hist("Poll reply time", stats.poll_reply_hist, HIST_BASE_POLL_REPLY);
+    for (int i = 0; i < RX_SOURCES; i++) {
+        if (stats.rx_sources[i])
+            logalways(LOG_INFO, "RX from 0x%02x            %u", i, stats.rx_sources[i]);
+    }
+}
+
+// Writes the packet as hex to text, which has PACKET_TEXT_SIZE characters
+void format_packet(char *text, int out, const uint8_t *msg, size_t len) {
+    static const char hex[] = "0123456789abcdef";
+    char *pos = text;
+
+    memcpy(pos, out ? "TX:" : "RX:", 3);
+    pos += 3;
+    for (size_t i = 0; i < len && i < MAX_PACKET_SIZE; i++) {
+        *pos++ = ' ';
+        *pos++ = hex[msg[i] >> 4];
+        *pos++ = hex[msg[i] & 0x0f];
+        if (i == 3 || i == len - 2)
+            *pos++ = ' ';
+    }
+    *pos = '\0';
 }
 
 void print_packet(int out, int loglevel, uint8_t *msg, size_t len) {
     if (!(logging & loglevel))
         return;
-    char text[3 + MAX_PACKET_SIZE * 3 + 2 + 1];
-    int pos = 0;
-    pos += sprintf(&text[0], out ? "TX:" : "RX:");
-    for (size_t i = 0; i < len; i++) {
-        pos += sprintf(&text[pos], " %02hhx", msg[i]);
-        if (i == 3 || i == len - 2) {
-            pos += sprintf(&text[pos], " ");
-        }
-    }
+#ifdef PYTHON_MODULE
+    // Formatted by the Python thread which drains the log ring
+    ems_serio_log_packet(out, loglevel, msg, len);
+#else
+    char text[PACKET_TEXT_SIZE];
+    format_packet(text, out, msg, len);
     logalways(loglevel, "%s", text);
+#endif
 }
 
 void stop_handler() {
     close_queues();
+    ring_close();
     close_serial();
+    if (rt_mlock)
+        munlockall();
     readloop = 0;
 }
 
@@ -81,6 +154,8 @@ void *read_loop() {
 
     pthread_cleanup_push(stop_handler, NULL);
     log(LOG_INFO, "Starting EMS bus access");
+    log(LOG_VERBOSE, "Reader thread priority %d, CPU %d, memory locked %d", rt_priority, rt_cpu,
+        rt_mlock);
     while (1) {
         rx_packet(&abort);
         rx_done();
@@ -89,7 +164,61 @@ void *read_loop() {
     return NULL;
 }
 
-int start(char *port_path) {
+// Sets the scheduling of the reader thread for the next start(). With priority > 0, it runs under
+// SCHED_FIFO with this priority, with cpu >= 0 it is pinned to this CPU, and with mlock the memory
+// of the process is locked, so a page fault does not delay the reply to a poll. Returns 0 on
+// success.
+int setup_realtime(int priority, int cpu, int mlock) {
+    if (priority < 0 || priority > sched_get_priority_max(SCHED_FIFO)) {
+        log(LOG_ERROR, "SCHED_FIFO priority must be 1 to %d, or 0 for the default scheduling",
+            sched_get_priority_max(SCHED_FIFO));
+        return(-1);
+    }
+    if (cpu >= CPU_SETSIZE || cpu >= sysconf(_SC_NPROCESSORS_CONF)) {
+        log(LOG_ERROR, "CPU %d does not exist", cpu);
+        return(-1);
+    }
+    rt_priority = priority;
+    rt_cpu = cpu < 0 ? -1 : cpu;
+    rt_mlock = mlock;
+    return(0);
+}
+
+// Creates the reader thread with the scheduling of setup_realtime()
+static int start_thread() {
+    pthread_attr_t attr;
+    struct sched_param param;
+    cpu_set_t cpus;
+    int ret;
+
+    pthread_attr_init(&attr);
+    if (rt_priority > 0) {
+        param.sched_priority = rt_priority;
+        pthread_attr_setinheritsched(&attr, PTHREAD_EXPLICIT_SCHED);
+        pthread_attr_setschedpolicy(&attr, SCHED_FIFO);
+        pthread_attr_setschedparam(&attr, &param);
+    }
+    if (rt_cpu >= 0) {
+        CPU_ZERO(&cpus);
+        CPU_SET(rt_cpu, &cpus);
+        pthread_attr_setaffinity_np(&attr, sizeof(cpus), &cpus);
+    }
+    ret = pthread_create(&readloop, &attr, &read_loop, NULL);
+    pthread_attr_destroy(&attr);
+    if (ret == EPERM || ret == EINVAL) {
+        // SCHED_FIFO needs CAP_SYS_NICE or RLIMIT_RTPRIO, the CPU must be in our affinity mask.
+        log(LOG_ERROR, "Failed to start the reader thread with priority %d on CPU %d: %s",
+            rt_priority, rt_cpu, strerror(ret));
+        return(-1);
+    }
+    if (ret != 0)
+        handle_error_en(ret, "pthread_create");
+    return(0);
+}
+
+// Starts the driver. With ring_slots > 0, received packets are passed in a shared memory ring
+// instead of the RX queue.
+int start(char *port_path, unsigned int ring_slots) {
     int ret;
 
     ret = open_serial(port_path);
@@ -102,20 +231,33 @@ int start(char *port_path) {
     setup_queue(&tx_queue, TX_QUEUE_NAME);
     if (tx_queue == -1) {
         log(LOG_ERROR, "Failed to open TX message queue: %i %s", tx_queue, strerror(errno));
-        return(-1);
+        goto fail;
     }
     setup_queue(&rx_queue, RX_QUEUE_NAME);
     if (rx_queue == -1) {
         log(LOG_ERROR, "Failed to open RX message queue: %i %s", rx_queue, strerror(errno));
-        return(-1);
+        goto fail;
     }
     log(LOG_VERBOSE, "Connected to message queues");
+    if (ring_slots > 0 && ring_open(ring_slots) != 0)
+        goto fail;
 
-    ret = pthread_create(&readloop, NULL, &read_loop, NULL);
-    if (ret != 0)
-        handle_error_en(ret, "pthread_create");
+    // Locked after the other setup, so only the reader thread can fail with the memory locked.
+    // MCL_FUTURE also locks the stack of the reader thread when it is created.
+    if (rt_mlock && mlockall(MCL_CURRENT | MCL_FUTURE) != 0) {
+        log(LOG_ERROR, "Failed to lock the memory, check RLIMIT_MEMLOCK: %s", strerror(errno));
+        goto fail;
+    }
+
+    if (start_thread() != 0)
+        goto fail;
 
     return(0);
+
+fail:
+    // Closes what was opened and unlocks the memory
+    stop_handler();
+    return(-1);
 }
 
 int stop() {
@@ -129,17 +271,28 @@ void sig_stop() {
     stop();
 }
 
+#ifndef NO_MAIN
 int main(int argc, char *argv[]) {
     int ret;
     struct sigaction signal_action;
 
     if (argc < 2) {
-        fprintf(stderr, "Usage: %s [ttypath] [logmask]\n", argv[0]);
+        fprintf(stderr, "Usage: %s [ttypath] [logmask] [txmode] [capture file] [queue depth] "
+                "[RX overflow policy] [SCHED_FIFO priority] [CPU] [mlock]\n", argv[0]);
         return(0);
     }
 
     logging = atoi(argv[2]);
-    ret = start(argv[1]);
+    if (argc > 3)
+        tx_mode = atoi(argv[3]);
+    if (argc > 4 && argv[4][0] != '\0' && capture_open(argv[4], 1) != 0)
+        return(1);
+    if (argc > 5 && setup_queue_policy(atol(argv[5]), argc > 6 ? atoi(argv[6]) : rx_overflow))
+        return(1);
+    if (argc > 7 && setup_realtime(atoi(argv[7]), argc > 8 ? atoi(argv[8]) : -1,
+                                   argc > 9 && atoi(argv[9])))
+        return(1);
+    ret = start(argv[1], 0);
 
     // Set signal handler and wait for the thread
     signal_action.sa_handler = sig_stop;
@@ -150,7 +303,9 @@ int main(int argc, char *argv[]) {
     sigaction(SIGTERM, &signal_action, NULL);
 
     pthread_join(readloop, NULL);
+    capture_close();
     print_stats();
 
     return(ret);
 }
+#endif
@@ -6,6 +6,13 @@ extern struct STATS stats;
 extern int logging;
 extern pthread_t readloop;
 
-int start(char *);
+extern int rt_priority;
+extern int rt_cpu;
+extern int rt_mlock;
+
+int setup_realtime(int, int, int);
+int start(char *, unsigned int);
 int stop();
+void format_packet(char *, int, const uint8_t *, size_t);
 void print_packet(int, int, uint8_t *, size_t len);
+void hist_add(unsigned int *, unsigned int, int64_t);
@@ -0,0 +1,105 @@
+#define _GNU_SOURCE 1
+
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <errno.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/eventfd.h>
+
+#include "ems_serio.h"
+#include "logring.h"
+
+// Lock-free ring of log records. The bus thread adds records without taking the GIL, a Python
+// thread drains them into the logger. Any thread may add records (bounded MPSC queue after
+// Dmitry Vyukov): a writer claims position pos by incrementing head, and publishes the record by
+// setting its seq to pos + 1. The reader takes the record at tail once its seq is tail + 1 and
+// frees it for position tail + LOG_RING_SIZE. If the ring is full, the record is dropped and
+// counted in stats.log_dropped.
+
+static struct LOG_RECORD records[LOG_RING_SIZE];
+static _Atomic uint64_t head;
+static uint64_t tail;
+// Set by the reader before it sleeps, the next writer wakes it up with log_event.
+static _Atomic int waiting = 1;
+int log_event = -1;
+
+int log_ring_init() {
+    for (uint32_t i = 0; i < LOG_RING_SIZE; i++)
+        atomic_store(&records[i].seq, i);
+    log_event = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    return(log_event < 0 ? -1 : 0);
+}
+
+// Adds a record with len bytes of text. Returns -1 if the ring is full.
+int log_ring_put(int level, int kind, const char *text, size_t len) {
+    uint64_t pos = atomic_load_explicit(&head, memory_order_relaxed);
+    struct LOG_RECORD *record;
+    struct timespec now;
+    uint64_t one = 1;
+
+    while (1) {
+        record = &records[pos % LOG_RING_SIZE];
+        int32_t diff = (int32_t)(atomic_load_explicit(&record->seq, memory_order_acquire) -
+                                 (uint32_t)pos);
+        if (diff == 0) {
+            if (atomic_compare_exchange_weak_explicit(&head, &pos, pos + 1, memory_order_relaxed,
+                                                      memory_order_relaxed))
+                break;
+        } else if (diff < 0) {
+            stats.log_dropped++;
+            return(-1);
+        } else {
+            pos = atomic_load_explicit(&head, memory_order_relaxed);
+        }
+    }
+
+    clock_gettime(CLOCK_REALTIME, &now);
+    record->time_ns = (int64_t)now.tv_sec * 1000000000 + now.tv_nsec;
+    record->level = (uint8_t)level;
+    record->kind = (uint8_t)kind;
+    if (len > LOG_TEXT_SIZE)
+        len = LOG_TEXT_SIZE;
+    record->length = (uint8_t)len;
+    memcpy(record->text, text, len);
+    atomic_store_explicit(&record->seq, (uint32_t)(pos + 1), memory_order_release);
+
+    // Wake up the reader once per batch. With the fences, either the reader sees the record when
+    // it checks after setting waiting, or we see waiting.
+    atomic_thread_fence(memory_order_seq_cst);
+    if (atomic_exchange(&waiting, 0) && write(log_event, &one, sizeof(one)) != sizeof(one))
+        atomic_store(&waiting, 1);
+    return(0);
+}
+
+// Copies the oldest record to record and frees it. Returns 0 if the ring is empty. Only one
+// thread may read at a time.
+int log_ring_get(struct LOG_RECORD *record) {
+    struct LOG_RECORD *slot = &records[tail % LOG_RING_SIZE];
+
+    if (atomic_load_explicit(&slot->seq, memory_order_acquire) != (uint32_t)(tail + 1))
+        return(0);
+    record->level = slot->level;
+    record->kind = slot->kind;
+    record->length = slot->length;
+    record->time_ns = slot->time_ns;
+    memcpy(record->text, slot->text, slot->length);
+    atomic_store_explicit(&slot->seq, (uint32_t)(tail + LOG_RING_SIZE), memory_order_release);
+    tail++;
+    return(1);
+}
+
+// Resets log_event and asks the writers to signal the next record. Returns 1 if records were
+// added meanwhile, then the reader drains the ring again instead of waiting.
+int log_ring_wait() {
+    uint64_t count;
+
+    // Fails with EAGAIN if no writer signalled
+    if (read(log_event, &count, sizeof(count)) < 0)
+        count = 0;
+    atomic_store(&waiting, 1);
+    atomic_thread_fence(memory_order_seq_cst);
+    return(atomic_load_explicit(&records[tail % LOG_RING_SIZE].seq, memory_order_acquire) ==
+           (uint32_t)(tail + 1));
+}
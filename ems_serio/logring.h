@@ -0,0 +1,26 @@
+#include <stdint.h>
+#include <stdatomic.h>
+
+#define LOG_RING_SIZE 256 // Records, a power of 2
+#define LOG_TEXT_SIZE 128
+
+#define LOG_KIND_TEXT 0   // text is the message
+#define LOG_KIND_RX 1     // text holds the bytes of a received packet
+#define LOG_KIND_TX 2     // text holds the bytes of a sent packet
+
+// A log record of a thread without the GIL
+struct LOG_RECORD {
+    _Atomic uint32_t seq;
+    uint8_t level;
+    uint8_t kind;
+    uint8_t length;
+    int64_t time_ns; // CLOCK_REALTIME
+    char text[LOG_TEXT_SIZE];
+};
+
+extern int log_event;
+
+int log_ring_init();
+int log_ring_put(int level, int kind, const char *text, size_t len);
+int log_ring_get(struct LOG_RECORD *record);
+int log_ring_wait();
@@ -1,24 +1,63 @@
 #include <Python.h>
+#include <stddef.h>
 
 #include "ems_serio.h"
+#include "tx.h"
+#include "capture.h"
+#include "ring.h"
+#include "queue.h"
+#include "logring.h"
 
 static PyObject *py_logger;
+static unsigned int log_dropped_reported;
 
-static PyObject *ems_serio_start(PyObject *self, PyObject *args) {
+static PyObject *ems_serio_start(PyObject *self, PyObject *args, PyObject *kwargs) {
+    static char *keywords[] = {"serial_path", "tx_mode", "ring_slots", "queue_depth",
+                               "rx_overflow", "rt_priority", "cpu", "mlock", NULL};
     char *serial_path;
+    unsigned int ring_slots = 0;
+    long depth = QUEUE_DEPTH;
+    int overflow = RX_OVERFLOW_DROP_NEWEST;
+    int priority = 0;
+    int cpu = -1;
+    int mlock = 0;
     int res;
 
-    if (!PyArg_ParseTuple(args, "s", &serial_path)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s|iIliiip", keywords, &serial_path, &tx_mode,
+                                     &ring_slots, &depth, &overflow, &priority, &cpu, &mlock)) {
+        res = -1;
+        goto end;
+    }
+    if (setup_queue_policy(depth, overflow) != 0 || setup_realtime(priority, cpu, mlock) != 0) {
         res = -1;
         goto end;
     }
 
-    res = start(serial_path);
+    res = start(serial_path, ring_slots);
 
 end:
     return(PyLong_FromLong(res));
 }
 
+static PyObject *ems_serio_capture(PyObject *self, PyObject *args, PyObject *kwargs) {
+    static char *keywords[] = {"path", "mac", NULL};
+    char *path = NULL;
+    int mac = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "z|p", keywords, &path, &mac)) {
+        return(NULL);
+    }
+    if (path == NULL) {
+        capture_close();
+        return(PyLong_FromLong(0));
+    }
+    return(PyLong_FromLong(capture_open(path, mac)));
+}
+
+static PyObject *ems_serio_ring_fd(PyObject *self, PyObject *args) {
+    return(PyLong_FromLong(ring_event));
+}
+
 static PyObject *ems_serio_stop(PyObject *self, PyObject *args) {
     int res = stop();
 
@@ -33,38 +72,234 @@ typedef enum {
     ERROR = 40,
     CRITICAL = 50,
 } logging_level_e;
+static int py_level(int level) {
+    return(level & LOG_ERROR ? ERROR : (level & LOG_INFO ? INFO : DEBUG));
+}
+
+// Passes a message to the logger. Needs the GIL.
+static void log_message(int level, const char *msg, int64_t time_ns) {
+    PyObject *record;
+    PyObject *res;
+
+    res = PyObject_CallMethod(py_logger, "isEnabledFor", "i", level);
+    if (res == NULL || !PyObject_IsTrue(res))
+        goto end;
+    Py_DECREF(res);
+    record = PyObject_CallMethod(py_logger, "makeRecord", "sisisOO", "ems_serio", level,
+                                 "ems_serio", 0, msg, Py_None, Py_None);
+    if (record == NULL)
+        goto error;
+    if (time_ns != 0) {
+        // Time of the event, not of draining the log ring
+        double created = (double)time_ns / 1e9;
+        PyObject *value = PyFloat_FromDouble(created);
+        if (value == NULL || PyObject_SetAttrString(record, "created", value) != 0) {
+            Py_XDECREF(value);
+            Py_DECREF(record);
+            goto error;
+        }
+        Py_DECREF(value);
+        value = PyFloat_FromDouble((double)(time_ns % 1000000000) / 1e6);
+        if (value == NULL || PyObject_SetAttrString(record, "msecs", value) != 0) {
+            Py_XDECREF(value);
+            Py_DECREF(record);
+            goto error;
+        }
+        Py_DECREF(value);
+    }
+    res = PyObject_CallMethod(py_logger, "handle", "O", record);
+    Py_DECREF(record);
+end:
+    Py_XDECREF(res);
+error:
+    // The logging module reports errors of handlers itself. Do not raise from a function which
+    // did not fail.
+    PyErr_Clear();
+}
+
+// Logs a message. The thread holding the GIL logs directly. The bus thread never takes the GIL,
+// it adds the message to the log ring, and log_drain() logs it later.
 void ems_serio_log(int level, char* fmt, ...) {
-    char msg[128];
-    // https://gist.github.com/machinaut/f35ffea92a16c2b44cff4e9ac55678af
-    PyGILState_STATE state = PyGILState_Ensure();
-    int py_level = level & LOG_ERROR ? ERROR : (level & LOG_INFO ? INFO : DEBUG);
+    char msg[LOG_TEXT_SIZE];
+    int len;
 
     va_list(args);
     va_start(args, fmt);
-    vsnprintf(msg, sizeof(msg), fmt, args);
+    len = vsnprintf(msg, sizeof(msg), fmt, args);
     va_end(args);
+    if (len < 0)
+        return;
+
+    if (PyGILState_Check())
+        log_message(py_level(level), msg, 0);
+    else
+        log_ring_put(level, LOG_KIND_TEXT, msg, (size_t)len + 1);
+}
+
+// Logs a packet, which log_drain() formats if it comes from the bus thread
+void ems_serio_log_packet(int out, int level, uint8_t *msg, size_t len) {
+    char text[PACKET_TEXT_SIZE];
+
+    if (PyGILState_Check()) {
+        format_packet(text, out, msg, len);
+        log_message(py_level(level), text, 0);
+    } else {
+        log_ring_put(level, out ? LOG_KIND_TX : LOG_KIND_RX, (const char *)msg, len);
+    }
+}
+
+static PyObject *ems_serio_log_fd(PyObject *self, PyObject *args) {
+    return(PyLong_FromLong(log_event));
+}
+
+static PyObject *ems_serio_log_drain(PyObject *self, PyObject *args) {
+    struct LOG_RECORD record;
+    char text[PACKET_TEXT_SIZE];
+    long count = 0;
+
+    do {
+        while (log_ring_get(&record)) {
+            if (record.kind == LOG_KIND_TEXT) {
+                record.text[LOG_TEXT_SIZE - 1] = '\0';
+                log_message(py_level(record.level), record.text, record.time_ns);
+            } else {
+                format_packet(text, record.kind == LOG_KIND_TX, (uint8_t *)record.text,
+                              record.length);
+                log_message(py_level(record.level), text, record.time_ns);
+            }
+            count++;
+        }
+    } while (log_ring_wait());
+
+    if (stats.log_dropped != log_dropped_reported) {
+        unsigned int dropped = stats.log_dropped;
+        char msg[64];
+        snprintf(msg, sizeof(msg), "Log ring full, dropped %u records",
+                 dropped - log_dropped_reported);
+        log_message(WARNING, msg, 0);
+        log_dropped_reported = dropped;
+    }
+    return(PyLong_FromLong(count));
+}
+
+// Layout of struct STATS, exported as STATS_LAYOUT for readers of stats_view()
+struct STAT_FIELD {
+    const char *name;
+    size_t offset;
+    const char *format; // struct module format of one item
+    int count;
+};
+#define STAT(member, name, format, count) {name, offsetof(struct STATS, member), format, count}
+static const struct STAT_FIELD stat_fields[] = {
+    STAT(rx_mac_errors, "rx_sync_errors", "I", 1),
+    STAT(rx_total, "rx_total", "I", 1),
+    STAT(rx_success, "rx_success", "I", 1),
+    STAT(rx_short, "rx_short", "I", 1),
+    STAT(rx_sender, "rx_sender", "I", 1),
+    STAT(rx_format, "rx_format", "I", 1),
+    STAT(rx_crc, "rx_crc", "I", 1),
+    STAT(tx_total, "tx_total", "I", 1),
+    STAT(tx_fail, "tx_fail", "I", 1),
+    STAT(rx_reads, "rx_reads", "I", 1),
+    STAT(rx_dropped, "rx_dropped", "I", 1),
+    STAT(rx_dropped_oldest, "rx_dropped_oldest", "I", 1),
+    STAT(rx_coalesced, "rx_coalesced", "I", 1),
+    STAT(capture_errors, "capture_errors", "I", 1),
+    STAT(tx_bus_time, "tx_bus_time", "Q", 1),
+    STAT(tx_bus_time_max, "tx_bus_time_max", "I", 1),
+    STAT(tx_polls, "tx_polls", "I", 1),
+    STAT(tx_busy_polls, "tx_busy_polls", "I", 1),
+    STAT(tx_poll_max, "tx_poll_max", "I", 1),
+    STAT(tx_drain_time, "tx_drain_time", "I", 1),
+    STAT(tx_drain_time_max, "tx_drain_time_max", "I", 1),
+    STAT(tx_retries, "tx_retries", "I", 1),
+    STAT(tx_dropped, "tx_dropped", "I", 1),
+    STAT(rx_queue_len, "rx_queue_len", "I", 1),
+    STAT(rx_queue_max, "rx_queue_max", "I", 1),
+    STAT(tx_queue_len, "tx_queue_len", "I", 1),
+    STAT(tx_queue_max, "tx_queue_max", "I", 1),
+    STAT(poll_reply_max, "poll_reply_max", "I", 1),
+    STAT(tx_bus_hist, "tx_bus_hist", "I", HIST_BUCKETS),
+    STAT(poll_interval_hist, "poll_interval_hist", "I", HIST_BUCKETS),
+    STAT(poll_reply_hist, "poll_reply_hist", "I", HIST_BUCKETS),
+    STAT(rx_sources, "rx_sources", "I", RX_SOURCES),
+    STAT(log_dropped, "log_dropped", "I", 1),
+};
+#define STAT_FIELDS (sizeof(stat_fields) / sizeof(stat_fields[0]))
 
-    PyObject_CallMethod(py_logger, "log", "is", py_level, msg);
+static PyObject *stat_value(const char *format, const char *data) {
+    if (format[0] == 'Q')
+        return(PyLong_FromUnsignedLongLong(*(const unsigned long long *)(const void *)data));
+    return(PyLong_FromUnsignedLong(*(const unsigned int *)(const void *)data));
+}
+
+// Sets a dict item, releasing the value
+static int set_item(PyObject *dict, const char *key, PyObject *value) {
+    int res;
 
-    PyGILState_Release(state);
+    if (value == NULL)
+        return(-1);
+    res = PyDict_SetItemString(dict, key, value);
+    Py_DECREF(value);
+    return(res);
 }
 
-static PyObject *ems_serio_stats() {
+static PyObject *ems_serio_stats(PyObject *self, PyObject *args) {
     PyObject *dict;
+    PyObject *value;
+    const struct STAT_FIELD *field;
+    const char *data;
 
-    // Todo: Check if this is a memory leak and Py_DECREF must be used.
     dict = PyDict_New();
-    PyDict_SetItemString(dict, "rx_sync_errors", PyLong_FromUnsignedLong(stats.rx_mac_errors));
-    PyDict_SetItemString(dict, "rx_total", PyLong_FromUnsignedLong(stats.rx_total));
-    PyDict_SetItemString(dict, "rx_success", PyLong_FromUnsignedLong(stats.rx_success));
-    PyDict_SetItemString(dict, "rx_short", PyLong_FromUnsignedLong(stats.rx_short));
-    PyDict_SetItemString(dict, "rx_sender", PyLong_FromUnsignedLong(stats.rx_sender));
-    PyDict_SetItemString(dict, "rx_format", PyLong_FromUnsignedLong(stats.rx_format));
-    PyDict_SetItemString(dict, "tx_total", PyLong_FromUnsignedLong(stats.tx_total));
-    PyDict_SetItemString(dict, "tx_fail", PyLong_FromUnsignedLong(stats.tx_fail));
-    PyDict_SetItemString(dict, "logging", PyLong_FromUnsignedLong(logging));
-    PyDict_SetItemString(dict, "running", PyLong_FromUnsignedLong(!!readloop));
+    if (dict == NULL)
+        return(NULL);
+    for (field = stat_fields; field < stat_fields + STAT_FIELDS; field++) {
+        data = (const char *)&stats + field->offset;
+        if (field->count == 1) {
+            value = stat_value(field->format, data);
+        } else {
+            // Arrays are tuples. All of them have unsigned int items.
+            value = PyTuple_New(field->count);
+            for (int i = 0; value != NULL && i < field->count; i++) {
+                PyObject *item = stat_value(field->format, data + i * sizeof(unsigned int));
+                if (item == NULL)
+                    Py_CLEAR(value);
+                else
+                    PyTuple_SET_ITEM(value, i, item);
+            }
+        }
+        if (set_item(dict, field->name, value) != 0)
+            goto error;
+    }
+    if (set_item(dict, "logging", PyLong_FromUnsignedLong(logging)) != 0 ||
+            set_item(dict, "running", PyLong_FromUnsignedLong(!!readloop)) != 0)
+        goto error;
     return(dict);
+
+error:
+    Py_DECREF(dict);
+    return(NULL);
+}
+
+// Returns a read-only memoryview of the statistics. It stays valid and always shows the
+// current values, so a monitoring loop creates it once.
+static PyObject *ems_serio_stats_view(PyObject *self, PyObject *args) {
+    return(PyMemoryView_FromMemory((char *)&stats, sizeof(stats), PyBUF_READ));
+}
+
+static PyObject *stats_layout() {
+    PyObject *layout = PyTuple_New(STAT_FIELDS);
+
+    for (size_t i = 0; layout != NULL && i < STAT_FIELDS; i++) {
+        const struct STAT_FIELD *field = &stat_fields[i];
+        PyObject *item = Py_BuildValue("(snsi)", field->name, (Py_ssize_t)field->offset,
+                                       field->format, field->count);
+        if (item == NULL)
+            Py_CLEAR(layout);
+        else
+            PyTuple_SET_ITEM(layout, i, item);
+    }
+    return(layout);
 }
 
 static PyObject *ems_serio_loglevel(PyObject *self, PyObject *args) {
@@ -90,10 +325,21 @@ static PyObject *ems_serio_loglevel(PyObject *self, PyObject *args) {
 
 
 static PyMethodDef module_methods[] = {
-    {"start", ems_serio_start, METH_VARARGS, "Starts the EMS serial bus driver"},
+    {"start", (PyCFunction)(void(*)(void))ems_serio_start, METH_VARARGS | METH_KEYWORDS,
+     "Starts the EMS serial bus driver"},
     {"stop", ems_serio_stop, METH_VARARGS, "Stops the EMS serial bus driver"},
-    {"stats", ems_serio_stats, METH_VARARGS, "Returns a dict of bus statistics"},
+    {"capture", (PyCFunction)(void(*)(void))ems_serio_capture, METH_VARARGS | METH_KEYWORDS,
+     "Records the received packets to a file, or stops recording if the path is None"},
+    {"ring_fd", ems_serio_ring_fd, METH_NOARGS,
+     "Returns the eventfd signalling packets in the RX ring, -1 if the ring is not used"},
+    {"stats", ems_serio_stats, METH_NOARGS, "Returns a dict of bus statistics"},
+    {"stats_view", ems_serio_stats_view, METH_NOARGS,
+     "Returns a read-only memoryview of the bus statistics, see STATS_LAYOUT"},
     {"loglevel", ems_serio_loglevel, METH_VARARGS, "Sets the internal log level"},
+    {"log_fd", ems_serio_log_fd, METH_NOARGS,
+     "Returns the eventfd signalling records of the bus thread to log_drain()"},
+    {"log_drain", ems_serio_log_drain, METH_NOARGS,
+     "Passes the log records of the bus thread to the logger, returns their number"},
     {NULL, NULL, 0, NULL}
 };
 static struct PyModuleDef ems_serio = {
@@ -123,6 +369,11 @@ PyMODINIT_FUNC PyInit_ems_serio(void) {
         goto abort;
     }
 
+    if (log_ring_init() != 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        goto abort;
+    }
+
     if (PyModule_AddStringConstant(module, "version", "1.0.0") ||
             PyModule_AddIntConstant(module, "LOG_ERROR", LOG_ERROR) ||
             PyModule_AddIntConstant(module, "LOG_INFO", LOG_INFO) ||
@@ -130,7 +381,20 @@ PyMODINIT_FUNC PyInit_ems_serio(void) {
             PyModule_AddIntConstant(module, "LOG_PACKET", LOG_PACKET) ||
             PyModule_AddIntConstant(module, "LOG_MAC", LOG_MAC) ||
             PyModule_AddIntConstant(module, "LOG_ERROR", LOG_ERROR) ||
-            PyModule_AddIntConstant(module, "LOG_CHAR", LOG_CHAR)) {
+            PyModule_AddIntConstant(module, "LOG_CHAR", LOG_CHAR) ||
+            PyModule_AddIntConstant(module, "TX_MODE_BYTE", TX_MODE_BYTE) ||
+            PyModule_AddIntConstant(module, "TX_MODE_FRAME", TX_MODE_FRAME) ||
+            PyModule_AddStringConstant(module, "RING_NAME", RING_NAME) ||
+            PyModule_AddIntConstant(module, "RING_SLOTS", RING_SLOTS) ||
+            PyModule_AddIntConstant(module, "QUEUE_DEPTH", QUEUE_DEPTH) ||
+            PyModule_AddIntConstant(module, "RX_OVERFLOW_DROP_NEWEST", RX_OVERFLOW_DROP_NEWEST) ||
+            PyModule_AddIntConstant(module, "RX_OVERFLOW_DROP_OLDEST", RX_OVERFLOW_DROP_OLDEST) ||
+            PyModule_AddIntConstant(module, "RX_OVERFLOW_COALESCE", RX_OVERFLOW_COALESCE) ||
+            PyModule_AddIntConstant(module, "HIST_BUCKETS", HIST_BUCKETS) ||
+            PyModule_AddIntConstant(module, "HIST_BASE_TX_BUS", HIST_BASE_TX_BUS) ||
+            PyModule_AddIntConstant(module, "HIST_BASE_POLL_INTERVAL", HIST_BASE_POLL_INTERVAL) ||
+            PyModule_AddIntConstant(module, "HIST_BASE_POLL_REPLY", HIST_BASE_POLL_REPLY) ||
+            PyModule_AddObject(module, "STATS_LAYOUT", stats_layout())) {
         goto abort;
     }
 
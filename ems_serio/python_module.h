@@ -1 +1,5 @@
-void ems_serio_log(int level, char* fmt, ...);
\ No newline at end of file
+#include <stdint.h>
+#include <stddef.h>
+
+void ems_serio_log(int level, char* fmt, ...);
+void ems_serio_log_packet(int out, int level, uint8_t *msg, size_t len);
\ No newline at end of file
@@ -1,18 +1,146 @@
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <errno.h>
 #include <mqueue.h>
 
-#include "defines.h"
+#include "ems_serio.h"
+#include "queue.h"
 
-mqd_t tx_queue;
-mqd_t rx_queue;
+mqd_t tx_queue = -1;
+mqd_t rx_queue = -1;
+long queue_depth = QUEUE_DEPTH;
+int rx_overflow = RX_OVERFLOW_DROP_NEWEST;
 
+// Packets taken from the full RX queue when coalescing
+static uint8_t pending[QUEUE_DEPTH_MAX][MAX_PACKET_SIZE];
+static ssize_t pending_len[QUEUE_DEPTH_MAX];
+
+// Opens or creates a queue with queue_depth messages. A queue left with another depth by an
+// earlier run is recreated, as the depth cannot be changed once the queue exists.
 void setup_queue(mqd_t *queue, char *name) {
     struct mq_attr queue_attr;
-    queue_attr.mq_maxmsg = 32;
+
+    *queue = mq_open(name, O_RDWR | O_NONBLOCK);
+    if (*queue != -1) {
+        if (mq_getattr(*queue, &queue_attr) == 0 && queue_attr.mq_maxmsg == queue_depth &&
+                queue_attr.mq_msgsize == MAX_PACKET_SIZE)
+            return;
+        log(LOG_INFO, "Recreating queue %s with %ld messages", name, queue_depth);
+        mq_close(*queue);
+        mq_unlink(name);
+    }
+
+    queue_attr.mq_maxmsg = queue_depth;
     queue_attr.mq_msgsize = MAX_PACKET_SIZE;
     *queue = mq_open(name, O_RDWR | O_NONBLOCK | O_CREAT, 0666, &queue_attr);
+    if (*queue == -1 && errno == EINVAL) {
+        log(LOG_ERROR, "Queue depth %ld exceeds /proc/sys/fs/mqueue/msg_max", queue_depth);
+        // Logging may change errno, the caller reports it.
+        errno = EINVAL;
+    }
+}
+
+// Sets the depth of the queues and the policy on a full RX queue. Call before start().
+int setup_queue_policy(long depth, int overflow) {
+    if (depth < 1 || depth > QUEUE_DEPTH_MAX) {
+        log(LOG_ERROR, "Queue depth must be 1 to %d", QUEUE_DEPTH_MAX);
+        return(-1);
+    }
+    if (overflow < RX_OVERFLOW_DROP_NEWEST || overflow > RX_OVERFLOW_COALESCE) {
+        log(LOG_ERROR, "Unknown RX overflow policy %d", overflow);
+        return(-1);
+    }
+    queue_depth = depth;
+    rx_overflow = overflow;
+    return(0);
+}
+
+// Returns if two packets update the same data: same source, type, offset and length.
+// The length is part of the key so a shorter update never hides data of a longer one.
+static int same_update(uint8_t *a, size_t a_len, uint8_t *b, size_t b_len) {
+    return(a_len == b_len && a_len > HDR_LEN && a[SRCPOS] == b[SRCPOS] && a[2] == b[2] &&
+           a[3] == b[3]);
+}
+
+// Drops the oldest packet of the RX queue. Returns -1 if the queue was empty.
+static int drop_oldest() {
+    uint8_t buf[MAX_PACKET_SIZE];
+
+    if (mq_receive(rx_queue, (char *)buf, MAX_PACKET_SIZE, NULL) == -1)
+        return(-1);
+    stats.rx_dropped_oldest++;
+    return(0);
+}
+
+// Takes all packets from the RX queue, drops the ones updating the same data as the new packet
+// and queues the others again in their order. Returns the number of dropped packets.
+static int coalesce(uint8_t *msg, size_t len) {
+    long count = 0;
+    long i;
+    int dropped = 0;
+
+    // The reader may take packets at the same time. It only gets packets before the ones
+    // queued again, so the order is kept.
+    while (count < queue_depth) {
+        pending_len[count] = mq_receive(rx_queue, (char *)pending[count], MAX_PACKET_SIZE, NULL);
+        if (pending_len[count] == -1)
+            break;
+        count++;
+    }
+    for (i = 0; i < count; i++) {
+        if (same_update(pending[i], (size_t)pending_len[i], msg, len)) {
+            dropped++;
+            continue;
+        }
+        if (mq_send(rx_queue, (char *)pending[i], (size_t)pending_len[i], 0) == -1)
+            stats.rx_dropped_oldest++;
+    }
+    stats.rx_coalesced += dropped;
+    return(dropped);
+}
+
+// Records the number of messages in a queue and its maximum
+void queue_stats(mqd_t queue, unsigned int *len, unsigned int *max) {
+    struct mq_attr queue_attr;
+
+    if (mq_getattr(queue, &queue_attr) != 0)
+        return;
+    *len = (unsigned int)queue_attr.mq_curmsgs;
+    if (*len > *max)
+        *max = *len;
+}
+
+// Adds a received packet to the RX queue. On a full queue, the packet is handled by the
+// rx_overflow policy. Returns -1 if the packet was dropped.
+int queue_rx_send(uint8_t *msg, size_t len) {
+    if (mq_send(rx_queue, (char *)msg, len, 0) == 0) {
+        queue_stats(rx_queue, &stats.rx_queue_len, &stats.rx_queue_max);
+        return(0);
+    }
+    if (errno != EAGAIN) {
+        log(LOG_ERROR, "RX: Could not add packet to queue: %s", strerror(errno));
+        return(-1);
+    }
+
+    // The queue is full
+    if (rx_overflow == RX_OVERFLOW_COALESCE && coalesce(msg, len) == 0)
+        drop_oldest();
+    else if (rx_overflow == RX_OVERFLOW_DROP_OLDEST)
+        drop_oldest();
+    if (rx_overflow == RX_OVERFLOW_DROP_NEWEST || mq_send(rx_queue, (char *)msg, len, 0) == -1) {
+        stats.rx_dropped++;
+        log(LOG_ERROR, "RX: Could not add packet to queue, it is full");
+        return(-1);
+    }
+    return(0);
 }
 
+// Closes the queues opened by setup_queue(), also after a failed start()
 void close_queues() {
-    mq_close(rx_queue);
-    mq_close(tx_queue);
+    if (rx_queue != -1)
+        mq_close(rx_queue);
+    if (tx_queue != -1)
+        mq_close(tx_queue);
+    rx_queue = tx_queue = -1;
 }
@@ -1,7 +1,13 @@
+#include <stdint.h>
 #include <mqueue.h>
 
 extern mqd_t rx_queue;
 extern mqd_t tx_queue;
+extern long queue_depth;
+extern int rx_overflow;
 
 void setup_queue(mqd_t *, char *);
+int setup_queue_policy(long, int);
+int queue_rx_send(uint8_t *, size_t);
+void queue_stats(mqd_t, unsigned int *, unsigned int *);
 void close_queues();
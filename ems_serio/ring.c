@@ -0,0 +1,94 @@
+#define _GNU_SOURCE 1
+
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/eventfd.h>
+
+#include "ems_serio.h"
+#include "ring.h"
+
+// Shared memory transport of received packets, used instead of the RX queue if enabled.
+// The reader is woken up by the eventfd ring_event.
+
+struct RING *ring = NULL;
+size_t ring_size;
+int ring_event = -1;
+
+// Creates the ring with the number of slots. Returns 0 on success.
+int ring_open(unsigned int slots) {
+    int fd;
+
+    ring_size = sizeof(struct RING) + slots * sizeof(struct RING_SLOT);
+    fd = shm_open(RING_NAME, O_RDWR | O_CREAT | O_TRUNC, 0600);
+    if (fd < 0) {
+        log(LOG_ERROR, "Failed to open shared memory %s: %s", RING_NAME, strerror(errno));
+        return(-1);
+    }
+    if (ftruncate(fd, (off_t)ring_size) != 0) {
+        log(LOG_ERROR, "Failed to size shared memory %s: %s", RING_NAME, strerror(errno));
+        close(fd);
+        return(-1);
+    }
+    ring = mmap(NULL, ring_size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if (ring == MAP_FAILED) {
+        log(LOG_ERROR, "Failed to map shared memory %s: %s", RING_NAME, strerror(errno));
+        ring = NULL;
+        return(-1);
+    }
+    ring->slots = slots;
+    ring->slot_size = sizeof(struct RING_SLOT);
+    atomic_store(&ring->head, 0);
+    atomic_store(&ring->tail, 0);
+    ring->magic = RING_MAGIC;
+
+    ring_event = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    if (ring_event < 0) {
+        log(LOG_ERROR, "Failed to create ring eventfd: %s", strerror(errno));
+        ring_close();
+        return(-1);
+    }
+    log(LOG_VERBOSE, "RX ring with %u slots created", slots);
+    return(0);
+}
+
+void ring_close() {
+    if (ring != NULL) {
+        munmap(ring, ring_size);
+        shm_unlink(RING_NAME);
+        ring = NULL;
+    }
+    if (ring_event >= 0) {
+        close(ring_event);
+        ring_event = -1;
+    }
+}
+
+// Adds a packet to the ring and wakes up the reader. Returns -1 if the ring is full.
+int ring_put(uint8_t *data, size_t len) {
+    uint64_t head = atomic_load_explicit(&ring->head, memory_order_relaxed);
+    uint64_t tail = atomic_load_explicit(&ring->tail, memory_order_acquire);
+    struct RING_SLOT *slot;
+    uint64_t one = 1;
+
+    if (head - tail >= ring->slots)
+        return(-1);
+    slot = &ring->slot[head % ring->slots];
+    slot->length = (uint8_t)len;
+    memcpy(slot->data, data, len);
+    atomic_store_explicit(&ring->head, head + 1, memory_order_release);
+    stats.rx_queue_len = (unsigned int)(head + 1 - tail);
+    if (stats.rx_queue_len > stats.rx_queue_max)
+        stats.rx_queue_max = stats.rx_queue_len;
+    // The reader cannot order its own loads and stores with a fence from Python, so it may
+    // miss a packet added just when it finished. Wake it up for each packet. It reads all
+    // packets up to head on a wakeup, so the counter of the eventfd coalesces wakeups.
+    if (write(ring_event, &one, sizeof(one)) != sizeof(one) && errno != EAGAIN)
+        log(LOG_ERROR, "RX ring: eventfd write failed: %s", strerror(errno));
+    return(0);
+}
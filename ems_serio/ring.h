@@ -0,0 +1,32 @@
+#include <stdint.h>
+#include <stdatomic.h>
+
+#define RING_NAME "/ems_bus_rx_ring"
+#define RING_MAGIC 0x454d5352 // "EMSR"
+#define RING_SLOTS 4096
+
+// A received packet in the ring
+struct RING_SLOT {
+    uint8_t length;
+    uint8_t data[MAX_PACKET_SIZE];
+};
+
+// Single producer, single consumer ring of received packets in shared memory. The driver writes
+// the slot at head and increments head, the reader processes the slots up to head and sets tail.
+// head and tail only increase, the slot of a position is position % slots.
+struct RING {
+    uint32_t magic;
+    uint32_t slots;
+    uint32_t slot_size; // sizeof(struct RING_SLOT)
+    uint32_t reserved;
+    _Alignas(64) _Atomic uint64_t head; // At offset 64
+    _Alignas(64) _Atomic uint64_t tail; // At offset 128
+    _Alignas(64) struct RING_SLOT slot[]; // At offset 192
+};
+
+extern struct RING *ring;
+extern int ring_event;
+
+int ring_open(unsigned int slots);
+void ring_close();
+int ring_put(uint8_t *data, size_t len);
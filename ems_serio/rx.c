@@ -1,6 +1,6 @@
 #include <stdint.h>
 #include <unistd.h>
-#include <sys/select.h>
+#include <poll.h>
 #include <errno.h>
 #include <stdio.h>
 #include <sys/time.h>
@@ -10,49 +10,89 @@
 #include "ems_serio.h"
 #include "queue.h"
 #include "tx.h"
+#include "capture.h"
+#include "ring.h"
+#include "crc.h"
 
 size_t rx_len;
 uint8_t rx_buf[MAX_PACKET_SIZE];
+// Characters read from the serial port but not yet processed
+uint8_t rx_chars[RX_CHARS_SIZE];
+size_t rx_chars_pos = 0;
+size_t rx_chars_len = 0;
 enum STATE state = RELEASED;
 uint8_t polled_id;
 extern uint8_t client_id;
 uint8_t read_expected[HDR_LEN];
-struct timeval got_bus;
+// Time the last read() returned, in us
+int64_t rx_read_time;
+// Time of the last poll of our ID, in us
+int64_t got_bus;
+int64_t last_poll;
 
-int rx_wait() {
-    fd_set rfds;
-    struct timeval tv;
+// Reads all available characters from the serial port with a single read().
+// Must only be called when all buffered characters are processed.
+int rx_fill() {
+    ssize_t ret;
 
-    // Wait maximum 200 ms for the BREAK
-    FD_ZERO(&rfds);
-    FD_SET(port, &rfds);
-    tv.tv_sec = 0;
-    tv.tv_usec = 1000*200; // 200 ms
-    return(select(FD_SETSIZE, &rfds, NULL, NULL, &tv));
+    ret = read(port, rx_chars, sizeof(rx_chars));
+    rx_read_time = now_us();
+    stats.rx_reads++;
+    if (ret <= 0) {
+        return(-1);
+    }
+    rx_chars_pos = 0;
+    rx_chars_len = (size_t)ret;
+    return(0);
+}
+
+// Returns the next character from the serial port. Blocks if nothing is buffered.
+int rx_getc(uint8_t *c) {
+    if (rx_chars_pos == rx_chars_len && rx_fill() != 0) {
+        return(0);
+    }
+    *c = rx_chars[rx_chars_pos++];
+    return(1);
+}
+
+// Waits until a character can be read, maximum timeout milliseconds.
+int rx_wait(int timeout) {
+    struct pollfd pfd;
+
+    // Characters are already waiting in the buffer
+    if (rx_chars_pos < rx_chars_len)
+        return(1);
+
+    pfd.fd = port;
+    pfd.events = POLLIN;
+    return(poll(&pfd, 1, timeout));
 }
 
 int rx_break() {
     // Read a BREAK from the MASTER_ID.
     int ret;
-    uint8_t echo;
+    uint8_t echo = 0;
 
-    ret = rx_wait();
+    // Wait maximum 200 ms for the BREAK
+    ret = rx_wait(200);
     if (ret != 1) {
-        log(LOG_ERROR, "select() failed: %i", ret);
+        log(LOG_ERROR, "poll() failed: %i", ret);
         return(-1);
     }
     for (size_t i = 0; i < sizeof(BREAK_IN) - 1; i++) {
-        ret = read(port, &echo, 1);
-        if (ret != 1 || echo != BREAK_IN[i]) {
-            log(LOG_ERROR, "TX fail: expected break char 0x%02x but got 0x%02x", echo,
-                BREAK_IN[i]);
+        ret = rx_getc(&echo);
+        // char is signed on x86, but not on ARM
+        if (ret != 1 || echo != (uint8_t)BREAK_IN[i]) {
+            log(LOG_ERROR, "TX fail: expected break char 0x%02x but got 0x%02x",
+                (uint8_t)BREAK_IN[i], echo);
             return(-1);
         }
     }
     return(0);
 }
 
-// Loop that reads single characters until a full packet is received.
+// Loop that processes characters until a full packet is received.
+// The characters are read in bulk, the remaining ones are kept for the next packet.
 void rx_packet(int *abort) {
     uint8_t c;
     unsigned int parity = 0;
@@ -60,7 +100,7 @@ void rx_packet(int *abort) {
 
     rx_len = 0;
     while (*abort != 1) {
-        if (read(port, &c, 1) != 1)
+        if (rx_getc(&c) != 1)
             continue;
         if (parity == 0 && c == 0xff) {
             // We got a parity mark character.
@@ -106,7 +146,7 @@ void rx_packet(int *abort) {
 
 // Handler on a received packet
 void rx_done() {
-    uint8_t dst;
+    uint8_t dst, mac;
 
     // Handle MAC packages first. They always have length 1.
     // MASTER_ID poll requests (bus assigns) have bit 7 set (0x80).
@@ -117,6 +157,8 @@ void rx_done() {
     // - Read another device (desination is ORed with 0x80) (Answer comes immediately)
     if (rx_len == 1) {
         print_packet(0, LOG_MAC, rx_buf, rx_len);
+        // Captured after the token is answered, the write to the capture file may block.
+        mac = rx_buf[0];
         if (rx_buf[0] == 0x01) {
             // Got an ACK. Warn if there was no write from the bus-owning device.
             if (state != WROTE) {
@@ -125,7 +167,7 @@ void rx_done() {
             }
             if (polled_id == client_id) {
                 // The ACK is for us after a write command. We can send another message.
-                handle_poll();
+                handle_poll(0);
             } else {
                 state = ASSIGNED;
             }
@@ -145,8 +187,13 @@ void rx_done() {
             }
             polled_id = rx_buf[0] & 0x7f;
             if (polled_id == client_id) {
-                gettimeofday(&got_bus, NULL);
-                handle_poll();
+                // The poll reply time counts from receiving the poll, not from processing it.
+                got_bus = rx_read_time;
+                if (last_poll)
+                    hist_add(stats.poll_interval_hist, HIST_BASE_POLL_INTERVAL,
+                             got_bus - last_poll);
+                last_poll = got_bus;
+                handle_poll(1);
             } else {
                 state = ASSIGNED;
             }
@@ -154,6 +201,8 @@ void rx_done() {
             log(LOG_ERROR, "Ignored unknown MAC package 0x%02hhx", rx_buf[0]);
             stats.rx_mac_errors++;
         }
+        if (capture_mac)
+            capture_packet(&mac, 1, CAPTURE_MAC);
         return;
     }
 
@@ -218,7 +267,7 @@ void rx_done() {
             return;
         }
         if (polled_id == client_id) {
-            handle_poll();
+            handle_poll(0);
         }
     } else if (state == WROTE) {
         log(LOG_ERROR, "Received package from 0x%02hhx when waiting for write ACK", rx_buf[0]);
@@ -230,10 +279,20 @@ void rx_done() {
         return;
     }
 
-    // Do not check the CRC here. It adds too much delay and we risk missing a poll cycle.
+    // Do not drop packets with a bad CRC here. EmsProtocol checks it when reading the RX queue.
     stats.rx_success++;
-    if (mq_send(rx_queue, (char *)rx_buf, rx_len, 0) == -1) {
-        log(LOG_ERROR, "RX: Could not add packet to queue: %s", strerror(errno));
+    stats.rx_sources[rx_buf[SRCPOS] & 0x7f]++;
+    capture_packet(rx_buf, rx_len, CAPTURE_PACKET);
+    if (ring != NULL) {
+        if (ring_put(rx_buf, rx_len) != 0) {
+            stats.rx_dropped++;
+            log(LOG_ERROR, "RX: Could not add packet to ring, it is full");
+        }
+    } else {
+        queue_rx_send(rx_buf, rx_len);
     }
+    // Only count bad CRCs, after the packet was forwarded
+    if (calc_crc(rx_buf, rx_len) != rx_buf[rx_len - 1])
+        stats.rx_crc++;
 }
 
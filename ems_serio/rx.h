@@ -3,6 +3,7 @@ void rx_done();
 
 extern enum STATE state;
 extern uint8_t read_expected[HDR_LEN];
-extern struct timeval got_bus;
-int rx_wait();
+extern int64_t got_bus;
+int rx_wait(int timeout);
+int rx_getc(uint8_t *c);
 int rx_break();
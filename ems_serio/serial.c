@@ -3,12 +3,28 @@
 #include <termios.h>
 #include <unistd.h>
 #include <fcntl.h>
+#include <sys/stat.h>
+#include <sys/sysmacros.h>
+
+// Device numbers of pseudo-terminal slaves (UNIX98_PTY_SLAVE_MAJOR and following)
+#define PTY_SLAVE_MAJOR_FIRST 136
+#define PTY_SLAVE_MAJOR_LAST 143
 
 int port;
+int port_is_pty;
 tcflag_t tcflag_normal;
 tcflag_t tcflag_parity;
 struct termios tios;
 
+// Returns 1 if the port is a pseudo-terminal, like the one of the bus simulator
+int is_pty() {
+    struct stat st;
+
+    if (fstat(port, &st) != 0 || !S_ISCHR(st.st_mode))
+        return(0);
+    return(major(st.st_rdev) >= PTY_SLAVE_MAJOR_FIRST && major(st.st_rdev) <= PTY_SLAVE_MAJOR_LAST);
+}
+
 int open_serial(char *tty_path) {
     // Opens a raw serial with parity marking enabled
     int ret;
@@ -35,7 +51,13 @@ int open_serial(char *tty_path) {
     // Enable parity marking.
     // This is important as each telegramme is terminated by a BREAK signal.
     // Without it, we could not distinguish between two telegrammes.
-    tios.c_iflag |= PARMRK;
+    // A pseudo-terminal has no parity, its other side sends the marks itself. With PARMRK, the
+    // line discipline would double each 0xff of them.
+    port_is_pty = is_pty();
+    if (port_is_pty)
+        tios.c_iflag &= ~PARMRK;
+    else
+        tios.c_iflag |= PARMRK;
 
     // 9600 baud
     ret = cfsetispeed(&tios, B9600);
@@ -72,6 +94,9 @@ int close_serial() {
 }
 
 int set_parity(int enable) {
+    // A pseudo-terminal does not support parity
+    if (port_is_pty)
+        return(0);
     tios.c_cflag = enable ? tcflag_parity : tcflag_normal;
     return(tcsetattr(port, TCSANOW, &tios));
 }
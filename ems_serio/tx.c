@@ -1,6 +1,9 @@
+#define _GNU_SOURCE 1
+
 #include <stdint.h>
 #include <unistd.h>
 #include <sys/time.h>
+#include <time.h>
 #include <stdio.h>
 #include <inttypes.h>
 
@@ -11,6 +14,11 @@
 #include "crc.h"
 
 int tx_retries = -1;
+// Messages sent in the current poll cycle
+unsigned int tx_poll_sent;
+// Time the first message of the current TX queue backlog was sent
+int64_t tx_backlog_start = 0;
+int tx_mode = TX_MODE_BYTE;
 uint8_t tx_buf[MAX_PACKET_SIZE];
 size_t tx_len;
 uint8_t client_id = CLIENT_ID;
@@ -30,43 +38,73 @@ void tx_break() {
     set_parity(0);
 }
 
-ssize_t tx_packet(uint8_t *msg, size_t len) {
-    size_t i;
+int64_t now_us() {
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return((int64_t)now.tv_sec * 1000000 + now.tv_nsec / 1000);
+}
+
+// Reads and checks the echo of a character. deadline is the time when the echo must be there.
+int tx_echo(uint8_t expected, int64_t deadline) {
     uint8_t echo;
+    int64_t timeout = (deadline - now_us() + 999) / 1000;
+
+    if (rx_wait(timeout > 0 ? (int)timeout : 0) != 1) {
+        log(LOG_ERROR, "Echo not received in time");
+        return(-1);
+    }
+    if (rx_getc(&echo) != 1) {
+        log(LOG_ERROR, "read() failed after successful poll");
+        return(-1);
+    };
+    log(LOG_CHAR, "RD 0x%02hhx", echo);
+    if (expected != echo) {
+        log(LOG_ERROR, "TX fail: send 0x%02x but echo is 0x%02x", expected, echo);
+        return(-1);
+    }
+    if (echo == 0xff) {
+        // Parity escaping also doubles a 0xff
+        if (rx_getc(&echo) != 1) {
+            log(LOG_ERROR, "read() failed");
+            return(-1);
+        }
+        log(LOG_CHAR, "RD 0x%02hhx", echo);
+        if (echo != 0xff) {
+            log(LOG_ERROR, "TX fail: parity escaping expected 0xff but got 0x%02x", echo);
+            return(-1);
+        }
+    }
+    return(0);
+}
 
-    print_packet(1, LOG_PACKET, msg, len);
+ssize_t tx_packet(uint8_t *msg, size_t len) {
+    size_t i;
+    int64_t start;
 
-    // Write the message by character while checking the echoed characters from the MASTER_ID
-    for (i = 0; i < len; i++) {
-        log(LOG_CHAR, "WR 0x%02hhx", msg[i]);
-        if (write(port, &msg[i], 1) != 1) {
+    if (tx_mode == TX_MODE_FRAME) {
+        // Write the whole message and check the echo stream. Character i is echoed after
+        // i + 1 characters were transmitted.
+        log(LOG_CHAR, "WR %zu characters", len);
+        start = now_us();
+        if (write(port, msg, len) != (ssize_t)len) {
             log(LOG_ERROR, "write() failed");
-            return(i);
-        }
-        if (rx_wait() != 1) {
-            log(LOG_ERROR, "Echo not received after 200 ms");
-            return(i);
+            return(0);
         }
-        if (read(port, &echo, 1) != 1) {
-            log(LOG_ERROR, "read() failed after successful select");
-            return(i);
-        };
-        log(LOG_CHAR, "RD 0x%02hhx", echo);
-        if (msg[i] != echo) {
-            log(LOG_ERROR, "TX fail: send 0x%02x but echo is 0x%02x", msg[i], echo);
-            return(i);
+        for (i = 0; i < len; i++) {
+            if (tx_echo(msg[i], start + (int64_t)(i + 2) * CHAR_TIME + ECHO_MARGIN) != 0)
+                return(i);
         }
-        if (echo == 0xff) {
-            // Parity escaping also doubles a 0xff
-            if (read(port, &echo, 1) != 1) {
-                log(LOG_ERROR, "read() failed");
+    } else {
+        // Write the message by character while checking the echoed characters from the MASTER_ID
+        for (i = 0; i < len; i++) {
+            log(LOG_CHAR, "WR 0x%02hhx", msg[i]);
+            if (write(port, &msg[i], 1) != 1) {
+                log(LOG_ERROR, "write() failed");
                 return(i);
             }
-            log(LOG_CHAR, "RD 0x%02hhx", echo);
-            if (echo != 0xff) {
-                log(LOG_ERROR, "TX fail: parity escaping expected 0xff but got 0x%02x", echo);
+            if (tx_echo(msg[i], now_us() + 2 * CHAR_TIME + ECHO_MARGIN) != 0)
                 return(i);
-            }
         }
     }
 
@@ -79,69 +117,130 @@ ssize_t tx_packet(uint8_t *msg, size_t len) {
     return(i);
 }
 
-void handle_poll() {
+void tx_bus_time(unsigned int duration) {
+    stats.tx_bus_time += duration;
+    if (duration > stats.tx_bus_time_max)
+        stats.tx_bus_time_max = duration;
+}
+
+void poll_reply(unsigned int duration) {
+    hist_add(stats.poll_reply_hist, HIST_BASE_POLL_REPLY, duration);
+    if (duration > stats.poll_reply_max)
+        stats.poll_reply_max = duration;
+}
+
+// Picks the next message from the TX queue unless a failed one is retried.
+// Returns 1 if there is a message to send.
+int tx_next() {
     ssize_t ret;
-    struct timeval now;
-    int64_t have_bus;
+    unsigned int priority;
 
-    // We got polled by the MASTER_ID. Send a message or release the bus.
-    // Todo: Send more than one message
-    // Todo: Release the bus after sending a message (does not work)
-    if (tx_retries < 0 || tx_retries > MAX_TX_RETRIES) {
-        if (tx_retries > MAX_TX_RETRIES) {
-            log(LOG_ERROR, "TX failed 5 times. Dropping message.");
-            tx_retries = -1;
-        }
-        // Pick a new message
-        //ret = msgrcv(tx_queue, &tx_buf, sizeof(tx_buf), 0, IPC_NOWAIT | MSG_NOERROR);
-        ret = mq_receive(tx_queue, (char *)tx_buf, MAX_PACKET_SIZE, 0);
-        if (ret > 0) {
-            tx_retries = 0;
-            tx_len = (size_t)ret;
-            if (tx_len >= 6) {
-                // Set the source ID and CRC value
-                tx_buf[0] = client_id;
-                tx_buf[tx_len - 1] = calc_crc(tx_buf, tx_len);
-            }
+    if (tx_retries > MAX_TX_RETRIES) {
+        log(LOG_ERROR, "TX failed 5 times. Dropping message.");
+        stats.tx_dropped++;
+        tx_retries = -1;
+    }
+    if (tx_retries >= 0) {
+        stats.tx_retries++;
+        return(1);
+    }
+
+    // The queue returns the oldest message of the highest priority
+    ret = mq_receive(tx_queue, (char *)tx_buf, MAX_PACKET_SIZE, &priority);
+    if (ret <= 0) {
+        // The queue is empty. Record how long it took to send all queued messages.
+        if (tx_backlog_start) {
+            stats.tx_drain_time = (unsigned int)(now_us() - tx_backlog_start);
+            if (stats.tx_drain_time > stats.tx_drain_time_max)
+                stats.tx_drain_time_max = stats.tx_drain_time;
+            tx_backlog_start = 0;
         }
+        return(0);
+    }
+    if (!tx_backlog_start)
+        tx_backlog_start = now_us();
+    log(LOG_VERBOSE, "Sending message with priority %u", priority);
+    tx_retries = 0;
+    tx_len = (size_t)ret;
+    if (tx_len >= 6) {
+        // Set the source ID and CRC value
+        tx_buf[0] = client_id;
+        tx_buf[tx_len - 1] = calc_crc(tx_buf, tx_len);
     }
+    return(1);
+}
 
-    gettimeofday(&now, NULL);
-    have_bus = (now.tv_sec - got_bus.tv_sec) * 1000000 + now.tv_usec - got_bus.tv_usec;
-    log(LOG_VERBOSE, "Occupying bus since %"PRIi64" us", have_bus);
+// Releases the bus by sending our ID
+void tx_release() {
+    print_packet(1, LOG_MAC, &client_id, 1);
+    if (tx_packet(&client_id, 1) != 1) {
+        log(LOG_ERROR, "TX poll reply failed");
+    }
+    state = RELEASED;
+    hist_add(stats.tx_bus_hist, HIST_BASE_TX_BUS, now_us() - got_bus);
+    if (tx_poll_sent) {
+        stats.tx_busy_polls++;
+        if (tx_poll_sent > stats.tx_poll_max)
+            stats.tx_poll_max = tx_poll_sent;
+    }
+}
+
+// We got polled by the MASTER_ID (assigned is set) or got the answer to the message we sent.
+// Send messages until one expects an answer or the bus time is over, then release the bus.
+// Todo: Release the bus after sending a message (does not work)
+void handle_poll(int assigned) {
+    ssize_t ret;
+    int64_t have_bus;
+    int64_t start;
+    int send;
+
+    if (assigned) {
+        stats.tx_polls++;
+        tx_poll_sent = 0;
+        queue_stats(tx_queue, &stats.tx_queue_len, &stats.tx_queue_max);
+    }
+
+    while (1) {
+        have_bus = now_us() - got_bus;
+        log(LOG_VERBOSE, "Occupying bus since %"PRIi64" us", have_bus);
+        send = have_bus < MAX_BUS_TIME && tx_next();
+        if (assigned) {
+            // The first character we send now is the reply to the poll
+            poll_reply((unsigned int)(now_us() - got_bus));
+            assigned = 0;
+        }
+        if (!send) {
+            tx_release();
+            return;
+        }
 
-    if (tx_retries >= 0 && have_bus < MAX_BUS_TIME) {
         print_packet(1, LOG_PACKET, tx_buf, tx_len);
-        if ((size_t)tx_packet(tx_buf, tx_len) == tx_len) {
-            tx_retries = -1;
-            if (tx_buf[1] == 0x00) {
-                // Release bus
-                print_packet(1, LOG_PACKET, &client_id, 1);
-                if (tx_packet(&client_id, 1) != 1) {
-                    log(LOG_ERROR, "TX poll reply failed");
-                }
-                state = RELEASED;
-            } else if (tx_buf[1] & 0x80) {
-                read_expected[0] = tx_buf[1] & 0x7f;
-                read_expected[1] = tx_buf[0];
-                read_expected[2] = tx_buf[2];
-                read_expected[3] = tx_buf[3];
-                state = READ;
-            } else {
-                // Write command
-                state = WROTE;
-            }
-        } else {
+        start = now_us();
+        ret = tx_packet(tx_buf, tx_len);
+        tx_bus_time((unsigned int)(now_us() - start));
+        if ((size_t)ret != tx_len) {
             log(LOG_ERROR, "TX failed, %i/%i", tx_retries, MAX_TX_RETRIES);
+            stats.tx_fail++;
             tx_retries++;
             state = RELEASED;
+            return;
         }
-    } else {
-        // Nothing to send.
-        print_packet(1, LOG_MAC, &client_id, 1);
-        if (tx_packet(&client_id, 1) != 1) {
-            log(LOG_ERROR, "TX poll reply failed");
+        stats.tx_total++;
+        tx_poll_sent++;
+        tx_retries = -1;
+        if (tx_buf[1] & 0x80) {
+            // Read request. The answer comes immediately, we continue after it in rx_done().
+            read_expected[0] = tx_buf[1] & 0x7f;
+            read_expected[1] = tx_buf[0];
+            read_expected[2] = tx_buf[2];
+            read_expected[3] = tx_buf[3];
+            state = READ;
+            return;
+        } else if (tx_buf[1] != 0x00) {
+            // Write command. We continue after the ACK in rx_done().
+            state = WROTE;
+            return;
         }
-        state = RELEASED;
+        // Broadcasts are not answered, send the next message.
     }
 }
@@ -1 +1,3 @@
-void handle_poll();
+void handle_poll(int assigned);
+extern int tx_mode;
+int64_t now_us();
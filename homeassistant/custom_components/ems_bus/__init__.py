@@ -4,11 +4,15 @@ import logging
 
 import voluptuous as vol
 import homeassistant.helpers.config_validation as cv
+from ems_bus import ems_cache, ems_messages, ems_scheduler, ems_serio
 from ems_bus.ems_fields import BooleanField, BooleanIntegerField, Field, IntegerField, StringField
-from ems_bus.ems_protocol import EmsProtocol
+from ems_bus.ems_metrics import MetricsExporter
+from ems_bus.ems_protocol import EVENT_OFFLINE, EmsProtocol
+from ems_bus.ems_throttle import UpdateFilter
 from ems_bus.ems_units import UnitCelsius
 from homeassistant import bootstrap, config_entries
 from homeassistant.const import CONF_DEVICE, EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import callback
 from homeassistant.helpers import discovery
 from homeassistant.helpers.dispatcher import async_dispatcher_send
 from homeassistant.helpers.entity import async_generate_entity_id
@@ -16,9 +20,16 @@ from homeassistant.helpers.entity_platform import DATA_ENTITY_PLATFORM
 
 #from .binary_sensor import EmsBusBinarySensor
 from .climate import EmsBusClimate
-from .const import CONF_LOG_LEVEL, CONF_SERIAL_PATH, DATA_DEVICES, DATA_EMSBUS_CONFIG, \
-                   DATA_PROTOCOL, DEFAULT_CLIENT_ID, DEFAULT_LOG_LEVEL, DEFAULT_SERIAL_PATH, \
-                   DOMAIN, PLATFORMS, SERVICE_STATS
+from .const import CACHE_FILE, CONF_CACHE, CONF_CACHE_INTERVAL, CONF_CPU, CONF_LOG_LEVEL, \
+                   CONF_MAX_OUTSTANDING_READS, CONF_METRICS_PORT, CONF_MIN_UPDATE_INTERVAL, \
+                   CONF_MLOCK, CONF_QUEUE_DEPTH, CONF_READS_PER_MINUTE, CONF_REFRESH_INTERVALS, \
+                   CONF_RT_PRIORITY, CONF_RX_OVERFLOW, CONF_SERIAL_PATH, \
+                   CONF_TEMPERATURE_HYSTERESIS, CONF_UPDATE_INTERVALS, DATA_DEVICES, \
+                   DATA_DISPATCHER, DATA_EMSBUS_CONFIG, DATA_PROTOCOL, \
+                   DEFAULT_CLIENT_ID, DEFAULT_LOG_LEVEL, DEFAULT_MIN_UPDATE_INTERVAL, \
+                   DEFAULT_QUEUE_DEPTH, DEFAULT_RX_OVERFLOW, DEFAULT_SERIAL_PATH, \
+                   DEFAULT_TEMPERATURE_HYSTERESIS, DOMAIN, PLATFORMS, SERVICE_STATS
+from .dispatcher import EntityUpdateDispatcher
 from .input_number import EmsBusInputNumber
 from .input_select import EmsBusInputSelect
 from .sensor import EmsBusSensor
@@ -26,18 +37,85 @@ from .switch import EmsBusSwitch
 
 LOGGER = logging.getLogger(__name__)
 
+RX_OVERFLOW_POLICIES = {
+    'drop_newest': ems_serio.RX_OVERFLOW_DROP_NEWEST,
+    'drop_oldest': ems_serio.RX_OVERFLOW_DROP_OLDEST,
+    'coalesce': ems_serio.RX_OVERFLOW_COALESCE,
+}
+
 CONFIG_SCHEMA = vol.Schema(
     {
         DOMAIN: vol.Schema(
             {
                 vol.Optional(CONF_SERIAL_PATH): vol.Coerce(str),
                 vol.Optional(CONF_LOG_LEVEL): vol.Coerce(int),
+                vol.Optional(CONF_QUEUE_DEPTH): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_RX_OVERFLOW): vol.In(RX_OVERFLOW_POLICIES),
+                vol.Optional(CONF_METRICS_PORT): cv.port,
+                vol.Optional(CONF_RT_PRIORITY): vol.All(vol.Coerce(int), vol.Range(min=0, max=99)),
+                vol.Optional(CONF_CPU): vol.All(vol.Coerce(int), vol.Range(min=0)),
+                vol.Optional(CONF_MLOCK): cv.boolean,
+                vol.Optional(CONF_MIN_UPDATE_INTERVAL): cv.positive_float,
+                vol.Optional(CONF_UPDATE_INTERVALS): {cv.string: cv.positive_float},
+                vol.Optional(CONF_TEMPERATURE_HYSTERESIS): cv.positive_float,
+                vol.Optional(CONF_CACHE): cv.boolean,
+                vol.Optional(CONF_CACHE_INTERVAL): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_REFRESH_INTERVALS): {cv.string: cv.positive_int},
+                vol.Optional(CONF_MAX_OUTSTANDING_READS): vol.All(vol.Coerce(int),
+                                                                  vol.Range(min=1)),
+                vol.Optional(CONF_READS_PER_MINUTE): vol.All(vol.Coerce(int), vol.Range(min=1)),
             }
         )
     },
     extra=vol.ALLOW_EXTRA
 )
 
+def entity_platform(message, field_obj):
+    '''Returns the platform name and entity class of a field of a message'''
+    platform_name = None
+    if getattr(message.Meta, 'write', False):
+        if issubclass(field_obj.__class__, BooleanField) or \
+           issubclass(field_obj.__class__, BooleanIntegerField):
+            # Boolean values -> switch
+            platform_name = 'switch'
+            platform_type = EmsBusSwitch
+        elif issubclass(field_obj.__class__, IntegerField):
+            if field_obj.unit == UnitCelsius:
+                # Celsius values -> climate
+                platform_name = 'climate'
+                platform_type = EmsBusClimate
+            elif hasattr(field_obj.unit, 'VALUES'):
+                # Multiple choice values -> Input select
+                platform_name = 'input_select'
+                platform_type = EmsBusInputSelect
+            else:
+                # Other integer values (%, bar, ...)
+                platform_name = 'input_number'
+                platform_type = EmsBusInputNumber
+    if platform_name is None:
+        # Read-only field or no write entity configured
+#        if issubclass(field_obj.__class__, BooleanField) or \
+#           issubclass(field_obj.__class__, BooleanIntegerField):
+#            # Boolean types -> Binary sensor
+#            platform_name = 'binary_sensor'
+#            platform_type = EmsBusBinarySensor
+#        else:
+        # Create a read only sensor
+        platform_name = 'sensor'
+        platform_type = EmsBusSensor
+    return(platform_name, platform_type)
+
+def message_intervals(intervals):
+    '''Returns the refresh intervals by message name as intervals by message type'''
+    message_types = {}
+    for name, interval in intervals.items():
+        message_type = getattr(ems_messages, name, None)
+        if not isinstance(message_type, type) or not issubclass(message_type, ems_messages.Message):
+            LOGGER.error('Ignoring the refresh interval of the unknown message %s', name)
+            continue
+        message_types[message_type] = interval
+    return(message_types)
+
 async def async_setup(hass, config):
     '''Old way of setting up integrations.'''
 
@@ -47,50 +125,74 @@ async def async_setup(hass, config):
     if conf is not None:
         serial_path = conf.get(CONF_SERIAL_PATH, DEFAULT_SERIAL_PATH)
         log_level = conf.get(CONF_LOG_LEVEL, DEFAULT_LOG_LEVEL)
+        queue_depth = conf.get(CONF_QUEUE_DEPTH, DEFAULT_QUEUE_DEPTH)
+        rx_overflow = conf.get(CONF_RX_OVERFLOW, DEFAULT_RX_OVERFLOW)
+        metrics_port = conf.get(CONF_METRICS_PORT)
+        rt_priority = conf.get(CONF_RT_PRIORITY, 0)
+        cpu = conf.get(CONF_CPU, -1)
+        mlock = conf.get(CONF_MLOCK, False)
+        min_update_interval = conf.get(CONF_MIN_UPDATE_INTERVAL, DEFAULT_MIN_UPDATE_INTERVAL)
+        update_intervals = conf.get(CONF_UPDATE_INTERVALS, {})
+        hysteresis = conf.get(CONF_TEMPERATURE_HYSTERESIS, DEFAULT_TEMPERATURE_HYSTERESIS)
+        cache = conf.get(CONF_CACHE, False)
+        cache_interval = conf.get(CONF_CACHE_INTERVAL, ems_cache.DEFAULT_INTERVAL)
+        refresh_intervals = conf.get(CONF_REFRESH_INTERVALS, {})
+        max_outstanding_reads = conf.get(CONF_MAX_OUTSTANDING_READS,
+                                         ems_scheduler.DEFAULT_MAX_OUTSTANDING)
+        reads_per_minute = conf.get(CONF_READS_PER_MINUTE, ems_scheduler.DEFAULT_READS_PER_MINUTE)
         #client_id = conf.get(CONF_CLIENT_ID, DEFAULT_CLIENT_ID)
     else:
         serial_path = DEFAULT_SERIAL_PATH
         log_level = DEFAULT_LOG_LEVEL
+        queue_depth = DEFAULT_QUEUE_DEPTH
+        rx_overflow = DEFAULT_RX_OVERFLOW
+        metrics_port = None
+        rt_priority = 0
+        cpu = -1
+        mlock = False
+        min_update_interval = DEFAULT_MIN_UPDATE_INTERVAL
+        update_intervals = {}
+        hysteresis = DEFAULT_TEMPERATURE_HYSTERESIS
+        cache = False
+        cache_interval = ems_cache.DEFAULT_INTERVAL
+        refresh_intervals = {}
+        max_outstanding_reads = ems_scheduler.DEFAULT_MAX_OUTSTANDING
+        reads_per_minute = ems_scheduler.DEFAULT_READS_PER_MINUTE
         #client_id = DEFAULT_CLIENT_ID
 
-    async def event_handler(signal, device, message, affected_fields):
-        '''Callback function when update events happen on the EMS bus'''
-        for field_name, field_obj in message.get_fields():
-            platform_name = None
-            if getattr(message.Meta, 'write', False):
-                if issubclass(field_obj.__class__, BooleanField) or \
-                   issubclass(field_obj.__class__, BooleanIntegerField):
-                    # Boolean values -> switch
-                    platform_name = 'switch'
-                    platform_type = EmsBusSwitch
-                elif issubclass(field_obj.__class__, IntegerField):
-                    if field_obj.unit == UnitCelsius:
-                        # Celsius values -> climate
-                        platform_name = 'climate'
-                        platform_type = EmsBusClimate
-                    elif hasattr(field_obj.unit, 'VALUES'):
-                        # Multiple choice values -> Input select
-                        platform_name = 'input_select'
-                        platform_type = EmsBusInputSelect
-                    else:
-                        # Other integer values (%, bar, ...)
-                        platform_name = 'input_number'
-                        platform_type = EmsBusInputNumber
-            if platform_name is None:
-                # Read-only field or no write entity configured
-#                if issubclass(field_obj.__class__, BooleanField) or \
-#                   issubclass(field_obj.__class__, BooleanIntegerField):
-#                    # Boolean types -> Binary sensor
-#                    platform_name = 'binary_sensor'
-#                    platform_type = EmsBusBinarySensor
-#                else:
-                # Create a read only sensor
-                platform_name = 'sensor'
-                platform_type = EmsBusSensor
+    # Routing table of the entities: {(device address, message type): {field: (platform name,
+    # unique ID, entity)}}. A route is built when a message is first seen for a device, so an
+    # update only looks up the changed fields. The routes of a device are dropped when it goes
+    # offline, as it gets new message objects when it comes back.
+    routes = {}
+    # New entities per platform name. They are added with one call per platform once the
+    # telegrams received together were handled, e.g. all messages of a new device.
+    new_entities = {}
 
+    @callback
+    def add_new_entities():
+        '''Adds the new entities to their platforms'''
+        for platform_name, entities in new_entities.items():
+            LOGGER.debug('Adding %d %s entities', len(entities), platform_name)
+            if platform_name.startswith('input_'):
+                # The Input* component only read from the yaml config.
+                # Also, the setup_platform of input_select is not called.
+                # So run it manually in the component.
+                component = hass.data[DATA_ENTITY_PLATFORM][platform_name][0]
+                hass.async_create_task(component.async_add_entities(entities))
+            else:
+                async_dispatcher_send(hass, f'{DOMAIN}_new_{platform_name}', entities)
+        new_entities.clear()
+
+    def add_route(device, message):
+        '''Returns the route of a message of a device, creating the entities of its fields'''
+        route = {}
+        for field_name, field_obj in message.get_fields():
+            platform_name, platform_type = entity_platform(message, field_obj)
             unique_id = f'{DOMAIN}_{device.address:02x}_' \
                         f'{message.Meta.identification:02x}_{field_name}'
-            if not unique_id in hass.data[DATA_DEVICES]:
+            platform = hass.data[DATA_DEVICES].get(unique_id)
+            if platform is None:
                 #LOGGER.debug('Adding new entity %s', unique_id)
                 #entity_id_format = platform_name + '.{}'
                 # It's uncommon to create the entity ID here, but here is the best place
@@ -98,37 +200,71 @@ async def async_setup(hass, config):
                 entity_id = f'{platform_name}.{unique_id}'
                 LOGGER.debug('Setting up %s', entity_id)
                 platform = platform_type(entity_id, device, message, field_name, field_obj)
-                # See comment below
-                if platform_name.startswith('input_'):
-                    # The Input* component only read from the yaml config.
-                    # Also, the setup_platform of input_select is not called.
-                    # So run it manually in the component.
-                    component = hass.data[DATA_ENTITY_PLATFORM][platform_name][0]
-                    await component.async_add_entities([platform])
-                else:
-                    async_dispatcher_send(hass, f'{DOMAIN}_new_{platform_name}', platform)
+                if not new_entities:
+                    hass.loop.call_soon(add_new_entities)
+                new_entities.setdefault(platform_name, []).append(platform)
                 hass.data[DATA_DEVICES][unique_id] = platform
-            # Dispatch update event for updated fields
-            if field_obj in affected_fields:
-                async_dispatcher_send(hass, unique_id)
-            #hass.data[DATA_DEVICES][unique_id].async_schedule_update_ha_state()
+            else:
+                # The device came online again. Show the values of its new message object.
+                platform.rebind(device, message)
+            route[field_obj] = (platform_name, unique_id, platform)
+        return(route)
+
+    async def event_handler(signal, device, message, affected_fields):
+        '''Callback function when update events happen on the EMS bus'''
+        if signal == EVENT_OFFLINE:
+            for key in [key for key in routes if key[0] == device.address]:
+                del routes[key]
+            return
+        key = (device.address, message.Meta.identification)
+        route = routes.get(key)
+        if route is None:
+            route = routes[key] = add_route(device, message)
+        # The states of the entities of the changed fields are written in one batch
+        updated = [route[field_obj][1] for field_obj in affected_fields if field_obj in route]
+        if updated:
+            dispatcher.async_update(updated)
 
     hass.data[DATA_DEVICES] = {}
+    dispatcher = hass.data[DATA_DISPATCHER] = EntityUpdateDispatcher(
+        hass, UpdateFilter(min_update_interval, update_intervals, hysteresis))
     protocol = hass.data[DATA_PROTOCOL] = EmsProtocol(
-        serial_path, log_level, DEFAULT_CLIENT_ID, event_handler, hass)
+        serial_path, log_level, DEFAULT_CLIENT_ID, event_handler, hass,
+        queue_depth=queue_depth, rx_overflow=RX_OVERFLOW_POLICIES[rx_overflow],
+        metrics=metrics_port is not None, rt_priority=rt_priority, cpu=cpu, mlock=mlock,
+        cache=hass.config.path(CACHE_FILE) if cache else None, cache_interval=cache_interval,
+        refresh_intervals=message_intervals(refresh_intervals),
+        max_outstanding_reads=max_outstanding_reads, reads_per_minute=reads_per_minute)
+    # Prometheus exporter of the bus and protocol metrics
+    exporter = MetricsExporter(protocol) if metrics_port is not None else None
+
+    # Loop time the bus was started
+    started = None
 
     async def start_emsbus(_event):
+        nonlocal started
         LOGGER.info('Starting the EMS bus...')
+        started = hass.loop.time()
         await protocol.start()
+        if exporter is not None:
+            await exporter.start(port=metrics_port)
 
     async def stop_emsbus(_event):
         LOGGER.info('Stopping the EMS bus...')
+        if exporter is not None:
+            await exporter.stop()
         await protocol.stop()
 
     def stats(_):
         '''Log statistics'''
         for key, value in protocol.stats().items():
             LOGGER.info('%20s %s', key, value)
+        for key, value in {**dispatcher.stats, **dispatcher.update_filter.stats}.items():
+            LOGGER.info('%20s %s', f'state_{key}', value)
+        if started is not None and dispatcher.last_registered is not None:
+            # The time to the full dashboard, when all devices were discovered
+            LOGGER.info('%20s %.1f s after start', 'last_entity',
+                        dispatcher.last_registered - started)
     hass.services.async_register(DOMAIN, SERVICE_STATS, stats)
 
 
@@ -16,11 +16,11 @@ async def async_setup_platform(hass, config_entry, async_add_entities, discovery
     '''Set up EMS bus binary sensor properties'''
 
     @callback
-    def async_add_binary_sensor(binary_sensor):
-        '''Add an EMS bus binary sensor property'''
-        async_add_entities([binary_sensor], False)
+    def async_add_binary_sensors(binary_sensors):
+        '''Add EMS bus binary sensor properties'''
+        async_add_entities(binary_sensors, False)
 
-    async_dispatcher_connect(hass, f'{DOMAIN}_new_binary_sensor', async_add_binary_sensor)
+    async_dispatcher_connect(hass, f'{DOMAIN}_new_binary_sensor', async_add_binary_sensors)
 
 
 class EmsBusBinarySensor(EmsBusEntity, BinarySensorDevice):
@@ -28,7 +28,7 @@ class EmsBusBinarySensor(EmsBusEntity, BinarySensorDevice):
 
     @property
     def is_on(self):
-        return(bool(self._field.value))
+        return(bool(self._value))
 
     @property
     def device_class(self):
@@ -18,12 +18,12 @@ async def async_setup_platform(hass, config_entry, async_add_entities, discovery
     '''Set up EMS bus climate properties'''
 
     @callback
-    def async_add_climate(climate):
-        '''Add an EMS bus climate property'''
-        async_add_entities([climate], False)
-        #_LOGGER.debug('Added new climate %s / %s', climate.entity_id, climate.unique_id)
+    def async_add_climates(climates):
+        '''Add EMS bus climate properties'''
+        async_add_entities(climates, False)
+        #_LOGGER.debug('Added %d new climates', len(climates))
 
-    async_dispatcher_connect(hass, f'{DOMAIN}_new_climate', async_add_climate)
+    async_dispatcher_connect(hass, f'{DOMAIN}_new_climate', async_add_climates)
 
 
 class EmsBusClimate(EmsBusEntity, ClimateDevice):
@@ -35,7 +35,7 @@ class EmsBusClimate(EmsBusEntity, ClimateDevice):
 
     @property
     def current_temperature(self):
-        return(self._field.value)
+        return(self._value)
 
     def set_temperature(self, **kwargs):
         temp = kwargs.get(ATTR_TEMPERATURE)
@@ -45,7 +45,7 @@ class EmsBusClimate(EmsBusEntity, ClimateDevice):
 
     @property
     def target_temperature(self):
-        return(self._field.value)
+        return(self._value)
 
     @property
     def supported_features(self):
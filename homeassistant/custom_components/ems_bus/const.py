@@ -5,14 +5,35 @@ DOMAIN = 'ems_bus'
 DATA_EMSBUS_CONFIG = 'ems_bus_config'
 DATA_PROTOCOL = 'ems_bus_protocol'
 DATA_DEVICES = 'ems_bus_devices'
+DATA_DISPATCHER = 'ems_bus_dispatcher'
 
 CONF_SERIAL_PATH = 'serial_path'
 #CONF_CLIENT_ID = 'client_id'
 CONF_LOG_LEVEL = 'log_level'
+CONF_QUEUE_DEPTH = 'queue_depth'
+CONF_RX_OVERFLOW = 'rx_overflow'
+CONF_METRICS_PORT = 'metrics_port'
+CONF_RT_PRIORITY = 'rt_priority'
+CONF_CPU = 'cpu'
+CONF_MLOCK = 'mlock'
+CONF_MIN_UPDATE_INTERVAL = 'min_update_interval'
+CONF_UPDATE_INTERVALS = 'update_intervals'
+CONF_TEMPERATURE_HYSTERESIS = 'temperature_hysteresis'
+CONF_CACHE = 'cache'
+CONF_CACHE_INTERVAL = 'cache_interval'
+CONF_REFRESH_INTERVALS = 'refresh_intervals'
+CONF_MAX_OUTSTANDING_READS = 'max_outstanding_reads'
+CONF_READS_PER_MINUTE = 'reads_per_minute'
 
 DEFAULT_SERIAL_PATH = '/dev/ttyAMA0'
 DEFAULT_CLIENT_ID = 0x0B
 DEFAULT_LOG_LEVEL = 3
+DEFAULT_QUEUE_DEPTH = 10
+DEFAULT_RX_OVERFLOW = 'drop_newest'
+DEFAULT_MIN_UPDATE_INTERVAL = 0
+DEFAULT_TEMPERATURE_HYSTERESIS = 0
+# In the configuration directory
+CACHE_FILE = 'ems_bus_cache.json'
 
 SERVICE_STATS = 'stats'
 
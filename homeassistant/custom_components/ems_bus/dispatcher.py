@@ -0,0 +1,72 @@
+'''Batched state writes of the EMS bus entities'''
+
+from ems_bus.ems_throttle import PUBLISH, THROTTLED
+from homeassistant.core import callback
+
+
+class EntityUpdateDispatcher:
+    '''Writes the states of the entities of the fields changed by a telegram in one batch.
+
+    The entities register when they are added to hass. An UpdateFilter skips unchanged values,
+    temperatures within the hysteresis and updates faster than the minimum interval. A throttled
+    entity is written once its interval elapsed, with the value it has then.'''
+
+    def __init__(self, hass, update_filter):
+        self._hass = hass
+        self.update_filter = update_filter
+        # {unique ID: entity added to hass}
+        self._entities = {}
+        # {unique ID: timer of a throttled entity}
+        self._timers = {}
+        self.stats = {'batches': 0, 'writes': 0, 'entities': 0}
+        # Loop time the last entity was added to hass
+        self.last_registered = None
+
+    @callback
+    def register(self, entity):
+        '''Registers an entity added to hass. Its state was just written.'''
+        self._entities[entity.unique_id] = entity
+        self.stats['entities'] += 1
+        self.last_registered = self._hass.loop.time()
+        self.update_filter.published(entity.unique_id, entity._field_name, entity._value,
+                                     self.last_registered)
+
+    @callback
+    def unregister(self, entity):
+        self._entities.pop(entity.unique_id, None)
+        self.update_filter.forget(entity.unique_id)
+        timer = self._timers.pop(entity.unique_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    @callback
+    def async_update(self, unique_ids):
+        '''Writes the states of the entities whose field changed in one telegram'''
+        self.stats['batches'] += 1
+        now = self._hass.loop.time()
+        for unique_id in unique_ids:
+            entity = self._entities.get(unique_id)
+            # Entities not yet added write their state when added
+            if entity is not None:
+                self._update(entity, now)
+
+    def _update(self, entity, now):
+        unique_id = entity.unique_id
+        decision = self.update_filter.check(unique_id, entity._field_name, entity._field,
+                                            entity._value, now)
+        if decision == PUBLISH:
+            timer = self._timers.pop(unique_id, None)
+            if timer is not None:
+                timer.cancel()
+            entity.async_write_ha_state()
+            self.stats['writes'] += 1
+        elif decision == THROTTLED and unique_id not in self._timers:
+            self._timers[unique_id] = self._hass.loop.call_at(
+                self.update_filter.due(unique_id), self._deferred, unique_id)
+
+    @callback
+    def _deferred(self, unique_id):
+        del self._timers[unique_id]
+        entity = self._entities.get(unique_id)
+        if entity is not None:
+            self._update(entity, self._hass.loop.time())
@@ -1,8 +1,6 @@
 import logging
 
-from homeassistant.helpers.dispatcher import async_dispatcher_connect
-
-from .const import DOMAIN
+from .const import DATA_DISPATCHER, DOMAIN
 from ems_bus.ems_fields import BooleanField, BooleanIntegerField
 
 _LOGGER = logging.getLogger(__name__)
@@ -19,18 +17,30 @@ class EmsBusEntity:
         self.entity_id = entity_id
 
     async def async_added_to_hass(self):
-        """Connect to update callbacks"""
+        """Register for state writes of the dispatcher"""
         await super().async_added_to_hass()
-        async def updated():
-            self.async_schedule_update_ha_state(False)
-        async_dispatcher_connect(self.hass, self._unique_id, updated)
+        self.hass.data[DATA_DISPATCHER].register(self)
         _LOGGER.debug('Added %s', self.entity_id)
 
+    async def async_will_remove_from_hass(self):
+        self.hass.data[DATA_DISPATCHER].unregister(self)
+        await super().async_will_remove_from_hass()
+
+    def rebind(self, device, message):
+        '''Shows the field of the message object of a device which came online again'''
+        self._devinfo = device
+        self._message = message
+
+    @property
+    def _value(self):
+        '''Current value of the field in the message'''
+        return(getattr(self._message, self._field_name))
+
     @property
     def is_on(self):
         '''Return if the entity is on'''
         if isinstance(self._field, (BooleanField, BooleanIntegerField)):
-            return(bool(self._field.value))
+            return(bool(self._value))
         return(None)
 
     @property
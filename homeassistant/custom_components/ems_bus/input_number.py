@@ -18,11 +18,11 @@ async def async_setup_platform(hass, config_entry, async_add_entities, discovery
     '''Set up EMS bus input number properties'''
 
     @callback
-    def async_add_input_number(input_number):
-        '''Add an EMS bus input_number property'''
-        async_add_entities([input_number], False)
+    def async_add_input_numbers(input_numbers):
+        '''Add EMS bus input_number properties'''
+        async_add_entities(input_numbers, False)
 
-    async_dispatcher_connect(hass, f'{DOMAIN}_new_input_number', async_add_input_number)
+    async_dispatcher_connect(hass, f'{DOMAIN}_new_input_number', async_add_input_numbers)
 
 
 class EmsBusInputNumber(EmsBusEntity, InputNumber):
@@ -35,7 +35,7 @@ class EmsBusInputNumber(EmsBusEntity, InputNumber):
             between = (0, 100)
 
         config = {
-            CONF_INITIAL: self._field.value,
+            CONF_INITIAL: self._value,
             CONF_ID: entity_id,
             CONF_MIN: between[0],
             CONF_MAX: between[1],
@@ -51,7 +51,7 @@ class EmsBusInputNumber(EmsBusEntity, InputNumber):
     @property
     def state(self):
         """Return the state of the component."""
-        return self._field.value
+        return self._value
 
     async def async_set_value(self, value):
         """Set new value."""
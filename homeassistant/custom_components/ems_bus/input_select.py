@@ -16,11 +16,11 @@ async def async_setup_platform(hass, config_entry, async_add_entities, discovery
     '''Set up EMS bus input select properties'''
 
     @callback
-    def async_add_input_select(input_select):
-        '''Add an EMS bus input_select property'''
-        async_add_entities([input_select], False)
+    def async_add_input_selects(input_selects):
+        '''Add EMS bus input_select properties'''
+        async_add_entities(input_selects, False)
 
-    async_dispatcher_connect(hass, f'{DOMAIN}_new_input_select', async_add_input_select)
+    async_dispatcher_connect(hass, f'{DOMAIN}_new_input_select', async_add_input_selects)
 
 
 class EmsBusInputSelect(EmsBusEntity, InputSelect):
@@ -34,7 +34,7 @@ class EmsBusInputSelect(EmsBusEntity, InputSelect):
             options = ()
 
         config = {
-            CONF_INITIAL: options[self._field.value],
+            CONF_INITIAL: options[self._value],
             CONF_OPTIONS: options,
             CONF_ID: entity_id
         }
@@ -54,4 +54,4 @@ class EmsBusInputSelect(EmsBusEntity, InputSelect):
     @property
     def state(self):
         """Return the state of the component."""
-        return self._options[self._field.value]
+        return self._options[self._value]
@@ -16,12 +16,12 @@ async def async_setup_platform(hass, config_entry, async_add_entities, discovery
     '''Set up EMS bus sensor properties'''
 
     @callback
-    def async_add_sensor(sensor):
-        '''Add an EMS bus sensor property'''
-        async_add_entities([sensor], True)
-        #_LOGGER.debug('Added new sensor %s / %s', sensor.entity_id, sensor.unique_id)
+    def async_add_sensors(sensors):
+        '''Add EMS bus sensor properties'''
+        async_add_entities(sensors, True)
+        #_LOGGER.debug('Added %d new sensors', len(sensors))
 
-    async_dispatcher_connect(hass, f'{DOMAIN}_new_sensor', async_add_sensor)
+    async_dispatcher_connect(hass, f'{DOMAIN}_new_sensor', async_add_sensors)
 
 
 class EmsBusSensor(EmsBusEntity, Entity):
@@ -29,14 +29,14 @@ class EmsBusSensor(EmsBusEntity, Entity):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._unit = None if self._field.unit is None else self._field.unit(self._field.value)
+        self._unit = None if self._field.unit is None else self._field.unit(self._value)
 
     @property
     def state(self):
         '''Return the state of the sensor.'''
         if self._unit is None:
-            return(self._field.value)
-        self._unit.update(self._field.value)
+            return(self._value)
+        self._unit.update(self._value)
         return(self._unit.value)
 
     @property
@@ -16,12 +16,12 @@ async def async_setup_platform(hass, config_entry, async_add_entities, discovery
     '''Set up EMS bus switch properties'''
 
     @callback
-    def async_add_switch(switch):
-        '''Add an EMS bus switch property'''
-        async_add_entities([switch], True)
-        #_LOGGER.debug('Added new switch %s / %s', switch.entity_id, switch.unique_id)
+    def async_add_switches(switches):
+        '''Add EMS bus switch properties'''
+        async_add_entities(switches, True)
+        #_LOGGER.debug('Added %d new switchs', len(switches))
 
-    async_dispatcher_connect(hass, f'{DOMAIN}_new_switch', async_add_switch)
+    async_dispatcher_connect(hass, f'{DOMAIN}_new_switch', async_add_switches)
 
 
 class EmsBusSwitch(EmsBusEntity, SwitchDevice):
@@ -7,10 +7,13 @@ EMS_SERIO_DIR = 'ems_serio'
 ems_serio = Extension(
     "ems_bus.ems_serio",
     [
+        os.path.join(EMS_SERIO_DIR, "capture.c"),
         os.path.join(EMS_SERIO_DIR, "crc.c"),
         os.path.join(EMS_SERIO_DIR, "ems_serio.c"),
+        os.path.join(EMS_SERIO_DIR, "logring.c"),
         os.path.join(EMS_SERIO_DIR, "python_module.c"),
         os.path.join(EMS_SERIO_DIR, "queue.c"),
+        os.path.join(EMS_SERIO_DIR, "ring.c"),
         os.path.join(EMS_SERIO_DIR, "rx.c"),
         os.path.join(EMS_SERIO_DIR, "serial.c"),
         os.path.join(EMS_SERIO_DIR, "tx.c")